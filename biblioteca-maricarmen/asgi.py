@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'biblioteca-maricarmen.settings')
 
 application = get_asgi_application()
+
+# Índice de sugerencias y trabajos pendientes: se ponen en marcha con la primera
+# petición, no al importar la aplicación (órdenes de gestión, tests)
+from biblioteca import segon_pla  # noqa: E402
+segon_pla.en_la_primera_peticio()
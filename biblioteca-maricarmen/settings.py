@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
-import os, environ
+import os, environ, tempfile
 
 env = environ.Env(
     # set casting, default value
@@ -46,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # El primero, para medir la petición entera; sin INSTRUMENTACIO no hace nada
+    'biblioteca.instrumentacio.InstrumentacioMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -96,6 +98,12 @@ WSGI_APPLICATION = 'biblioteca-maricarmen.wsgi.application'
 DATABASES = {
      'default': env.db(),
 }
+# Tests con SQLite: base de datos en un fichero temporal y no en memoria, para
+# que varias conexiones compartan los datos y los tests de concurrencia se ejecuten
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default'].setdefault('TEST', {}).setdefault(
+        'NAME', env("TEST_DATABASE_NAME", default=os.path.join(tempfile.gettempdir(), 'biblioteca_test.sqlite3'))
+    )
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -139,5 +147,101 @@ STATIC_ROOT = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Índice de sugerencias de búsqueda en memoria (biblioteca/suggeriments.py):
+# memoria máxima en bytes (0 lo desactiva) y segundos entre reconstrucciones
+SUGGERIMENTS_MEMORIA_MAXIMA = env.int("SUGGERIMENTS_MEMORIA_MAXIMA", default=64 * 1024 * 1024)
+SUGGERIMENTS_REFRESC = env.int("SUGGERIMENTS_REFRESC", default=300)
+
+# Autocompletado con Google Books (biblioteca/google_books.py)
+GOOGLE_BOOKS_URL = env("GOOGLE_BOOKS_URL", default="https://www.googleapis.com/books/v1/volumes")
+GOOGLE_BOOKS_TIMEOUT = env.float("GOOGLE_BOOKS_TIMEOUT", default=2.0)
+GOOGLE_BOOKS_CACHE_TTL = env.int("GOOGLE_BOOKS_CACHE_TTL", default=7 * 24 * 3600)
+GOOGLE_BOOKS_CACHE_MAX = env.int("GOOGLE_BOOKS_CACHE_MAX", default=5000)
+GOOGLE_BOOKS_ERRORS_MAX = 3
+GOOGLE_BOOKS_PAUSA = 60
+
+# Etiquetas (biblioteca/etiquetes.py): caché de códigos de barras en disco y
+# número de páginas por lote a partir del cual el PDF se genera por partes
+ETIQUETES_CACHE_DIR = env("ETIQUETES_CACHE_DIR", default=os.path.join(BASE_DIR, 'cache', 'codis_barres'))
+ETIQUETES_PAGINES_PER_LOT = 10
+
+# Trabajos de etiquetas en segundo plano (biblioteca/treballs.py): carpeta de
+# los PDF generados, hilos por proceso y segundos sin progreso tras los que un
+# trabajo en curso se da por abandonado y se vuelve a encolar
+ETIQUETES_TREBALLS_DIR = env("ETIQUETES_TREBALLS_DIR", default=os.path.join(BASE_DIR, 'cache', 'etiquetes'))
+ETIQUETES_TREBALLADORS = env.int("ETIQUETES_TREBALLADORS", default=2)
+ETIQUETES_TREBALL_TIMEOUT = 600
+# Segundos tras los que un trabajo acabado o con error se borra junto con su PDF
+ETIQUETES_TREBALL_CADUCITAT = env.int("ETIQUETES_TREBALL_CADUCITAT", default=7 * 24 * 3600)
+
+# Importación de usuarios (biblioteca/importacio.py): procesos para cifrar las
+# contraseñas (por defecto, uno por CPU) y usuarios por cada bulk_create, que
+# también es el tamaño de cada bloque confirmado en las importaciones de fichero
+IMPORTACIO_PROCESSOS = env.int("IMPORTACIO_PROCESSOS", default=0) or None
+IMPORTACIO_LOT = 500
+IMPORTACIO_DIR = env("IMPORTACIO_DIR", default=os.path.join(BASE_DIR, 'cache', 'importacions'))
+IMPORTACIO_TIMEOUT = 600
+# Tamaño máximo en bytes de un fichero subido a /import_users/stream/
+IMPORTACIO_MIDA_MAXIMA = env.int("IMPORTACIO_MIDA_MAXIMA", default=50 * 1024 * 1024)
+
+# Tokens de la API (biblioteca/tokens.py): caché en memoria token→usuario de
+# cada proceso, con el número máximo de entradas y los segundos de validez
+TOKENS_CACHE_MAX = env.int("TOKENS_CACHE_MAX", default=1024)
+TOKENS_CACHE_TTL = env.int("TOKENS_CACHE_TTL", default=60)
+
+# Tokens firmados: se activan con TOKENS_SIGNATS; TOKENS_OPACS mantiene válidos
+# los tokens de antes durante la migración. Duración del token, segundos tras
+# caducar en los que aún se puede refrescar y cada cuánto cada proceso vuelve a
+# leer los tokens revocados
+TOKENS_SIGNATS = env.bool("TOKENS_SIGNATS", default=True)
+TOKENS_OPACS = env.bool("TOKENS_OPACS", default=True)
+TOKENS_DURADA = env.int("TOKENS_DURADA", default=3600)
+TOKENS_REFRESC = env.int("TOKENS_REFRESC", default=7 * 24 * 3600)
+TOKENS_REVOCATS_INTERVAL = 5
+
+# Inicio de sesión: durante TOKENS_LOGIN_TTL segundos las mismas credenciales
+# devuelven el mismo token sin volver a cifrar la contraseña, si al token aún
+# le quedan TOKENS_REUS_MINIM segundos
+TOKENS_LOGIN_TTL = env.int("TOKENS_LOGIN_TTL", default=300)
+TOKENS_REUS_MINIM = 300
+
+# Permisos y perfil de cada usuario (biblioteca/permisos.py): segundos que la
+# copia en memoria de cada proceso es válida si no la invalida ninguna señal
+PERMISOS_CACHE_TTL = env.int("PERMISOS_CACHE_TTL", default=300)
+
+# Instrumentación por petición (biblioteca/instrumentacio.py), desactivada por
+# defecto: cabecera Server-Timing con el tiempo de SQL y de Python, las
+# peticiones de más de INSTRUMENTACIO_LLINDAR_MS milisegundos con sus consultas
+# en INSTRUMENTACIO_LOG (rotativo) y estadísticas por ruta de las últimas
+# INSTRUMENTACIO_MOSTRES peticiones de cada proceso en /api/instrumentacio/rutes
+INSTRUMENTACIO = env.bool("INSTRUMENTACIO", default=False)
+INSTRUMENTACIO_LLINDAR_MS = env.int("INSTRUMENTACIO_LLINDAR_MS", default=500)
+INSTRUMENTACIO_LOG = env("INSTRUMENTACIO_LOG", default=os.path.join(BASE_DIR, 'cache', 'logs', 'peticions_lentes.log'))
+INSTRUMENTACIO_CONSULTES_LENTES = 3
+INSTRUMENTACIO_MOSTRES = 1000
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "peticions_lentes": {
+            "class": "logging.handlers.RotatingFileHandler",
+            "filename": INSTRUMENTACIO_LOG,
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 5,
+            "encoding": "utf-8",
+            # El fichero no se crea hasta la primera petición lenta
+            "delay": True,
+        },
+    },
+    "loggers": {
+        "biblioteca.peticions_lentes": {
+            "handlers": ["peticions_lentes"],
+            "level": "WARNING",
+            "propagate": False,
+        },
+    },
+}
+
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_CREDENTIALS = True
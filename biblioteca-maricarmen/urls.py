@@ -16,6 +16,9 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", api.urls),
     path("import_users/", views.import_users),
+    path("import_users/stream/", views.import_users_stream),
+    path("import_users/stream/<uuid:codi>/", views.import_users_stream_status),
+    path("import_users/stream/<uuid:codi>/errors/", views.import_users_stream_errors),
     path('test-403/', views.test_403),
 ]
 
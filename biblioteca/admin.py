@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import F, Sum
 from django.utils.html import escape, mark_safe
 
 
@@ -50,8 +51,14 @@ class LlibreAdmin(admin.ModelAdmin):
 	search_fields = ('titol','autor','CDU','signatura','ISBN','editorial','colleccio')
 	list_display = ('titol','autor','editorial','num_exemplars')
 	readonly_fields = ('thumb',)
+	def get_queryset(self, request):
+		# Comptadors de DisponibilitatExemplars: un join en lloc d'un COUNT per fila
+		return super().get_queryset(request).annotate(
+			total_exemplars=Sum(F('disponibilitats__disponible') + F('disponibilitats__exclos_prestec') + F('disponibilitats__baixa')),
+		)
 	def num_exemplars(self,obj):
-		return obj.exemplar_set.count()
+		return obj.total_exemplars or 0
+	num_exemplars.admin_order_field = 'total_exemplars'
 	def thumb(self,obj):
 		return mark_safe("<img src='{}' />".format(escape(obj.thumbnail_url)))
 	thumb.allow_tags = True
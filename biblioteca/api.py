@@ -1,20 +1,15 @@
-from django.contrib.auth import authenticate
-from ninja import NinjaAPI, Schema, Query
+from django.http import FileResponse
+from ninja import NinjaAPI, Schema, Query, Field
 from ninja.security import HttpBasicAuth, HttpBearer
 from django.db.models.functions import Substr, Length
-from django.template.loader import render_to_string
-from django.http import HttpResponse
-from xhtml2pdf import pisa
-from io import BytesIO
-import base64
-import barcode
-from barcode.writer import ImageWriter
-from barcode import Code128
 
 from .models import *
+from .paginacio import Pagina, paginar, normalitzar_limit, codificar_cursor, decodificar_cursor
+from . import cerca, suggeriments, google_books, etiquetes, treballs, tokens, permisos, circulacio, disponibilitat, instrumentacio
+from ninja.errors import HttpError
 from typing import List, Optional, Union, Literal
-import secrets
-from django.db.models import Q
+from django.db.models import Q, OuterRef, Subquery
+from django.db import transaction
 import re  # Importar módulo para manejar signos de puntuación
 
 api = NinjaAPI()
@@ -81,7 +76,7 @@ class ExemplarSearchOut(Schema):
     exclos_prestec: bool
     baixa: bool
 
-@api.get("/exemplars/search/", response=List[ExemplarSearchOut])
+@api.get("/exemplars/search/", response=Pagina[ExemplarSearchOut])
 def search_exemplars(request, q: Optional[str] = Query(None), 
                     start: Optional[str] = Query(None), 
                     end: Optional[str] = Query(None), 
@@ -90,11 +85,18 @@ def search_exemplars(request, q: Optional[str] = Query(None),
                     id: Optional[int] = Query(None),
                     tipo: Optional[str] = Query(None),
                     code: Optional[str] = Query(None),
-                    centre_id: Optional[int] = Query(None)):
+                    centre_id: Optional[int] = Query(None),
+                    cursor: Optional[str] = Query(None),
+                    limit: Optional[int] = Query(None)):
     """
     Endpoint para buscar ejemplares por múltiples criterios combinados.
+    Paginado por cursor sobre el registro.
     """
-    exemplars = Exemplar.objects.select_related("cataleg").all()
+    exemplars = Exemplar.objects.select_related("cataleg__llibre").all()
+
+    # Filtrar por tipo de catálogo si se especifica
+    if tipo:
+        exemplars = exemplars.filter(cataleg__tipus=tipo)
 
     # Filtrar por centro si se especifica
     if centre_id is not None:
@@ -128,36 +130,26 @@ def search_exemplars(request, q: Optional[str] = Query(None),
     if code:
         exemplars = exemplars.filter(registre=code)
 
+    exemplars, next_cursor = paginar(exemplars, cursor, limit, camp="registre")
+
     # Formatear los resultados
     results = []
     for exemplar in exemplars:
-        tipus = "indefinit"
-        if hasattr(exemplar.cataleg, "llibre"):
-            tipus = "llibre"
-        elif hasattr(exemplar.cataleg, "revista"):
-            tipus = "revista"
-        elif hasattr(exemplar.cataleg, "cd"):
-            tipus = "cd"
-        elif hasattr(exemplar.cataleg, "dvd"):
-            tipus = "dvd"
-        elif hasattr(exemplar.cataleg, "br"):
-            tipus = "br"
-        elif hasattr(exemplar.cataleg, "dispositiu"):
-            tipus = "dispositiu"
+        tipus = exemplar.cataleg.tipus
 
         results.append({
             "id": exemplar.id,
             "registre": exemplar.registre,
             "titol": exemplar.cataleg.titol,
             "autor": exemplar.cataleg.autor,
-            "editorial": exemplar.cataleg.llibre.editorial if hasattr(exemplar.cataleg, "llibre") else None,
+            "editorial": exemplar.cataleg.llibre.editorial if tipus == "llibre" else None,
             "CDU": exemplar.cataleg.CDU,
             "tipus": tipus,
             "exclos_prestec": exemplar.exclos_prestec,
             "baixa": exemplar.baixa,
         })
 
-    return results
+    return {"items": results, "next": next_cursor}
 
 
 # Endpoint para obtener sugerencias de búsqueda
@@ -167,48 +159,71 @@ def get_search_suggestions(request, q: str):
     if not q:
         return []
     
+    # Índice de prefijos en memoria, sin consultar la base de datos
+    if suggeriments.index.disponible():
+        return suggeriments.index.suggeriments_cataleg(q, 10)
+
     # Buscar en el catálogo
-    query = Q(titol__icontains=q) | Q(autor__icontains=q)
-    items = Cataleg.objects.filter(query)[:10]  # Limitamos a 10 sugerencias
+    if cerca.disponible():
+        # Índice de texto completo, ordenado por relevancia
+        ids = [cataleg_id for cataleg_id, _ in cerca.cercar(q, 10)]
+        trobats = Cataleg.objects.in_bulk(ids)
+        items = [trobats[i] for i in ids if i in trobats]
+    else:
+        query = Q(titol__icontains=q) | Q(autor__icontains=q)
+        items = Cataleg.objects.filter(query)[:10]  # Limitamos a 10 sugerencias
     
     results = []
     for item in items:
-        # Determinar el tipo de ítem
-        if hasattr(item, 'llibre'):
-            tipus = "llibre"
-        elif hasattr(item, 'revista'):
-            tipus = "revista"
-        elif hasattr(item, 'cd'):
-            tipus = "cd"
-        elif hasattr(item, 'dvd'):
-            tipus = "dvd"
-        elif hasattr(item, 'br'):
-            tipus = "br"
-        elif hasattr(item, 'dispositiu'):
-            tipus = "dispositiu"
-        else:
-            tipus = "indefinit"
-        
         results.append({
             "id": item.id,
             "titol": item.titol,
             "autor": item.autor,
-            "tipus": tipus
+            "tipus": item.tipus
         })
     
     return results
 
-# Endpoint para realizar búsqueda completa
-@api.get("/cataleg/search/", response=List[SearchResultOut])
-def search_catalog(request, q: str = None):
-    # Si la consulta está vacía, devolver todos los elementos del catálogo
-    if q is None or q.strip() == '':
-        items = Cataleg.objects.all()
+def cataleg_amb_relacions(items, tipus=None):
+    """
+    Afegeix al queryset de Cataleg les subclasses, país, llengua, tags i
+    l'estat del primer exemplar perquè la serialització no faci més consultes.
+    Si es coneix el tipus, només s'uneix la taula d'aquella subclasse.
+    """
+    relacions = {
+        "llibre": ("llibre__pais", "llibre__llengua"),
+        "revista": ("revista__pais", "revista__llengua"),
+        "cd": ("cd",),
+        "dvd": ("dvd",),
+        "br": ("br",),
+        "dispositiu": ("dispositiu",),
+    }
+    if tipus:
+        select = relacions.get(tipus, ())
     else:
-        # Realizar la búsqueda en el catálogo
-        query = Q(titol__icontains=q) | Q(autor__icontains=q)
-        items = Cataleg.objects.filter(query)
-    
+        select = [r for rels in relacions.values() for r in rels]
+
+    primer_exemplar = Exemplar.objects.filter(cataleg=OuterRef('pk')).order_by('registre')
+    return items.select_related(*select).prefetch_related("tags").annotate(
+        primer_exclos_prestec=Subquery(primer_exemplar.values('exclos_prestec')[:1]),
+        primer_baixa=Subquery(primer_exemplar.values('baixa')[:1]),
+    )
+
+def comptar_exemplars(cataleg_ids):
+    """
+    Retorna {cataleg_id: {disponible, exclos_prestec, baixa}} amb una sola
+    consulta als comptadors de DisponibilitatExemplars.
+    """
+    return disponibilitat.per_cataleg(cataleg_ids)
+
+def serialitzar_resultats_cerca(items):
+    """
+    Serialitza una llista de Cataleg (carregada amb cataleg_amb_relacions)
+    amb el format de SearchResultOut.
+    """
+    items = list(items)
+    counts = comptar_exemplars([item.id for item in items])
+
     results = []
     for item in items:
         # Base data common to all types
@@ -223,111 +238,137 @@ def search_catalog(request, q: str = None):
             "resum": item.resum,
             "anotacions": item.anotacions,
             "mides": item.mides,
-            "tipus": "indefinit"
+            "tipus": item.tipus
         }
-        
-        exemplars = Exemplar.objects.filter(cataleg=item)
-        exemplar_counts = {
-            "disponible": exemplars.filter(exclos_prestec=False, baixa=False).count(),
-            "exclos_prestec": exemplars.filter(exclos_prestec=True, baixa=False).count(),
-            "baixa": exemplars.filter(baixa=True).count()
-        }
-        
-        result["exemplar_counts"] = exemplar_counts
-        
+
+        result["exemplar_counts"] = counts.get(item.id, {
+            "disponible": 0,
+            "exclos_prestec": 0,
+            "baixa": 0
+        })
+
         # Add tags (categories)
         result["tags"] = [{
             "id": tag.id,
             "nom": tag.nom
         } for tag in item.tags.all()]
-        
+
         # Determine specific type and add specific attributes
-        if hasattr(item, 'llibre'):
+        if item.tipus == 'llibre':
             llibre = item.llibre
-            result["tipus"] = "llibre"
             result["editorial"] = llibre.editorial
             result["ISBN"] = llibre.ISBN
             result["colleccio"] = llibre.colleccio
             result["lloc"] = llibre.lloc
             result["pagines"] = llibre.pagines
-            
+
             # Add país and llengua references
             if llibre.pais:
                 result["pais"] = {"id": llibre.pais.id, "nom": llibre.pais.nom}
-            
+
             if llibre.llengua:
                 result["llengua"] = {"id": llibre.llengua.id, "nom": llibre.llengua.nom}
-            
-        elif hasattr(item, 'revista'):
+
+        elif item.tipus == 'revista':
             revista = item.revista
-            result["tipus"] = "revista"
             result["editorial"] = revista.editorial
             result["ISSN"] = revista.ISSN
             result["lloc"] = revista.lloc
             result["pagines"] = revista.pagines
-            
+
             # Add país and llengua references
             if revista.pais:
                 result["pais"] = {"id": revista.pais.id, "nom": revista.pais.nom}
-            
+
             if revista.llengua:
                 result["llengua"] = {"id": revista.llengua.id, "nom": revista.llengua.nom}
-            
-        elif hasattr(item, 'cd'):
+
+        elif item.tipus == 'cd':
             cd = item.cd
-            result["tipus"] = "cd"
             result["discografica"] = cd.discografica
             result["estil"] = cd.estil
             result["duracio"] = str(cd.duracio) if cd.duracio else None
-            
-        elif hasattr(item, 'dvd'):
+
+        elif item.tipus == 'dvd':
             dvd = item.dvd
-            result["tipus"] = "dvd"
             result["productora"] = dvd.productora
             result["duracio"] = str(dvd.duracio) if dvd.duracio else None
-            
-        elif hasattr(item, 'br'):
+
+        elif item.tipus == 'br':
             br = item.br
-            result["tipus"] = "br"
             result["productora"] = br.productora
             result["duracio"] = str(br.duracio) if br.duracio else None
-            
-        elif hasattr(item, 'dispositiu'):
+
+        elif item.tipus == 'dispositiu':
             dispositiu = item.dispositiu
-            result["tipus"] = "dispositiu"
             result["marca"] = dispositiu.marca
             result["model"] = dispositiu.model
-        
-        # Check if there are exemplars and get their status
-        exemplars = Exemplar.objects.filter(cataleg=item)
-        if exemplars.exists():
-            exemplar = exemplars.first()
-            result["exclos_prestec"] = exemplar.exclos_prestec
-            result["baixa"] = exemplar.baixa
-        
+
+        # Estado del primer ejemplar (si hay alguno)
+        if item.primer_baixa is not None:
+            result["exclos_prestec"] = item.primer_exclos_prestec
+            result["baixa"] = item.primer_baixa
+
         results.append(result)
-    
+
     return results
+
+def cerca_per_rellevancia(q, tipus, cursor, limit):
+    """
+    Búsqueda en el índice de texto completo. El cursor guarda el (rank, id)
+    del último resultado para seguir en el mismo orden de relevancia.
+    """
+    limit = normalitzar_limit(limit)
+    despres = None
+    if cursor:
+        despres = decodificar_cursor(cursor)
+        if not isinstance(despres, list) or len(despres) != 2:
+            raise HttpError(400, "Cursor no vàlid")
+
+    files = cerca.cercar(q, limit + 1, despres, tipus)
+    next_cursor = None
+    if len(files) > limit:
+        files = files[:limit]
+        darrer_id, darrer_rank = files[-1]
+        next_cursor = codificar_cursor([darrer_rank, darrer_id])
+
+    ids = [cataleg_id for cataleg_id, _ in files]
+    trobats = {item.id: item for item in cataleg_amb_relacions(Cataleg.objects.filter(id__in=ids), tipus)}
+    items = [trobats[i] for i in ids if i in trobats]
+    return {"items": serialitzar_resultats_cerca(items), "next": next_cursor}
+
+# Endpoint para realizar búsqueda completa
+@api.get("/cataleg/search/", response=Pagina[SearchResultOut])
+def search_catalog(request, q: str = None, tipus: Optional[str] = None,
+                   cursor: Optional[str] = None, limit: Optional[int] = None):
+    # Si la consulta está vacía, devolver todos los elementos del catálogo
+    if q is None or q.strip() == '':
+        items = Cataleg.objects.all()
+    elif cerca.disponible():
+        # Resultados ordenados por relevancia
+        return cerca_per_rellevancia(q, tipus, cursor, limit)
+    else:
+        # Realizar la búsqueda en el catálogo
+        query = Q(titol__icontains=q) | Q(autor__icontains=q)
+        items = Cataleg.objects.filter(query)
+
+    # Filtrar por tipo de catálogo si se especifica
+    if tipus:
+        items = items.filter(tipus=tipus)
+
+    items, next_cursor = paginar(cataleg_amb_relacions(items, tipus), cursor, limit)
+    return {"items": serialitzar_resultats_cerca(items), "next": next_cursor}
+
 # Autenticació bàsica
 class BasicAuth(HttpBasicAuth):
     def authenticate(self, request, username, password):
-        user = authenticate(username=username, password=password)
-        if user:
-            # Genera un token simple
-            token = secrets.token_hex(16)
-            user.auth_token = token
-            user.save()
-            return token
-        return None
+        # Comprova la contrasenya i retorna un token (el mateix si encara és vàlid)
+        return tokens.iniciar_sessio(username, password)
 
 # Autenticació per Token Bearer
 class AuthBearer(HttpBearer):
     def authenticate(self, request, token):
-        try:
-            user = Usuari.objects.get(auth_token=token)
-            return user
-        except Usuari.DoesNotExist:
-            return None
+        return tokens.usuari_per_token(token)
 
 # Endpoint per obtenir un token
 @api.get("/token", auth=BasicAuth())
@@ -336,32 +377,51 @@ def obtenir_token(request):
     return {"token": request.auth}
 
 
+def _token_bearer(request):
+    autoritzacio = request.headers.get("Authorization", "")
+    tipus, _, token = autoritzacio.partition(" ")
+    return token.strip() if tipus.lower() == "bearer" else ""
+
+
+# Canvia un token vàlid (o caducat fa poc) per un de nou
+@api.post("/token/refresh", response={200: dict, 401: dict})
+def refrescar_token(request):
+    token = tokens.refrescar(_token_bearer(request))
+    if not token:
+        return 401, {"error": "Token no válido o caducado"}
+    return 200, {"token": token}
+
+
+# Tanca la sessió: el token deixa de ser vàlid
+@api.post("/logout", response={204: None}, auth=AuthBearer())
+def tancar_sessio(request):
+    tokens.revocar(_token_bearer(request))
+    return 204, None
+
+
 # Endpoint per obtenir dades d'un usuari a partir del seu token
 @api.get("/usuari", auth=AuthBearer())
 @api.get("/usuari/", auth=AuthBearer())
 def obtenir_usuari(request):    
-    user = request.auth
+    # Instantània en memòria: sense consultes mentre no canviï l'usuari
+    user = permisos.instantania(request.auth)
     if user:
-        user_permissions = [{"id": perm.id, "name": perm.name} for perm in user.user_permissions.all()]
-        
-        imatge_url = user.imatge.url if user.imatge else None 
-        
         return {
-            "id": user.id if user else None,
-            "username": user.username if user else None,
-            "first_name": user.first_name if user else None,
-            "last_name": user.last_name if user else None,
-            "email": user.email if user else None,
-            "telefon": user.telefon if user else None,
-            "is_staff": user.is_staff if user else None,
-            "is_superuser": user.is_superuser if user else None,
-            "user_permissions": user_permissions if user else None,
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "email": user.email,
+            "telefon": user.telefon,
+            "is_staff": user.is_staff,
+            "is_superuser": user.is_superuser,
+            "user_permissions": user.permisos_directes,
             "centre": {
-                "id": user.centre.id,
-                "nom": user.centre.nom
-            } if user.centre else None,
-            "grup": user.grup.nom if user.grup else None,
-            "imatge": imatge_url,
+                "id": user.centre_id,
+                "nom": user.centre_nom
+            } if user.centre_id else None,
+            "grup": user.grup,
+            "imatge": user.imatge,
         }
     
     return {"error": "Usuari no trobat"}, 404
@@ -436,7 +496,6 @@ def get_historial_prestecs_usuari(request, usuari_id: int):
                     continue
 
                 # Determinar el tipus del catàleg
-                tipus = "Indefinit"
                 tipus_map = {
                     "cd": "CD",
                     "dvd": "DVD", 
@@ -445,11 +504,7 @@ def get_historial_prestecs_usuari(request, usuari_id: int):
                     "revista": "Revista",
                     "dispositiu": "Dispositiu"
                 }
-                
-                for t in tipus_map.keys():
-                    if hasattr(cataleg, t):
-                        tipus = tipus_map[t]
-                        break
+                tipus = tipus_map.get(cataleg.tipus, "Indefinit")
 
                 prestec_dict = {
                     "prestec_id": prestec.id,
@@ -500,12 +555,12 @@ class LlibreIn(Schema):
     editorial: str
 
 
-@api.get("/llibres", response=List[LlibreOut])
-@api.get("/llibres/", response=List[LlibreOut])
-#@api.get("/llibres/", response=List[LlibreOut], auth=AuthBearer())
-def get_llibres(request):
-    qs = Llibre.objects.all()
-    return qs
+@api.get("/llibres", response=Pagina[LlibreOut])
+@api.get("/llibres/", response=Pagina[LlibreOut])
+#@api.get("/llibres/", response=Pagina[LlibreOut], auth=AuthBearer())
+def get_llibres(request, cursor: Optional[str] = None, limit: Optional[int] = None):
+    llibres, next_cursor = paginar(Llibre.objects.all(), cursor, limit)
+    return {"items": llibres, "next": next_cursor}
 
 @api.post("/llibres/")
 def post_llibres(request, payload: LlibreIn):
@@ -515,25 +570,20 @@ def post_llibres(request, payload: LlibreIn):
         "titol": llibre.titol
     }
 
-@api.get("/exemplars", response=List[ExemplarOut])
-@api.get("/exemplars/", response=List[ExemplarOut])
-def get_exemplars(request):
+@api.get("/exemplars", response=Pagina[ExemplarOut])
+@api.get("/exemplars/", response=Pagina[ExemplarOut])
+def get_exemplars(request, cursor: Optional[str] = None, limit: Optional[int] = None):
     # carreguem objectes amb els proxy models relacionats exactes
-    exemplars = Exemplar.objects.select_related(
-        "cataleg__llibre",
-        "cataleg__revista",
-        "cataleg__cd",
-        "cataleg__dvd",
-        "cataleg__br",
-        "cataleg__dispositiu",
-    ).all()
+    # només LlibreOut necessita la subclasse; la resta surt del Cataleg
+    exemplars = Exemplar.objects.select_related("cataleg__llibre").all()
+    exemplars, next_cursor = paginar(exemplars, cursor, limit, camp="registre")
     result = []
 
     for exemplar in exemplars:
         cataleg_instance = exemplar.cataleg
 
         # Determinar el tipus de l'objecte Cataleg
-        if hasattr(cataleg_instance, "llibre"):
+        if cataleg_instance.tipus == "llibre":
             cataleg_schema = LlibreOut.from_orm(cataleg_instance.llibre)
             tipus = "llibre"
         #elif hasattr(cataleg_instance, "dispositiu"):
@@ -555,7 +605,7 @@ def get_exemplars(request):
             )
         )
 
-    return result
+    return {"items": result, "next": next_cursor}
 
 # Schema for exemplars by catalog item
 class ExemplarItemOut(Schema):
@@ -647,79 +697,90 @@ def get_exemplar_by_id(request, exemplar_id: int):
         return {"error": "Ejemplar no encontrado"}, 404
 
 # Get available users for loans
-@api.get("/usuarios-disponibles/", response=List[UserOut], auth=AuthBearer())
-def get_available_users(request):
-    user = request.auth
+@api.get("/usuarios-disponibles/", response=Pagina[UserOut], auth=AuthBearer())
+def get_available_users(request, cursor: Optional[str] = None, limit: Optional[int] = None):
+    user = permisos.instantania(request.auth)
     if not user or not user.is_staff:
         return {"error": "No autorizado"}, 401
     
-    # Obtener todos los usuarios activos, sin filtrar por centro
-    users = Usuari.objects.filter(is_active=True)
+    # Obtener todos los usuarios activos, sin filtrar por centro.
+    # No incluir al propio bibliotecario ni a otros usuarios staff
+    users = Usuari.objects.filter(is_active=True, is_staff=False).exclude(id=user.id).select_related('centre')
+    users, next_cursor = paginar(users, cursor, limit)
     
     result = []
     for u in users:
-        # No incluir al propio bibliotecario ni a otros usuarios staff
-        if u.id != user.id and not u.is_staff:
-            result.append({
-                "id": u.id,
-                "username": u.username,
-                "first_name": u.first_name,
-                "last_name": u.last_name,
-                "email": u.email,
-                "centre": u.centre.nom if u.centre else None
-            })
+        result.append({
+            "id": u.id,
+            "username": u.username,
+            "first_name": u.first_name,
+            "last_name": u.last_name,
+            "email": u.email,
+            "centre": u.centre.nom if u.centre else None
+        })
     
-    return result
+    return {"items": result, "next": next_cursor}
 
 # Create a new loan
-@api.post("/prestecs/crear/", response=LoanCreateOut, auth=AuthBearer())
+@api.post("/prestecs/crear/", response={200: LoanCreateOut, 400: dict, 401: dict, 404: dict, 409: dict, 500: dict}, auth=AuthBearer())
 def create_loan(request, payload: LoanCreateIn):
-    bibliotecari = request.auth
+    bibliotecari = permisos.instantania(request.auth)
     if not bibliotecari or not bibliotecari.is_staff:
-        return {"error": "No autorizado"}, 401
+        return 401, {"error": "No autorizado"}
     
     try:
         # Obtener el usuario y ejemplar
-        usuario = Usuari.objects.get(id=payload.usuari_id)
-        exemplar = Exemplar.objects.get(id=payload.exemplar_id)
+        usuario = Usuari.objects.select_related('centre').get(id=payload.usuari_id)
+        exemplar = Exemplar.objects.select_related('centre').get(id=payload.exemplar_id)
         
         # Verificar que el ejemplar está disponible
         if exemplar.exclos_prestec:
-            return {"error": "El ejemplar está excluido de préstamo"}, 400
+            return 400, {"error": "El ejemplar está excluido de préstamo"}
         if exemplar.baixa:
-            return {"error": "El ejemplar está dado de baja"}, 400
+            return 400, {"error": "El ejemplar está dado de baja"}
         
         # Reforzar validación de centro: un bibliotecario solo puede prestar ejemplares de su centro
-        if not bibliotecari.centre:
-            return {"error": "El bibliotecario no tiene un centro asignado"}, 400
+        if not bibliotecari.centre_id:
+            return 400, {"error": "El bibliotecario no tiene un centro asignado"}
             
         if not exemplar.centre:
-            return {"error": "El ejemplar no tiene un centro asignado"}, 400
+            return 400, {"error": "El ejemplar no tiene un centro asignado"}
             
         # Comparar los IDs de los centros, no las instancias
-        if bibliotecari.centre.id != exemplar.centre.id and not bibliotecari.is_superuser:
-            return {"error": f"El ejemplar pertenece al centre '{exemplar.centre.nom}' y tú perteneces a '{bibliotecari.centre.nom}'"}, 400
-        
-        # Crear el préstamo
-        prestec = Prestec.objects.create(
-            usuari=usuario,
-            exemplar=exemplar,
-            anotacions=payload.anotacions
-        )
-        
-        # Marcar el ejemplar como excluido de préstamo
-        exemplar.exclos_prestec = True
-        exemplar.save()
+        if bibliotecari.centre_id != exemplar.centre_id and not bibliotecari.is_superuser:
+            return 400, {"error": f"El ejemplar pertenece al centre '{exemplar.centre.nom}' y tú perteneces a '{bibliotecari.centre_nom}'"}
         
-        # Registrar en el log
-        Log.objects.create(
-            usuari=bibliotecari.username,
-            accio=f"Préstamo creado: ID {prestec.id} - Ejemplar {exemplar.registre} a {usuario.username}",
-            tipus="INFO"
-        )
+        with transaction.atomic():
+            # Marcar el ejemplar como excluido de préstamo solo si aún está
+            # disponible y sin ningún préstamo abierto (p. ej. creado desde el
+            # admin): el UPDATE bloquea la fila y, si dos bibliotecarios
+            # prestan el mismo ejemplar a la vez, solo uno lo consigue
+            agafat = Exemplar.objects.filter(
+                ~circulacio.prestec_obert(), id=exemplar.id, exclos_prestec=False, baixa=False
+            ).update(exclos_prestec=True)
+            if not agafat:
+                return 409, {"error": "El ejemplar acaba de ser prestado o dado de baja"}
+            exemplar.exclos_prestec = True
+            disponibilitat.Canvis().moure(
+                exemplar.cataleg_id, exemplar.centre_id, "disponible", "exclos_prestec"
+            ).aplicar()
+            
+            # Crear el préstamo
+            prestec = Prestec.objects.create(
+                usuari=usuario,
+                exemplar=exemplar,
+                anotacions=payload.anotacions
+            )
+            
+            # Registrar en el log
+            Log.objects.create(
+                usuari=bibliotecari.username,
+                accio=f"Préstamo creado: ID {prestec.id} - Ejemplar {exemplar.registre} a {usuario.username}"[:100],
+                tipus="INFO"
+            )
         
         # Devolver resultado
-        return {
+        return 200, {
             "id": prestec.id,
             "usuari": {
                 "id": usuario.id,
@@ -743,17 +804,79 @@ def create_loan(request, payload: LoanCreateIn):
         }
         
     except Usuari.DoesNotExist:
-        return {"error": "Usuario no encontrado"}, 404
+        return 404, {"error": "Usuario no encontrado"}
     except Exemplar.DoesNotExist:
-        return {"error": "Ejemplar no encontrado"}, 404
+        return 404, {"error": "Ejemplar no encontrado"}
     except Exception as e:
         # Registrar error en el log
         Log.objects.create(
             usuari=bibliotecari.username,
-            accio=f"Error al crear préstamo: {str(e)}",
+            accio=f"Error al crear préstamo: {str(e)}"[:100],
             tipus="ERROR"
         )
-        return {"error": f"Error al crear el préstamo: {str(e)}"}, 500
+        return 500, {"error": f"Error al crear el préstamo: {str(e)}"}
+
+# Préstamos y devoluciones en lote (taulell de circulació)
+class PrestecsLotIn(Schema):
+    usuari_id: int
+    registres: List[str] = Field(..., min_length=1, max_length=circulacio.MAX_PER_LOT)
+    anotacions: Optional[str] = None
+
+class RetornsLotIn(Schema):
+    registres: List[str] = Field(..., min_length=1, max_length=circulacio.MAX_PER_LOT)
+
+class ResultatLotOut(Schema):
+    registre: str
+    ok: bool
+    prestec_id: Optional[int] = None
+    error: Optional[str] = None
+
+class LotOut(Schema):
+    correctes: int
+    errors: int
+    resultats: List[ResultatLotOut]
+
+def _lot_out(resultats):
+    correctes = sum(1 for r in resultats if r["ok"])
+    return {"correctes": correctes, "errors": len(resultats) - correctes, "resultats": resultats}
+
+@api.post("/prestecs/lot", response={200: LotOut, 400: dict, 401: dict, 404: dict, 409: dict}, auth=AuthBearer())
+def crear_prestecs_lot(request, payload: PrestecsLotIn):
+    """
+    Presta varios ejemplares (por número de registro) a un usuario de una vez.
+    Devuelve el resultado de cada registro, en el mismo orden.
+    """
+    bibliotecari = permisos.instantania(request.auth)
+    if not bibliotecari or not bibliotecari.is_staff:
+        return 401, {"error": "No autorizado"}
+    if not bibliotecari.centre_id:
+        return 400, {"error": "El bibliotecario no tiene un centro asignado"}
+    try:
+        usuario = Usuari.objects.get(id=payload.usuari_id)
+    except Usuari.DoesNotExist:
+        return 404, {"error": "Usuario no encontrado"}
+    try:
+        resultats = circulacio.prestar(bibliotecari, usuario, payload.registres, payload.anotacions)
+    except circulacio.Conflicte:
+        return 409, {"error": "Otro mostrador está modificando estos ejemplares, vuelve a intentarlo"}
+    return 200, _lot_out(resultats)
+
+@api.post("/prestecs/retorn", response={200: LotOut, 400: dict, 401: dict, 409: dict}, auth=AuthBearer())
+def retornar_prestecs_lot(request, payload: RetornsLotIn):
+    """
+    Devuelve los préstamos activos de varios ejemplares (por número de registro).
+    Devuelve el resultado de cada registro, en el mismo orden.
+    """
+    bibliotecari = permisos.instantania(request.auth)
+    if not bibliotecari or not bibliotecari.is_staff:
+        return 401, {"error": "No autorizado"}
+    if not bibliotecari.centre_id:
+        return 400, {"error": "El bibliotecario no tiene un centro asignado"}
+    try:
+        resultats = circulacio.retornar(bibliotecari, payload.registres)
+    except circulacio.Conflicte:
+        return 409, {"error": "Otro mostrador está modificando estos ejemplares, vuelve a intentarlo"}
+    return 200, _lot_out(resultats)
 
 # Nuevos endpoints para autocompletar autores y editoriales
 @api.get("/autores/search/")
@@ -778,34 +901,25 @@ def buscar_autores(request, q: str):
     autores = list(autores_dict.values())
     
     # Si no hay suficientes resultados (menos de 5), buscamos en Google Books
+    # (con caché, timeout y circuit breaker, ver google_books.py)
     if len(autores) < 5:
-        try:
-            import requests
-            response = requests.get(f"https://www.googleapis.com/books/v1/volumes?q=inauthor:{q}&maxResults=10")
-            if response.status_code == 200:
-                data = response.json()
-                if 'items' in data:
-                    # Lista temporal para ordenar los resultados de Google Books
-                    google_autores_start = []
-                    google_autores_contain = []
-                    
-                    for item in data['items']:
-                        if 'volumeInfo' in item and 'authors' in item['volumeInfo']:
-                            for autor in item['volumeInfo']['authors']:
-                                if autor and autor.lower() not in autores_dict:
-                                    # Verificamos si el autor comienza con el texto buscado
-                                    if autor.lower().startswith(q.lower()):
-                                        google_autores_start.append(autor)
-                                    else:
-                                        google_autores_contain.append(autor)
-                                    # Agregamos al diccionario para evitar duplicados en siguientes iteraciones
-                                    autores_dict[autor.lower()] = autor
-                    
-                    # Añadimos los autores de Google Books a nuestra lista, primero los que empiezan por q
-                    autores.extend(google_autores_start)
-                    autores.extend(google_autores_contain)
-        except Exception as e:
-            print(f"Error al buscar en Google Books: {e}")
+        # Lista temporal para ordenar los resultados de Google Books
+        google_autores_start = []
+        google_autores_contain = []
+
+        for autor in google_books.autors(q):
+            if autor.lower() not in autores_dict:
+                # Verificamos si el autor comienza con el texto buscado
+                if autor.lower().startswith(q.lower()):
+                    google_autores_start.append(autor)
+                else:
+                    google_autores_contain.append(autor)
+                # Agregamos al diccionario para evitar duplicados en siguientes iteraciones
+                autores_dict[autor.lower()] = autor
+
+        # Añadimos los autores de Google Books a nuestra lista, primero los que empiezan por q
+        autores.extend(google_autores_start)
+        autores.extend(google_autores_contain)
     
     return {"resultados": autores[:10]}  # Devolvemos máximo 10 resultados
 
@@ -830,34 +944,25 @@ def buscar_editoriales(request, q: str):
     editoriales = list(editoriales_dict.values())
     
     # Si no hay suficientes resultados (menos de 5), buscamos en Google Books
+    # (con caché, timeout y circuit breaker, ver google_books.py)
     if len(editoriales) < 5:
-        try:
-            import requests
-            response = requests.get(f"https://www.googleapis.com/books/v1/volumes?q=inpublisher:{q}&maxResults=10")
-            if response.status_code == 200:
-                data = response.json()
-                if 'items' in data:
-                    # Lista temporal para ordenar los resultados de Google Books
-                    google_editoriales_start = []
-                    google_editoriales_contain = []
-                    
-                    for item in data['items']:
-                        if 'volumeInfo' in item and 'publisher' in item['volumeInfo']:
-                            publisher = item['volumeInfo']['publisher']
-                            if publisher and publisher.lower() not in editoriales_dict:
-                                # Verificamos si la editorial comienza con el texto buscado
-                                if publisher.lower().startswith(q.lower()):
-                                    google_editoriales_start.append(publisher)
-                                else:
-                                    google_editoriales_contain.append(publisher)
-                                # Agregamos al diccionario para evitar duplicados en siguientes iteraciones
-                                editoriales_dict[publisher.lower()] = publisher
-                    
-                    # Añadimos las editoriales de Google Books a nuestra lista, manteniendo prioridad
-                    editoriales.extend(google_editoriales_start)
-                    editoriales.extend(google_editoriales_contain)
-        except Exception as e:
-            print(f"Error al buscar en Google Books: {e}")
+        # Lista temporal para ordenar los resultados de Google Books
+        google_editoriales_start = []
+        google_editoriales_contain = []
+
+        for publisher in google_books.editorials(q):
+            if publisher.lower() not in editoriales_dict:
+                # Verificamos si la editorial comienza con el texto buscado
+                if publisher.lower().startswith(q.lower()):
+                    google_editoriales_start.append(publisher)
+                else:
+                    google_editoriales_contain.append(publisher)
+                # Agregamos al diccionario para evitar duplicados en siguientes iteraciones
+                editoriales_dict[publisher.lower()] = publisher
+
+        # Añadimos las editoriales de Google Books a nuestra lista, manteniendo prioridad
+        editoriales.extend(google_editoriales_start)
+        editoriales.extend(google_editoriales_contain)
     
     return {"resultados": editoriales[:10]}  # Devolvemos máximo 10 resultados
 
@@ -874,6 +979,10 @@ def get_exemplar_suggestions(request, q: str = Query(...)):
     if not q:
         return []
 
+    # Índice de prefijos en memoria, sin consultar la base de datos
+    if suggeriments.index.disponible():
+        return suggeriments.index.suggeriments_exemplars(q)
+
     # Eliminar signos de puntuación de la consulta
     normalized_query = re.sub(r'[^\w\s]', '', q).lower()
 
@@ -881,7 +990,7 @@ def get_exemplar_suggestions(request, q: str = Query(...)):
         Q(cataleg__titol__icontains=normalized_query) |
         Q(cataleg__autor__icontains=normalized_query) |
         Q(cataleg__llibre__editorial__icontains=normalized_query)
-    ).select_related("cataleg")[:50]  # Limitar a 50 resultados para optimización
+    ).select_related("cataleg__llibre")[:50]  # Limitar a 50 resultados para optimización
 
     results = []
     seen_results = set()  # Usar un conjunto para garantizar unicidad
@@ -907,7 +1016,7 @@ def get_exemplar_suggestions(request, q: str = Query(...)):
                 results.append(result)
                 seen_results.add(result["resultado"])
 
-        if hasattr(exemplar.cataleg, "llibre") and exemplar.cataleg.llibre.editorial:
+        if exemplar.cataleg.tipus == "llibre" and exemplar.cataleg.llibre.editorial:
             editorial_normalized = re.sub(r'[^\w\s]', '', exemplar.cataleg.llibre.editorial).lower()
             if normalized_query in editorial_normalized:
                 result = {
@@ -923,82 +1032,189 @@ def get_exemplar_suggestions(request, q: str = Query(...)):
 
 class GenerateLabelsIn(Schema):
     exemplar_ids: List[int]
+    renderer: Literal["xhtml2pdf", "reportlab"] = "xhtml2pdf"
+
+def _es_bibliotecari(request):
+    bibliotecari = permisos.instantania(request.auth)
+    return bool(bibliotecari and bibliotecari.is_staff)
 
-@api.post("/exemplars/generate-labels")
+@api.post("/exemplars/generate-labels", response={401: dict, 500: dict}, auth=AuthBearer())
 def generate_labels(request, payload: GenerateLabelsIn):
     """
     Genera etiquetas en formato PDF para los ejemplares seleccionados.
     """
+    if not _es_bibliotecari(request):
+        return 401, {"error": "No autorizado"}
     try:
-        # Obtener los ejemplares seleccionados
-        exemplars_data = []
-
-        for exemplar_id in payload.exemplar_ids:
-            try:
-                exemplar = Exemplar.objects.select_related('cataleg').get(id=exemplar_id)
-                
-                # Generar código de barras como imagen base64
-                barcode_buffer = BytesIO()
-                writer = ImageWriter()
-                Code128(str(exemplar.registre), writer=writer).write(barcode_buffer, text='')
-                barcode_buffer.seek(0)  # Rebobinar el buffer
-                barcode_base64 = base64.b64encode(barcode_buffer.getvalue()).decode('utf-8')
-                
-                # Para cada ejemplar, crear dos objetos de etiqueta: uno para el código de barras y otro para el CDU
-                exemplars_data.append({
-                    'id': exemplar.id,
-                    'centre_nom' : exemplar.centre,
-                    'registre': exemplar.registre,
-                    'barcode_img': barcode_base64,
-                    'type': 'barcode',  # Marcador para identificar el tipo de etiqueta
-                    'CDU': None  
-                })
-                
-                exemplars_data.append({
-                    'id': exemplar.id,
-                    'centre_nom' : None,
-                    'registre': None,
-                    'barcode_img': None,  
-                    'type': 'cdu',  # Marcador para identificar el tipo de etiqueta
-                    'CDU': exemplar.cataleg.CDU if exemplar.cataleg and hasattr(exemplar.cataleg, 'CDU') else None
-                })
-                
-            except Exemplar.DoesNotExist:
-                continue
-        
-        # Organizar ejemplares en filas y columnas (4 columnas x 17 filas = 68 etiquetas por página)
-        rows = []
-        total_cells = 4 * 17  # 68 celdas totales
-        
-        # Rellenar la lista con None para tener un total de celdas múltiplo de 4
-        while len(exemplars_data) < total_cells:
-            exemplars_data.append(None)
-            
-        # Crear las filas (17) con 4 columnas cada una
-        for i in range(0, len(exemplars_data), 4):
-            row = exemplars_data[i:i+4]
-            # Asegurarse de que cada fila tenga exactamente 4 elementos
-            while len(row) < 4:
-                row.append(None)
-            rows.append(row)
-        
-        # Renderizar la plantilla HTML con los datos de los ejemplares
-        html = render_to_string('etiquetas.html', {
-            'rows': rows,
-        })
-        
-        # Convertir HTML a PDF
-        result = BytesIO()
-        pdf = pisa.pisaDocument(BytesIO(html.encode("UTF-8")), result)
-        
-        if not pdf.err:
-            # Devolver el PDF como respuesta
-            response = HttpResponse(result.getvalue(), content_type='application/pdf')
-            response['Content-Disposition'] = 'attachment; filename="etiquetas.pdf"'
-            return response
-        else:
-            return {"error": "Error al generar el PDF"}, 500
-            
+        return etiquetes.resposta_pdf(payload.exemplar_ids, payload.renderer)
+    except etiquetes.ErrorEtiquetes as e:
+        return 500, {"error": str(e)}
     except Exception as e:
         print(f"Error generando etiquetas: {e}")  # Añadir log para depuración
-        return {"error": str(e)}, 500
\ No newline at end of file
+        return 500, {"error": str(e)}
+
+
+class TreballEtiquetesOut(Schema):
+    id: int
+    estat: str
+    pagines_fetes: int
+    pagines_totals: int
+    error: Optional[str] = None
+    descarrega: Optional[str] = None
+
+
+def serialitzar_treball(treball):
+    return {
+        "id": treball.id,
+        "estat": treball.estat,
+        "pagines_fetes": treball.pagines_fetes,
+        "pagines_totals": treball.pagines_totals,
+        "error": treball.error,
+        "descarrega": f"/api/exemplars/generate-labels/jobs/{treball.id}/pdf" if treball.estat == "acabat" else None,
+    }
+
+@api.post("/exemplars/generate-labels/jobs", response={202: TreballEtiquetesOut, 401: dict, 500: dict}, auth=AuthBearer())
+def crear_treball_etiquetes(request, payload: GenerateLabelsIn):
+    """
+    Encola la generación del PDF de etiquetas y devuelve el trabajo al momento.
+    Si ya hay un trabajo con los mismos ejemplares se reutiliza.
+    """
+    if not _es_bibliotecari(request):
+        return 401, {"error": "No autorizado"}
+    try:
+        treball = treballs.crear(payload.exemplar_ids, payload.renderer)
+    except etiquetes.ErrorEtiquetes as e:
+        return 500, {"error": str(e)}
+    return 202, serialitzar_treball(treball)
+
+@api.get("/exemplars/generate-labels/jobs/{treball_id}", response={200: TreballEtiquetesOut, 401: dict, 404: dict}, auth=AuthBearer())
+def estat_treball_etiquetes(request, treball_id: int):
+    """
+    Estado y progreso (páginas generadas) de un trabajo de etiquetas.
+    """
+    if not _es_bibliotecari(request):
+        return 401, {"error": "No autorizado"}
+    try:
+        treball = TreballEtiquetes.objects.get(id=treball_id)
+    except TreballEtiquetes.DoesNotExist:
+        return 404, {"error": "Treball no trobat"}
+    return 200, serialitzar_treball(treball)
+
+@api.get("/exemplars/generate-labels/jobs/{treball_id}/pdf", response={401: dict, 404: dict, 409: dict, 410: dict}, auth=AuthBearer())
+def descarregar_treball_etiquetes(request, treball_id: int):
+    """
+    Descarga el PDF de un trabajo de etiquetas acabado.
+    """
+    if not _es_bibliotecari(request):
+        return 401, {"error": "No autorizado"}
+    try:
+        treball = TreballEtiquetes.objects.get(id=treball_id)
+    except TreballEtiquetes.DoesNotExist:
+        return 404, {"error": "Treball no trobat"}
+    if treball.estat != "acabat":
+        return 409, {"error": f"El treball està en estat '{treball.estat}'"}
+    try:
+        fitxer = open(treball.fitxer, "rb")
+    except (OSError, TypeError):
+        return 410, {"error": "El PDF ja no existeix, torna a crear el treball"}
+    return FileResponse(fitxer, content_type="application/pdf", as_attachment=True, filename="etiquetas.pdf")
+
+
+MAX_EXEMPLARS_EN_BLOC = 1000
+
+class ExemplarsEnBlocIn(Schema):
+    cataleg_id: int
+    quantitat: int = Field(..., ge=1, le=MAX_EXEMPLARS_EN_BLOC)
+    centre_id: Optional[int] = None  # Por defecto, el centro del bibliotecario
+    exclos_prestec: bool = False
+    etiquetes: bool = False  # Encolar también el PDF de etiquetas
+    renderer: Literal["xhtml2pdf", "reportlab"] = "xhtml2pdf"
+
+class ExemplarEnBlocOut(Schema):
+    id: int
+    registre: str
+
+class ExemplarsEnBlocOut(Schema):
+    exemplars: List[ExemplarEnBlocOut]
+    treball: Optional[TreballEtiquetesOut] = None
+
+@api.post("/exemplars/bulk", response={201: ExemplarsEnBlocOut, 400: dict, 401: dict, 404: dict}, auth=AuthBearer())
+def crear_exemplars_en_bloc(request, payload: ExemplarsEnBlocIn):
+    """
+    Crea varios ejemplares de un elemento del catálogo de una vez, con números
+    de registro consecutivos, y opcionalmente encola sus etiquetas.
+    """
+    bibliotecari = permisos.instantania(request.auth)
+    if not bibliotecari or not bibliotecari.is_staff:
+        return 401, {"error": "No autorizado"}
+
+    try:
+        cataleg = Cataleg.objects.get(id=payload.cataleg_id)
+    except Cataleg.DoesNotExist:
+        return 404, {"error": "Elemento del catálogo no encontrado"}
+
+    centre_id = payload.centre_id or bibliotecari.centre_id
+    if not centre_id:
+        return 400, {"error": "El bibliotecario no tiene un centro asignado"}
+    # Un bibliotecario solo puede dar de alta ejemplares en su centro
+    if centre_id != bibliotecari.centre_id and not bibliotecari.is_superuser:
+        return 400, {"error": "Solo puedes crear ejemplares de tu centro"}
+    try:
+        centre = Centre.objects.get(id=centre_id)
+    except Centre.DoesNotExist:
+        return 404, {"error": "Centro no encontrado"}
+
+    exemplars = Exemplar.objects.crear_en_bloc(
+        cataleg, centre, payload.quantitat, exclos_prestec=payload.exclos_prestec
+    )
+
+    Log.objects.create(
+        usuari=bibliotecari.username,
+        accio=f"Ejemplares creados: {exemplars[0].registre} - {exemplars[-1].registre} "
+              f"({len(exemplars)}) de '{cataleg.titol}'"[:100],
+        tipus="INFO"
+    )
+
+    treball = None
+    if payload.etiquetes:
+        treball = serialitzar_treball(treballs.crear([e.id for e in exemplars], payload.renderer))
+
+    return 201, {
+        "exemplars": [{"id": e.id, "registre": e.registre} for e in exemplars],
+        "treball": treball,
+    }
+
+
+class EstadistiquesRutaOut(Schema):
+    ruta: str
+    peticions: int
+    errors: int
+    lentes: int
+    p50_ms: float
+    p95_ms: float
+    max_ms: float
+    mitjana_db_ms: float
+    mitjana_python_ms: float
+    mitjana_consultes: float
+    max_consultes: int
+
+class InstrumentacioOut(Schema):
+    activa: bool
+    llindar_ms: int
+    rutes: List[EstadistiquesRutaOut]
+
+@api.get("/instrumentacio/rutes", response={200: InstrumentacioOut, 401: dict}, auth=AuthBearer())
+def estadistiques_rutes(request):
+    """
+    Estadísticas por ruta de este proceso (peticiones, percentiles, tiempo de
+    base de datos y de Python, consultas), primero las que más tiempo ocupan.
+    Solo para bibliotecarios; vacío si INSTRUMENTACIO no está activa.
+    """
+    bibliotecari = permisos.instantania(request.auth)
+    if not bibliotecari or not bibliotecari.is_staff:
+        return 401, {"error": "No autorizado"}
+    return 200, {
+        "activa": instrumentacio.activa(),
+        "llindar_ms": instrumentacio.llindar_ms(),
+        "rutes": instrumentacio.estadistiques.resum(),
+    }
@@ -63,4 +63,7 @@ class BibliotecaConfig(AppConfig):
     name = 'biblioteca'
 
     def ready(self):
-        post_migrate.connect(create_bibliotecaris_group, sender=self)
\ No newline at end of file
+        post_migrate.connect(create_bibliotecaris_group, sender=self)
+        # Senyals que mantenen els índexs de cerca i suggeriments sincronitzats
+        # i que buiden les memòries cau de tokens i permisos
+        from . import cerca, disponibilitat, permisos, suggeriments, tokens  # noqa: F401
@@ -0,0 +1,363 @@
+"""
+Benchmark de l'API: consultes, latència i memòria de cada endpoint.
+
+- `./manage.py benchmark_api` crea una base de dades de proves, hi carrega un
+  conjunt de dades fix amb seed_biblioteca (ESCALA, LLAVOR) i crida cada
+  endpoint de `api` dins del procés amb el client de proves de Django.
+- Cada crida es fa dins d'una transacció que es desfà: totes les repeticions
+  veuen les mateixes dades i el recompte de consultes és determinista (no es
+  compten les ordres de transacció, BEGIN, SAVEPOINT...).
+- De cada endpoint es desa el nombre de consultes, la latència p50/p95 i el
+  pic de memòria Python (tracemalloc) i es compara amb BASELINE, el fitxer
+  desat al repositori. Més consultes que la referència és sempre una
+  regressió; la latència i la memòria ho són si la superen en més d'un marge.
+- Cada endpoint nou de l'API ha de tenir el seu cas a CASOS (ho comprova
+  biblioteca/tests.py).
+"""
+import base64
+import json
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stderr
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection, reset_queries, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_databases, teardown_databases
+
+BASELINE = os.path.join(os.path.dirname(__file__), "benchmark_api.json")
+ESCALA = "small"
+LLAVOR = 1
+CONTRASENYA = "benchmark"
+# Exemplars per als préstecs, retorns i etiquetes en lot
+MIDA_LOT = 10
+# Segons màxims per renderitzar el treball d'etiquetes de prova
+ESPERA_TREBALL = 60
+
+
+class BackendSenseXarxa:
+    """Google Books sense sortir a internet: es mesura només el codi propi."""
+
+    def get(self, url, params, timeout):
+        return {"items": []}
+
+
+def operacions():
+    """(mètode, ruta) de cada endpoint de l'API; les rutes alternatives d'una mateixa vista hi surten una vegada."""
+    from .api import api
+
+    vistes, resultat = set(), []
+    for _, router in api._routers:
+        for ruta, path_view in router.path_operations.items():
+            for operacio in path_view.operations:
+                for metode in operacio.methods:
+                    if (metode, operacio.view_func) not in vistes:
+                        vistes.add((metode, operacio.view_func))
+                        resultat.append((metode, ruta))
+    return resultat
+
+
+def _bearer(token):
+    return {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+
+def _basic(username):
+    credencials = base64.b64encode(f"{username}:{CONTRASENYA}".encode()).decode()
+    return {"HTTP_AUTHORIZATION": f"Basic {credencials}"}
+
+
+# Cada cas rep el context de dades i retorna els arguments de la petició
+# (es crida a cada repetició: els tokens revocats en una no valen per a la següent)
+CASOS = {
+    ("GET", "/exemplars/search/"): lambda c: dict(url=f"/api/exemplars/search/?q={c['paraula']}"),
+    ("GET", "/cataleg/search/suggestions/"): lambda c: dict(url=f"/api/cataleg/search/suggestions/?q={c['paraula'][:3]}"),
+    ("GET", "/cataleg/search/"): lambda c: dict(url=f"/api/cataleg/search/?q={c['paraula']}"),
+    ("GET", "/token/"): lambda c: dict(url="/api/token/", **_basic(c["lector"].username)),
+    ("POST", "/token/refresh"): lambda c: dict(url="/api/token/refresh", **_bearer(c["token_nou"]())),
+    ("POST", "/logout"): lambda c: dict(url="/api/logout", **_bearer(c["token_nou"]()), estat=204),
+    ("GET", "/usuari/"): lambda c: dict(url="/api/usuari/", **_bearer(c["token_lector"])),
+    ("POST", "/editUsuari/"): lambda c: dict(
+        url="/api/editUsuari/", multipart={"payload": json.dumps({
+            "id": c["lector"].pk, "email": None, "first_name": "Benchmark", "last_name": None, "telefon": None,
+        })},
+    ),
+    ("GET", "/usuari/historial_prestecs"): lambda c: dict(
+        url=f"/api/usuari/historial_prestecs?usuari_id={c['lector'].pk}", **_bearer(c["token_lector"]),
+    ),
+    ("GET", "/llibres/"): lambda c: dict(url="/api/llibres/"),
+    ("POST", "/llibres/"): lambda c: dict(url="/api/llibres/", json={"titol": "Benchmark", "editorial": "Benchmark"}),
+    ("GET", "/exemplars/"): lambda c: dict(url="/api/exemplars/"),
+    ("GET", "/exemplars/by-item/{item_id}"): lambda c: dict(url=f"/api/exemplars/by-item/{c['cataleg_id']}"),
+    ("GET", "/exemplars/{exemplar_id}/"): lambda c: dict(
+        url=f"/api/exemplars/{c['disponibles'][0].pk}/", **_bearer(c["token_bibliotecari"]),
+    ),
+    ("GET", "/usuarios-disponibles/"): lambda c: dict(url="/api/usuarios-disponibles/", **_bearer(c["token_bibliotecari"])),
+    ("POST", "/prestecs/crear/"): lambda c: dict(
+        url="/api/prestecs/crear/", json={"usuari_id": c["lector"].pk, "exemplar_id": c["disponibles"][0].pk},
+        **_bearer(c["token_bibliotecari"]),
+    ),
+    ("POST", "/prestecs/lot"): lambda c: dict(
+        url="/api/prestecs/lot", json={"usuari_id": c["lector"].pk, "registres": [e.registre for e in c["disponibles"]]},
+        **_bearer(c["token_bibliotecari"]),
+    ),
+    ("POST", "/prestecs/retorn"): lambda c: dict(
+        url="/api/prestecs/retorn", json={"registres": c["prestats"]}, **_bearer(c["token_bibliotecari"]),
+    ),
+    ("GET", "/autores/search/"): lambda c: dict(url=f"/api/autores/search/?q={c['autor']}"),
+    ("GET", "/editoriales/search/"): lambda c: dict(url=f"/api/editoriales/search/?q={c['editorial']}"),
+    ("GET", "/exemplars/search/suggestions/"): lambda c: dict(url=f"/api/exemplars/search/suggestions/?q={c['paraula'][:3]}"),
+    ("POST", "/exemplars/generate-labels"): lambda c: dict(
+        url="/api/exemplars/generate-labels", json={"exemplar_ids": c["ids_etiquetes"]}, **_bearer(c["token_bibliotecari"]),
+    ),
+    ("POST", "/exemplars/generate-labels/jobs"): lambda c: dict(
+        url="/api/exemplars/generate-labels/jobs", json={"exemplar_ids": c["ids_etiquetes"]},
+        **_bearer(c["token_bibliotecari"]), estat=202,
+    ),
+    ("GET", "/exemplars/generate-labels/jobs/{treball_id}"): lambda c: dict(
+        url=f"/api/exemplars/generate-labels/jobs/{c['treball_id']}", **_bearer(c["token_bibliotecari"]),
+    ),
+    ("GET", "/exemplars/generate-labels/jobs/{treball_id}/pdf"): lambda c: dict(
+        url=f"/api/exemplars/generate-labels/jobs/{c['treball_id']}/pdf", **_bearer(c["token_bibliotecari"]),
+    ),
+    ("POST", "/exemplars/bulk"): lambda c: dict(
+        url="/api/exemplars/bulk", json={"cataleg_id": c["cataleg_id"], "quantitat": MIDA_LOT},
+        **_bearer(c["token_bibliotecari"]), estat=201,
+    ),
+    ("GET", "/instrumentacio/rutes"): lambda c: dict(
+        url="/api/instrumentacio/rutes", **_bearer(c["token_bibliotecari"]),
+    ),
+}
+
+
+def _context():
+    """Usuaris, tokens i ids que fan servir els casos, sobre les dades de seed_biblioteca."""
+    from . import circulacio, permisos, suggeriments, tokens, treballs
+    from .models import Centre, Exemplar, Llibre, TreballEtiquetes, Usuari
+
+    centre = Centre.objects.order_by("id").first()
+    bibliotecari = Usuari.objects.create_user(
+        username="benchmark_bibliotecari", password=CONTRASENYA, is_staff=True, centre=centre,
+    )
+    lector = Usuari.objects.create_user(username="benchmark_lector", password=CONTRASENYA, centre=centre)
+    llibre = Llibre.objects.exclude(autor=None).exclude(editorial=None).order_by("id").first()
+    disponibles = list(
+        Exemplar.objects.filter(centre=centre, exclos_prestec=False, baixa=False).order_by("registre")[:MIDA_LOT]
+    )
+    # Préstecs actius del lector per a l'historial i els retorns
+    prestats = list(
+        Exemplar.objects.filter(centre=centre, exclos_prestec=False, baixa=False)
+        .exclude(pk__in=[e.pk for e in disponibles]).order_by("registre")[:MIDA_LOT]
+    )
+    circulacio.prestar(permisos.instantania(bibliotecari), lector, [e.registre for e in prestats])
+
+    # El PDF del treball ha d'estar fet abans de mesurar-ne la descàrrega
+    ids_etiquetes = [e.pk for e in disponibles]
+    treball = treballs.crear(ids_etiquetes)
+    limit = time.monotonic() + ESPERA_TREBALL
+    while TreballEtiquetes.objects.get(pk=treball.pk).estat != "acabat":
+        if time.monotonic() > limit:
+            raise RuntimeError(f"El treball d'etiquetes {treball.pk} no s'ha acabat")
+        time.sleep(0.1)
+
+    suggeriments.index.construir()
+    return {
+        "lector": lector,
+        "token_lector": tokens.emetre(lector),
+        "token_bibliotecari": tokens.emetre(bibliotecari),
+        "token_nou": lambda: tokens.emetre(lector),
+        "paraula": llibre.titol.split()[0],
+        "autor": llibre.autor[:4],
+        "editorial": llibre.editorial[:4],
+        "cataleg_id": llibre.pk,
+        "disponibles": disponibles,
+        "prestats": [e.registre for e in prestats],
+        "ids_etiquetes": ids_etiquetes,
+        "treball_id": treball.pk,
+    }
+
+
+def _percentil(valors, p):
+    ordenats = sorted(valors)
+    return ordenats[max(0, math.ceil(p / 100 * len(ordenats)) - 1)]
+
+
+def _cridar(client, metode, peticio):
+    peticio = dict(peticio)
+    url = peticio.pop("url")
+    peticio.pop("estat", None)
+    if "json" in peticio:
+        resposta = getattr(client, metode.lower())(url, peticio.pop("json"), content_type="application/json", **peticio)
+    elif "multipart" in peticio:
+        resposta = getattr(client, metode.lower())(url, peticio.pop("multipart"), **peticio)
+    else:
+        resposta = getattr(client, metode.lower())(url, **peticio)
+    if resposta.streaming:
+        b"".join(resposta.streaming_content)
+        resposta.close()
+    return resposta.status_code
+
+
+def _desfent(funcio):
+    with transaction.atomic():
+        resultat = funcio()
+        transaction.set_rollback(True)
+    return resultat
+
+
+def _consultes(capturades):
+    # Sense les ordres de transacció, que depenen de la transacció que embolcalla cada crida
+    return sum(
+        1 for q in capturades
+        if not q["sql"].upper().startswith(("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE SAVEPOINT"))
+    )
+
+
+def mesurar(metode, ruta, ctx, repeticions):
+    client = Client()
+    cas = CASOS[(metode, ruta)]
+    esperat = cas(ctx).get("estat", 200)
+
+    estat = _desfent(lambda: _cridar(client, metode, cas(ctx)))  # Escalfa les memòries cau
+
+    peticio = cas(ctx)
+    reset_queries()
+    with CaptureQueriesContext(connection) as capturades:
+        _desfent(lambda: _cridar(client, metode, peticio))
+    # Cada petició buida el registre de consultes: es compten abans de la següent
+    consultes = _consultes(capturades.captured_queries)
+
+    peticio = cas(ctx)
+    tracemalloc.start()
+    try:
+        inici = tracemalloc.get_traced_memory()[0]
+        _desfent(lambda: _cridar(client, metode, peticio))
+        pic = tracemalloc.get_traced_memory()[1] - inici
+    finally:
+        tracemalloc.stop()
+
+    temps = []
+    for _ in range(repeticions):
+        peticio = cas(ctx)
+        t = time.perf_counter()
+        _desfent(lambda: _cridar(client, metode, peticio))
+        temps.append((time.perf_counter() - t) * 1000)
+
+    return {
+        "estat": estat,
+        "esperat": esperat,
+        "consultes": consultes,
+        "p50_ms": round(_percentil(temps, 50), 2),
+        "p95_ms": round(_percentil(temps, 95), 2),
+        "memoria_kb": round(pic / 1024, 1),
+    }
+
+
+def executar(repeticions=20, filtre=None, sortida=None):
+    """
+    Crea la base de dades de proves, hi carrega les dades i mesura els
+    endpoints. Retorna {"METODE /ruta": mesures}.
+    """
+    config = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+    try:
+        with tempfile.TemporaryDirectory() as directori, override_settings(
+            GOOGLE_BOOKS_BACKEND="biblioteca.benchmark.BackendSenseXarxa",
+            ETIQUETES_TREBALLS_DIR=directori,
+            ETIQUETES_CACHE_DIR=directori,
+            ALLOWED_HOSTS=["testserver"],
+            DEBUG=False,
+        ):
+            with redirect_stderr(StringIO()):
+                call_command("seed_biblioteca", scale=ESCALA, seed=LLAVOR, workers=1, stdout=StringIO())
+            ctx = _context()
+            resultats = {}
+            for metode, ruta in operacions():
+                nom = f"{metode} {ruta}"
+                if filtre and filtre not in nom:
+                    continue
+                if sortida:
+                    sortida(nom)
+                resultats[nom] = mesurar(metode, ruta, ctx, repeticions)
+            return resultats
+    finally:
+        teardown_databases(config, verbosity=0)
+
+
+def llegir_baseline(cami=BASELINE):
+    try:
+        with open(cami, encoding="utf-8") as fitxer:
+            return json.load(fitxer)["endpoints"]
+    except FileNotFoundError:
+        return {}
+
+
+def desar_baseline(resultats, cami=BASELINE):
+    endpoints = {
+        nom: {clau: mesures[clau] for clau in ("consultes", "p50_ms", "p95_ms", "memoria_kb")}
+        for nom, mesures in sorted(resultats.items())
+    }
+    with open(cami, "w", encoding="utf-8") as fitxer:
+        json.dump({"escala": ESCALA, "llavor": LLAVOR, "endpoints": endpoints}, fitxer, indent=2, ensure_ascii=False)
+        fitxer.write("\n")
+
+
+def comparar(resultats, baseline, marge=0.5, marge_ms=2.0):
+    """
+    Files de la taula de diferències i llista de regressions. La latència ha
+    de superar la referència en més de `marge` (proporció) i de `marge_ms`.
+    """
+    files, regressions = [], []
+    for nom, ara in resultats.items():
+        abans = baseline.get(nom)
+        problemes = []
+        if ara["estat"] != ara["esperat"]:
+            problemes.append(f"HTTP {ara['estat']}")
+        if abans is None:
+            problemes.append("new")
+        else:
+            if ara["consultes"] > abans["consultes"]:
+                problemes.append("queries")
+            for clau in ("p50_ms", "p95_ms"):
+                if ara[clau] > abans[clau] * (1 + marge) and ara[clau] - abans[clau] > marge_ms:
+                    problemes.append(clau[:3])
+            if ara["memoria_kb"] > abans["memoria_kb"] * (1 + marge) and ara["memoria_kb"] - abans["memoria_kb"] > 64:
+                problemes.append("memory")
+        if [p for p in problemes if p != "new"]:
+            regressions.append(nom)
+        files.append((nom, abans, ara, problemes))
+    return files, regressions
+
+
+def _diferencia(abans, ara, format_):
+    if abans is None:
+        return format_.format(ara)
+    if abans == ara:
+        return format_.format(ara)
+    signe = "+" if ara > abans else ""
+    if isinstance(ara, int):
+        return f"{format_.format(abans)}→{format_.format(ara)} ({signe}{ara - abans})"
+    percentatge = (ara - abans) / abans * 100 if abans else 0
+    return f"{format_.format(abans)}→{format_.format(ara)} ({signe}{percentatge:.0f}%)"
+
+
+def taula(files):
+    capcalera = ("endpoint", "queries", "p50 (ms)", "p95 (ms)", "peak mem (KB)", "")
+    linies = []
+    for nom, abans, ara, problemes in files:
+        abans = abans or {}
+        linies.append((
+            nom,
+            _diferencia(abans.get("consultes"), ara["consultes"], "{}"),
+            _diferencia(abans.get("p50_ms"), ara["p50_ms"], "{:.2f}"),
+            _diferencia(abans.get("p95_ms"), ara["p95_ms"], "{:.2f}"),
+            _diferencia(abans.get("memoria_kb"), ara["memoria_kb"], "{:.1f}"),
+            ", ".join(problemes),
+        ))
+    amplades = [max(len(str(fila[i])) for fila in [capcalera, *linies]) for i in range(len(capcalera))]
+    return [
+        "  ".join(str(valor).ljust(amplada) for valor, amplada in zip(fila, amplades)).rstrip()
+        for fila in [capcalera, *linies]
+    ]
@@ -0,0 +1,247 @@
+"""
+Índex de text complet del catàleg.
+
+A SQLite s'utilitza una taula virtual FTS5 i a PostgreSQL una taula amb un
+`tsvector` i un índex GIN. Amb altres bases de dades (MySQL) `disponible()`
+retorna False i les cerques continuen amb `icontains`.
+
+L'índex conté titol, titol_original, autor, resum, l'editorial i l'ISBN dels
+llibres i els noms dels tags. Es manté sincronitzat amb senyals i es pot
+reconstruir amb `./manage.py rebuild_search_index`.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import BR, CD, DVD, Cataleg, Categoria, Dispositiu, Llibre, Revista
+
+TAULA = "biblioteca_cataleg_fts"
+CAMPS = ("titol", "titol_original", "autor", "resum", "editorial", "isbn", "tags")
+
+# Pes de cada camp en la rellevància (bm25 a SQLite, setweight a PostgreSQL)
+PESOS_BM25 = (10.0, 5.0, 8.0, 1.0, 3.0, 3.0, 2.0)
+PESOS_PG = ("A", "B", "A", "D", "C", "C", "C")
+
+MIDA_LOT = 500
+
+
+def disponible(conn=connection):
+    return conn.vendor in ("sqlite", "postgresql")
+
+
+def normalitzar(text):
+    """Minúscules i sense accents, igual per indexar i per cercar."""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def crear_index(schema_editor):
+    conn = schema_editor.connection
+    if conn.vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {TAULA} USING fts5({', '.join(CAMPS)}, "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        )
+        pesos = ", ".join(str(p) for p in PESOS_BM25)
+        schema_editor.execute(f"INSERT INTO {TAULA}({TAULA}, rank) VALUES ('rank', 'bm25({pesos})')")
+    elif conn.vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE TABLE {TAULA} ("
+            f"cataleg_id bigint PRIMARY KEY REFERENCES biblioteca_cataleg(id) "
+            f"ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            f"document tsvector NOT NULL)"
+        )
+        schema_editor.execute(f"CREATE INDEX {TAULA}_document ON {TAULA} USING GIN (document)")
+
+
+def eliminar_index(schema_editor):
+    if disponible(schema_editor.connection):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {TAULA}")
+
+
+def _documents(ids, model=Cataleg):
+    """Retorna [(id, [valors de CAMPS])] per als ids indicats."""
+    tags = defaultdict(list)
+    for cataleg_id, nom in model.objects.filter(id__in=ids).values_list("id", "tags__nom"):
+        if nom:
+            tags[cataleg_id].append(nom)
+
+    files = model.objects.filter(id__in=ids).values_list(
+        "id", "titol", "titol_original", "autor", "resum", "llibre__editorial", "llibre__ISBN"
+    )
+    return [
+        (fila[0], [normalitzar(v) for v in fila[1:]] + [normalitzar(" ".join(tags[fila[0]]))])
+        for fila in files
+    ]
+
+
+def _esborrar(ids, conn):
+    if not ids:
+        return
+    marcadors = ", ".join(["%s"] * len(ids))
+    columna = "rowid" if conn.vendor == "sqlite" else "cataleg_id"
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TAULA} WHERE {columna} IN ({marcadors})", list(ids))
+
+
+def _escriure(documents, conn):
+    if not documents:
+        return
+    if conn.vendor == "sqlite":
+        sql = (
+            f"INSERT INTO {TAULA}(rowid, {', '.join(CAMPS)}) "
+            f"VALUES (%s, {', '.join(['%s'] * len(CAMPS))})"
+        )
+    else:
+        document = " || ".join(
+            f"setweight(to_tsvector('simple', %s), '{pes}')" for pes in PESOS_PG
+        )
+        sql = (
+            f"INSERT INTO {TAULA}(cataleg_id, document) VALUES (%s, {document}) "
+            f"ON CONFLICT (cataleg_id) DO UPDATE SET document = EXCLUDED.document"
+        )
+    with conn.cursor() as cursor:
+        cursor.executemany(sql, [[cataleg_id] + valors for cataleg_id, valors in documents])
+
+
+def indexar(ids, conn=connection):
+    """Torna a indexar els elements del catàleg indicats."""
+    ids = list(ids)
+    if not ids or not disponible(conn):
+        return
+    _esborrar(ids, conn)
+    _escriure(_documents(ids), conn)
+
+
+def desindexar(ids, conn=connection):
+    ids = list(ids)
+    if ids and disponible(conn):
+        _esborrar(ids, conn)
+
+
+def reconstruir_index(model=Cataleg, conn=connection):
+    """Buida i torna a omplir l'índex sencer. Retorna el nombre d'elements indexats."""
+    if not disponible(conn):
+        return 0
+    total = 0
+    with transaction.atomic(using=conn.alias):
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {TAULA}")
+        darrer = 0
+        while True:
+            ids = list(
+                model.objects.filter(id__gt=darrer).order_by("id").values_list("id", flat=True)[:MIDA_LOT]
+            )
+            if not ids:
+                break
+            _escriure(_documents(ids, model), conn)
+            total += len(ids)
+            darrer = ids[-1]
+    return total
+
+
+def _expressio(q, conn):
+    # Cada paraula de la consulta es tracta com a prefix i s'han de complir totes
+    paraules = re.findall(r"[^\W_]+", normalitzar(q))
+    if not paraules:
+        return None
+    if conn.vendor == "sqlite":
+        return " ".join(f'"{p}"*' for p in paraules)
+    return " & ".join(f"{p}:*" for p in paraules)
+
+
+def cercar(q, limit, despres=None, tipus=None, conn=connection):
+    """
+    Retorna [(id, rank)] ordenat per rellevància (rank més baix = més rellevant).
+
+    `despres` és el (rank, id) de l'últim resultat de la pàgina anterior.
+    """
+    expressio = _expressio(q, conn)
+    if expressio is None:
+        return []
+
+    params = []
+    if conn.vendor == "sqlite":
+        sql = f"SELECT {TAULA}.rowid AS id, {TAULA}.rank AS rank FROM {TAULA}"
+        if tipus:
+            sql += f" JOIN biblioteca_cataleg c ON c.id = {TAULA}.rowid AND c.tipus = %s"
+            params.append(tipus)
+        sql += f" WHERE {TAULA} MATCH %s"
+        params.append(expressio)
+    else:
+        sql = (
+            f"SELECT f.cataleg_id AS id, -ts_rank(f.document, to_tsquery('simple', %s)) AS rank "
+            f"FROM {TAULA} f"
+        )
+        params.append(expressio)
+        if tipus:
+            sql += " JOIN biblioteca_cataleg c ON c.id = f.cataleg_id AND c.tipus = %s"
+            params.append(tipus)
+        sql += " WHERE f.document @@ to_tsquery('simple', %s)"
+        params.append(expressio)
+
+    sql = f"SELECT id, rank FROM ({sql}) resultats"
+    if despres is not None:
+        sql += " WHERE (rank, id) > (%s, %s)"
+        params.extend(despres)
+    sql += " ORDER BY rank, id LIMIT %s"
+    params.append(limit)
+
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(fila[0], fila[1]) for fila in cursor.fetchall()]
+
+
+# Sincronització amb senyals
+@receiver(post_save, sender=Cataleg)
+@receiver(post_save, sender=Llibre)
+@receiver(post_save, sender=Revista)
+@receiver(post_save, sender=CD)
+@receiver(post_save, sender=DVD)
+@receiver(post_save, sender=BR)
+@receiver(post_save, sender=Dispositiu)
+def _cataleg_desat(sender, instance, raw=False, **kwargs):
+    if not raw:
+        indexar([instance.pk])
+
+
+@receiver(post_delete, sender=Cataleg)
+def _cataleg_esborrat(sender, instance, **kwargs):
+    desindexar([instance.pk])
+
+
+@receiver(m2m_changed, sender=Cataleg.tags.through)
+def _tags_canviats(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            indexar([instance.pk])
+        return
+    # Canvis des de la Categoria: cal reindexar els elements afectats
+    if action == "pre_clear":
+        instance._cerca_ids = list(instance.cataleg_set.values_list("id", flat=True))
+    elif action == "post_clear":
+        indexar(getattr(instance, "_cerca_ids", []))
+    elif action in ("post_add", "post_remove"):
+        indexar(pk_set or [])
+
+
+@receiver(post_save, sender=Categoria)
+def _categoria_desada(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        indexar(instance.cataleg_set.values_list("id", flat=True))
+
+
+@receiver(pre_delete, sender=Categoria)
+def _categoria_abans_esborrar(sender, instance, **kwargs):
+    instance._cerca_ids = list(instance.cataleg_set.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=Categoria)
+def _categoria_esborrada(sender, instance, **kwargs):
+    indexar(getattr(instance, "_cerca_ids", []))
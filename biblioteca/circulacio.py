@@ -0,0 +1,217 @@
+"""
+Préstecs i retorns en lot per al taulell de circulació.
+
+- Es valida tot el lot amb unes poques consultes per conjunts (exemplars per
+  registre, préstecs actius) i els canvis s'apliquen en una sola transacció,
+  amb els préstecs i els registres del Log inserits amb bulk_create.
+- Els registres que no es poden prestar o retornar no aturen la resta: cada
+  element del lot té el seu resultat, en el mateix ordre que s'han rebut.
+- Les files afectades es bloquegen (select_for_update) i l'UPDATE torna a
+  comprovar l'estat; si un altre taulell n'ha canviat alguna entretant (en
+  bases de dades sense bloqueig de files, com SQLite) es torna a provar.
+- Els comptadors de disponibilitat dels exemplars prestats o retornats
+  s'actualitzen en la mateixa transacció.
+- Un exemplar amb un préstec obert no es presta encara que no estigui exclòs
+  de préstec (préstecs creats des de l'admin o dades antigues): el registre rep
+  el seu error en lloc de fer fallar tot el lot.
+"""
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
+
+from . import disponibilitat
+from .models import Exemplar, Log, Prestec, Usuari
+
+MAX_PER_LOT = 200
+INTENTS = 3
+
+
+class Conflicte(Exception):
+    """Un altre taulell ha canviat algun exemplar del lot mentre es processava."""
+
+
+def _resultat(registre, error=None, prestec_id=None):
+    return {"registre": registre, "ok": error is None, "prestec_id": prestec_id, "error": error}
+
+
+def prestec_obert():
+    """Condició per a Exemplar: té algun préstec sense retornar."""
+    return Exists(Prestec.objects.filter(exemplar_id=OuterRef("pk"), data_retorn__isnull=True))
+
+
+def _exemplars(registres, amb_prestec=False):
+    """
+    Registres sense repetir (en ordre), exemplars trobats per registre i errors
+    per registre. Amb `amb_prestec`, cada exemplar porta `prestat`.
+    """
+    unics, errors = list(dict.fromkeys(registres)), {}
+    trobats = Exemplar.objects.filter(registre__in=unics).only("id", "registre", "exclos_prestec", "baixa", "cataleg_id", "centre_id")
+    if amb_prestec:
+        trobats = trobats.annotate(prestat=prestec_obert())
+    exemplars = {e.registre: e for e in trobats}
+    for registre in unics:
+        if registre not in exemplars:
+            errors[registre] = "Ejemplar no encontrado"
+    return unics, exemplars, errors
+
+
+def _error_centre(bibliotecari, exemplar):
+    if exemplar.centre_id != bibliotecari.centre_id and not bibliotecari.is_superuser:
+        return "El ejemplar pertenece a otro centro"
+    return None
+
+
+def _logs(bibliotecari, missatges):
+    Log.objects.bulk_create([
+        Log(usuari=bibliotecari.username, accio=missatge[:100], tipus="INFO") for missatge in missatges
+    ])
+
+
+def _resultats(registres, errors, exemplars, fets, error_restants):
+    resultats, vistos = [], set()
+    for registre in registres:
+        if registre in vistos:
+            resultats.append(_resultat(registre, "Registro repetido en el lote"))
+        elif registre in errors:
+            resultats.append(_resultat(registre, errors[registre]))
+        elif exemplars[registre].id in fets:
+            resultats.append(_resultat(registre, prestec_id=fets[exemplars[registre].id]))
+        else:
+            resultats.append(_resultat(registre, error_restants))
+        vistos.add(registre)
+    return resultats
+
+
+def _amb_reintents(funcio):
+    for intent in range(INTENTS):
+        try:
+            with transaction.atomic():
+                return funcio()
+        except Conflicte:
+            if intent == INTENTS - 1:
+                raise
+
+
+def prestar(bibliotecari, usuari, registres, anotacions=None):
+    """
+    Presta a `usuari` els exemplars amb aquests registres. `bibliotecari` és la
+    instantània de permisos de qui presta. Retorna un resultat per registre.
+    """
+    unics, exemplars, errors = _exemplars(registres, amb_prestec=True)
+    for registre in unics:
+        exemplar = exemplars.get(registre)
+        if exemplar is None:
+            continue
+        if exemplar.exclos_prestec:
+            errors[registre] = "El ejemplar está excluido de préstamo"
+        elif exemplar.baixa:
+            errors[registre] = "El ejemplar está dado de baja"
+        elif exemplar.prestat:
+            errors[registre] = "El ejemplar ya tiene un préstamo activo"
+        else:
+            error = _error_centre(bibliotecari, exemplar)
+            if error:
+                errors[registre] = error
+    candidats = {exemplars[r].id: r for r in unics if r not in errors}
+
+    def aplicar():
+        disponibles = Exemplar.objects.select_for_update().filter(
+            ~prestec_obert(), id__in=candidats, exclos_prestec=False, baixa=False
+        )
+        ids = set(disponibles.values_list("id", flat=True))
+        if Exemplar.objects.filter(~prestec_obert(), id__in=ids, exclos_prestec=False, baixa=False).update(exclos_prestec=True) != len(ids):
+            raise Conflicte()
+        canvis = disponibilitat.Canvis()
+        for exemplar_id in ids:
+            exemplar = exemplars[candidats[exemplar_id]]
+            canvis.moure(exemplar.cataleg_id, exemplar.centre_id, "disponible", "exclos_prestec")
+        canvis.aplicar()
+        prestecs = [Prestec(usuari=usuari, exemplar_id=i, anotacions=anotacions) for i in candidats if i in ids]
+        Prestec.objects.bulk_create(prestecs)
+        if any(p.pk is None for p in prestecs):
+            # Alguns backends (MySQL) no retornen les claus de bulk_create
+            claus = dict(
+                Prestec.objects.filter(exemplar_id__in=ids, usuari=usuari, data_retorn__isnull=True)
+                .order_by("id").values_list("exemplar_id", "id")
+            )
+            for prestec in prestecs:
+                prestec.pk = claus[prestec.exemplar_id]
+        _logs(bibliotecari, [
+            f"Préstamo creado: ID {p.pk} - Ejemplar {candidats[p.exemplar_id]} a {usuari.username}" for p in prestecs
+        ])
+        return {p.exemplar_id: p.pk for p in prestecs}
+
+    prestats = _amb_reintents(aplicar) if candidats else {}
+    return _resultats(registres, errors, exemplars, prestats, "El ejemplar acaba de ser prestado o dado de baja")
+
+
+def retornar(bibliotecari, registres):
+    """Tanca els préstecs actius dels exemplars amb aquests registres. Retorna un resultat per registre."""
+    unics, exemplars, errors = _exemplars(registres)
+    for registre in unics:
+        exemplar = exemplars.get(registre)
+        if exemplar is not None:
+            error = _error_centre(bibliotecari, exemplar)
+            if error:
+                errors[registre] = error
+    candidats = {exemplars[r].id: r for r in unics if r not in errors}
+
+    def aplicar():
+        actius = list(
+            Prestec.objects.select_for_update().filter(exemplar_id__in=candidats, data_retorn__isnull=True)
+            .order_by("id").values_list("id", "exemplar_id", "usuari_id")
+        )
+        ids = [prestec_id for prestec_id, _, _ in actius]
+        if Prestec.objects.filter(id__in=ids, data_retorn__isnull=True).update(data_retorn=timezone.localdate()) != len(ids):
+            raise Conflicte()
+        retornats = {}
+        for prestec_id, exemplar_id, _ in actius:
+            retornats.setdefault(exemplar_id, prestec_id)
+        # Només els que estaven exclosos de préstec (i no de baixa) tornen a estar disponibles
+        tornen = list(
+            Exemplar.objects.select_for_update().filter(id__in=retornats, exclos_prestec=True, baixa=False)
+            .values_list("id", "cataleg_id", "centre_id")
+        )
+        Exemplar.objects.filter(id__in=retornats).update(exclos_prestec=False)
+        canvis = disponibilitat.Canvis()
+        for _, cataleg_id, centre_id in tornen:
+            canvis.moure(cataleg_id, centre_id, "exclos_prestec", "disponible")
+        canvis.aplicar()
+        usernames = dict(Usuari.objects.filter(id__in={u for _, _, u in actius}).values_list("id", "username"))
+        _logs(bibliotecari, [
+            f"Devolución: ID {prestec_id} - Ejemplar {candidats[exemplar_id]} de {usernames[usuari_id]}"
+            for prestec_id, exemplar_id, usuari_id in actius
+        ])
+        return retornats
+
+    retornats = _amb_reintents(aplicar) if candidats else {}
+    return _resultats(registres, errors, exemplars, retornats, "El ejemplar no tiene ningún préstamo activo")
+
+
+def prestecs_duplicats():
+    """{exemplar_id: [ids dels préstecs actius, el més recent primer]} dels exemplars amb més d'un."""
+    actius = Prestec.objects.filter(data_retorn__isnull=True)
+    repetits = actius.values("exemplar_id").annotate(n=Count("id")).filter(n__gt=1).values("exemplar_id")
+    duplicats = {}
+    for prestec_id, exemplar_id in actius.filter(exemplar_id__in=repetits).order_by("exemplar_id", "-id").values_list("id", "exemplar_id"):
+        duplicats.setdefault(exemplar_id, []).append(prestec_id)
+    return duplicats
+
+
+def tancar_duplicats(usuari):
+    """
+    Deixa obert el préstec més recent de cada exemplar i tanca els anteriors el
+    dia que va començar aquest, amb un registre al Log per cada un. Retorna els
+    ids dels préstecs tancats.
+    """
+    tancats = []
+    with transaction.atomic():
+        for exemplar_id, ids in prestecs_duplicats().items():
+            recent = Prestec.objects.select_for_update().get(id=ids[0])
+            Prestec.objects.filter(id__in=ids[1:], data_retorn__isnull=True).update(data_retorn=recent.data_prestec)
+            tancats += ids[1:]
+        Log.objects.bulk_create([
+            Log(usuari=usuari, accio=f"Préstamo duplicado cerrado: ID {prestec_id}"[:100], tipus="WARNING")
+            for prestec_id in tancats
+        ])
+    return tancats
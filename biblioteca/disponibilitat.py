@@ -0,0 +1,179 @@
+"""
+Comptadors de disponibilitat d'exemplars per (element del catàleg, centre).
+
+- DisponibilitatExemplars desa quants exemplars hi ha disponibles, exclosos de
+  préstec i de baixa. La cerca i l'admin els llegeixen amb un sol join en
+  lloc de comptar els exemplars a cada petició.
+- Cada canvi d'un exemplar (desar, esborrar, crear en bloc, préstec, retorn)
+  suma o resta la diferència amb F() en la mateixa transacció: dues
+  transaccions concurrents no es trepitgen perquè els increments commuten.
+- Si la fila encara no existeix es crea amb el recompte real, que ja inclou el
+  canvi de la transacció en curs.
+- Els UPDATE directes d'exemplars fora d'aquest mòdul, loaddata o els canvis
+  fets a mà a la base de dades no actualitzen res: `reconcile_availability`
+  torna a calcular els comptadors i repara les diferències.
+"""
+from collections import Counter, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Cataleg, DisponibilitatExemplars, Exemplar, exemplars_creats
+
+CATEGORIES = ("disponible", "exclos_prestec", "baixa")
+
+
+def categoria(exclos_prestec, baixa):
+    if baixa:
+        return "baixa"
+    return "exclos_prestec" if exclos_prestec else "disponible"
+
+
+class Canvis:
+    """Diferències acumulades per (cataleg_id, centre_id) i categoria."""
+
+    def __init__(self):
+        self.deltes = defaultdict(Counter)
+
+    def sumar(self, cataleg_id, centre_id, categoria, n=1):
+        self.deltes[(cataleg_id, centre_id)][categoria] += n
+        return self
+
+    def moure(self, cataleg_id, centre_id, de, a, n=1):
+        """`n` exemplars passen de la categoria `de` a la categoria `a`."""
+        return self.sumar(cataleg_id, centre_id, de, -n).sumar(cataleg_id, centre_id, a, n)
+
+    def aplicar(self):
+        # Sempre en el mateix ordre: dues transaccions no es bloquegen en creu
+        for (cataleg_id, centre_id), delta in sorted(self.deltes.items()):
+            _aplicar(cataleg_id, centre_id, {c: n for c, n in delta.items() if n})
+        self.deltes.clear()
+
+
+def _comptes():
+    return {
+        "disponible": Count("id", filter=Q(exclos_prestec=False, baixa=False)),
+        "exclos_prestec": Count("id", filter=Q(exclos_prestec=True, baixa=False)),
+        "baixa": Count("id", filter=Q(baixa=True)),
+    }
+
+
+def _aplicar(cataleg_id, centre_id, delta):
+    if not delta:
+        return
+    files = DisponibilitatExemplars.objects.filter(cataleg_id=cataleg_id, centre_id=centre_id)
+    with transaction.atomic(savepoint=False):
+        if files.update(**{c: F(c) + n for c, n in delta.items()}):
+            return
+        if all(n < 0 for n in delta.values()):
+            # Només treu exemplars (p. ex. s'està esborrant el catàleg): no cal crear-la
+            return
+        try:
+            with transaction.atomic():
+                DisponibilitatExemplars.objects.create(
+                    cataleg_id=cataleg_id, centre_id=centre_id,
+                    **Exemplar.objects.filter(cataleg_id=cataleg_id, centre_id=centre_id).aggregate(**_comptes()),
+                )
+        except IntegrityError:
+            # Un altre procés l'acaba de crear, sense el nostre canvi
+            files.update(**{c: F(c) + n for c, n in delta.items()})
+
+
+def per_cataleg(cataleg_ids):
+    """{cataleg_id: {disponible, exclos_prestec, baixa}} sumant tots els centres, amb una sola consulta."""
+    files = DisponibilitatExemplars.objects.filter(cataleg_id__in=cataleg_ids).values_list(
+        "cataleg_id", *CATEGORIES
+    )
+    resultat = {}
+    for cataleg_id, *valors in files:
+        totals = resultat.setdefault(cataleg_id, dict.fromkeys(CATEGORIES, 0))
+        for categoria_, valor in zip(CATEGORIES, valors):
+            totals[categoria_] += valor
+    return resultat
+
+
+def reconciliar(mida_lot=1000, reparar=True):
+    """
+    Torna a calcular els comptadors a partir dels exemplars, per lots de
+    `mida_lot` elements del catàleg. Retorna quantes files eren incorrectes
+    (i, si `reparar`, s'han corregit).
+    """
+    incorrectes, darrer = 0, 0
+    while True:
+        ids = list(
+            Cataleg.objects.filter(id__gt=darrer).order_by("id").values_list("id", flat=True)[:mida_lot]
+        )
+        if not ids:
+            return incorrectes
+        darrer = ids[-1]
+        with transaction.atomic():
+            # Es bloquegen primer els comptadors: un canvi concurrent que encara
+            # no els ha actualitzat ho farà després, sobre el valor corregit
+            desats = {
+                (d.cataleg_id, d.centre_id): d
+                for d in DisponibilitatExemplars.objects.select_for_update().filter(cataleg_id__in=ids)
+            }
+            comptes = (
+                Exemplar.objects.filter(cataleg_id__in=ids).order_by()
+                .values("cataleg_id", "centre_id").annotate(**_comptes())
+                .values_list("cataleg_id", "centre_id", *CATEGORIES)
+            )
+            reals = {(cataleg_id, centre_id): dict(zip(CATEGORIES, valors)) for cataleg_id, centre_id, *valors in comptes}
+            nous, canviats = [], []
+            for clau in reals.keys() | desats.keys():
+                valors = reals.get(clau, dict.fromkeys(CATEGORIES, 0))
+                fila = desats.get(clau)
+                if fila is None:
+                    nous.append(DisponibilitatExemplars(cataleg_id=clau[0], centre_id=clau[1], **valors))
+                elif any(getattr(fila, c) != valors[c] for c in CATEGORIES):
+                    for c in CATEGORIES:
+                        setattr(fila, c, valors[c])
+                    canviats.append(fila)
+            incorrectes += len(nous) + len(canviats)
+            if reparar:
+                DisponibilitatExemplars.objects.bulk_create(nous)
+                DisponibilitatExemplars.objects.bulk_update(canviats, CATEGORIES)
+
+
+@receiver(pre_save, sender=Exemplar)
+def _abans_de_desar(sender, instance, raw=False, **kwargs):
+    instance._disponibilitat_abans = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    # Exemplar.save obre una transacció: la fila queda bloquejada fins a post_save
+    instance._disponibilitat_abans = (
+        Exemplar.objects.select_for_update().filter(pk=instance.pk)
+        .values_list("cataleg_id", "centre_id", "exclos_prestec", "baixa").first()
+    )
+
+
+@receiver(post_save, sender=Exemplar)
+def _exemplar_desat(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    canvis = Canvis()
+    abans = getattr(instance, "_disponibilitat_abans", None)
+    if abans is not None:
+        cataleg_id, centre_id, exclos_prestec, baixa = abans
+        canvis.sumar(cataleg_id, centre_id, categoria(exclos_prestec, baixa), -1)
+    elif not created:
+        return  # Desat sense passar per pre_save (no hauria de passar)
+    canvis.sumar(instance.cataleg_id, instance.centre_id, categoria(instance.exclos_prestec, instance.baixa))
+    canvis.aplicar()
+
+
+@receiver(post_delete, sender=Exemplar)
+def _exemplar_esborrat(sender, instance, **kwargs):
+    Canvis().sumar(
+        instance.cataleg_id, instance.centre_id, categoria(instance.exclos_prestec, instance.baixa), -1
+    ).aplicar()
+
+
+@receiver(exemplars_creats)
+def _exemplars_creats(sender, cataleg_id, exemplars, **kwargs):
+    canvis = Canvis()
+    for exemplar in exemplars:
+        canvis.sumar(cataleg_id, exemplar.centre_id, categoria(exemplar.exclos_prestec, exemplar.baixa))
+    canvis.aplicar()
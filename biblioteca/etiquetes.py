@@ -0,0 +1,324 @@
+"""
+Generació del PDF d'etiquetes dels exemplars.
+
+Cada exemplar ocupa dues cel·les (codi de barres i CDU) d'una graella de
+4 x 17 = 68 cel·les per pàgina A4. Els exemplars es carreguen amb una sola
+consulta i cada codi de barres es desa al disc (ETIQUETES_CACHE_DIR) amb una
+clau que depèn només del seu contingut, de manera que reimprimir una etiqueta
+no el torna a dibuixar.
+
+Hi ha dos renderitzadors:
+- 'xhtml2pdf': la plantilla etiquetas.html amb els codis com a imatges PNG.
+  Els treballs de més de ETIQUETES_PAGINES_PER_LOT pàgines es renderitzen per
+  lots en fitxers temporals. Les pàgines de cada lot s'escriuen directament al
+  destí i s'alliberen abans del següent (EscriptorIncremental), de manera que
+  la memòria depèn de la mida del lot i no de la del document.
+- 'reportlab': dibuixa la mateixa graella directament al canvas, amb els
+  codis de barres vectorials. És molt més ràpid i el PDF ocupa menys.
+
+Els PDF grans es retornen en streaming des d'un fitxer temporal, sense tenir
+tot el document en memòria.
+"""
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from io import BytesIO
+
+from barcode import Code128
+from barcode.writer import ImageWriter
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.template.loader import render_to_string
+from pypdf import PdfReader
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+from reportlab.graphics.barcode.code128 import Code128 as Code128Vectorial
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.pdfgen import canvas
+from xhtml2pdf import pisa
+
+from .models import Exemplar
+
+COLUMNES = 4
+FILES = 17
+CELES_PER_PAGINA = COLUMNES * FILES  # 68 etiquetes per pàgina
+
+RENDERITZADORS = ('xhtml2pdf', 'reportlab')
+
+# Mateixos marges i mides de cel·la que etiquetas.html
+MARGE_SUPERIOR = 0.6 * cm
+MARGE_LATERAL = 0.8 * cm
+ALCADA_CELA = 1.68 * cm
+PADDING = 0.2 * cm
+
+# Canviar-la invalida els codis de barres desats si canvia com es dibuixen
+VERSIO_CODI = "code128-png-1"
+
+
+class ErrorEtiquetes(Exception):
+    pass
+
+
+def carregar_exemplars(exemplar_ids):
+    """Exemplars en l'ordre demanat (amb repeticions), ometent els que no existeixen."""
+    trobats = Exemplar.objects.select_related('cataleg', 'centre').in_bulk(set(exemplar_ids))
+    return [trobats[i] for i in exemplar_ids if i in trobats]
+
+
+def _directori_cache():
+    return getattr(settings, 'ETIQUETES_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'biblioteca-codis'))
+
+
+def codi_barres_png(registre):
+    """PNG del codi de barres Code128 del registre, desat al disc per contingut."""
+    clau = hashlib.sha256(f"{VERSIO_CODI}:{registre}".encode('utf-8')).hexdigest()
+    directori = os.path.join(_directori_cache(), clau[:2])
+    cami = os.path.join(directori, f"{clau}.png")
+    try:
+        with open(cami, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    buffer = BytesIO()
+    Code128(str(registre), writer=ImageWriter()).write(buffer, text='')
+    png = buffer.getvalue()
+
+    # Escriptura atòmica: un altre procés pot estar generant el mateix codi
+    os.makedirs(directori, exist_ok=True)
+    temporal = f"{cami}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(png)
+    os.replace(temporal, cami)
+    return png
+
+
+def celes(exemplars):
+    """Dues cel·les per exemplar: una amb el codi de barres i una altra amb el CDU."""
+    result = []
+    for exemplar in exemplars:
+        result.append({
+            'id': exemplar.id,
+            'centre_nom': exemplar.centre,
+            'registre': exemplar.registre,
+            'barcode_img': None,  # s'omple en renderitzar la pàgina
+            'type': 'barcode',
+            'CDU': None
+        })
+        result.append({
+            'id': exemplar.id,
+            'centre_nom': None,
+            'registre': None,
+            'barcode_img': None,
+            'type': 'cdu',
+            'CDU': exemplar.cataleg.CDU if exemplar.cataleg else None
+        })
+    return result
+
+
+def paginar_celes(llista):
+    """Divideix les cel·les en pàgines completes de FILES x COLUMNES."""
+    # Rellenar con None hasta completar la última página
+    total = max(1, -(-len(llista) // CELES_PER_PAGINA)) * CELES_PER_PAGINA
+    llista = llista + [None] * (total - len(llista))
+
+    pagines = []
+    for inici in range(0, total, CELES_PER_PAGINA):
+        pagina = llista[inici:inici + CELES_PER_PAGINA]
+        pagines.append([pagina[i:i + COLUMNES] for i in range(0, CELES_PER_PAGINA, COLUMNES)])
+    return pagines
+
+
+def _renderitzar_html(pagines, desti):
+    for pagina in pagines:
+        for fila in pagina:
+            for cela in fila:
+                if cela and cela['type'] == 'barcode' and cela['barcode_img'] is None:
+                    cela['barcode_img'] = base64.b64encode(codi_barres_png(cela['registre'])).decode('utf-8')
+
+    html = render_to_string('etiquetas.html', {'pages': pagines})
+    pdf = pisa.pisaDocument(BytesIO(html.encode("UTF-8")), desti)
+    if pdf.err:
+        raise ErrorEtiquetes("Error al generar el PDF")
+
+
+class EscriptorIncremental:
+    """
+    Uneix PDF escrivint-ne els objectes a `desti` a mesura que s'afegeixen.
+
+    PdfWriter.append guarda totes les pàgines fins al write final. Aquí cada
+    part es llegeix, les seves pàgines i els objectes que en depenen es
+    renumeren i s'escriuen tot seguit, i de la part només queden els
+    desplaçaments per a la taula xref. L'arbre de pàgines, el catàleg i la
+    xref s'escriuen a tancar().
+    """
+    CATALEG, PAGINES = 1, 2
+
+    def __init__(self, desti):
+        self.desti = desti
+        self.inici = desti.tell()
+        self.desplacaments = {}
+        self.fills = ArrayObject()
+        self.seguent = self.PAGINES + 1
+        desti.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _escriure(self, numero, objecte):
+        self.desplacaments[numero] = self.desti.tell() - self.inici
+        self.desti.write(f"{numero} 0 obj\n".encode())
+        objecte.write_to_stream(self.desti)
+        self.desti.write(b"\nendobj\n")
+
+    def afegir(self, fitxer):
+        lector = PdfReader(fitxer)
+        numeros, cua = {}, []
+
+        def referencia(antiga):
+            if antiga.idnum not in numeros:
+                numeros[antiga.idnum] = self.seguent
+                self.seguent += 1
+                cua.append(antiga)
+            return IndirectObject(numeros[antiga.idnum], 0, None)
+
+        def renumerar(objecte):
+            # Substitueix in situ les referències pels números nous. dict.items
+            # i no items(): DictionaryObject resol les referències en llegir-les
+            if isinstance(objecte, DictionaryObject):
+                parells = list(dict.items(objecte))
+            elif isinstance(objecte, ArrayObject):
+                parells = list(enumerate(objecte))
+            else:
+                return
+            for clau, valor in parells:
+                if not isinstance(valor, IndirectObject):
+                    renumerar(valor)
+                elif valor.pdf is lector:
+                    # Les que no són del lector ja són noves: els objectes directes
+                    # heretats (p. ex. /Resources) es comparteixen entre pàgines
+                    objecte[clau] = referencia(valor)
+
+        pagines = set()
+        for pagina in lector.pages:
+            self.fills.append(referencia(pagina.indirect_reference))
+            pagines.add(pagina.indirect_reference.idnum)
+        while cua:
+            antiga = cua.pop()
+            objecte = antiga.get_object()
+            if antiga.idnum in pagines:
+                # L'arbre de pàgines de la part no es copia: les pàgines pengen del nou
+                objecte[NameObject("/Parent")] = IndirectObject(self.PAGINES, 0, None)
+            renumerar(objecte)
+            self._escriure(numeros[antiga.idnum], objecte)
+
+    def tancar(self):
+        self._escriure(self.PAGINES, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): self.fills,
+            NameObject("/Count"): NumberObject(len(self.fills)),
+        }))
+        self._escriure(self.CATALEG, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.PAGINES, 0, None),
+        }))
+        xref = self.desti.tell() - self.inici
+        self.desti.write(f"xref\n0 {self.seguent}\n0000000000 65535 f \n".encode())
+        for numero in range(1, self.seguent):
+            self.desti.write(f"{self.desplacaments[numero]:010d} 00000 n \n".encode())
+        self.desti.write(f"trailer\n<< /Size {self.seguent} /Root {self.CATALEG} 0 R >>\n"
+                         f"startxref\n{xref}\n%%EOF\n".encode())
+
+
+def _renderitzar_xhtml2pdf(pagines, desti, progres):
+    lot = getattr(settings, 'ETIQUETES_PAGINES_PER_LOT', 10)
+    if len(pagines) <= lot:
+        _renderitzar_html(pagines, desti)
+        progres(len(pagines), len(pagines))
+        return
+
+    escriptor = EscriptorIncremental(desti)
+    for inici in range(0, len(pagines), lot):
+        with tempfile.TemporaryFile() as part:
+            _renderitzar_html(pagines[inici:inici + lot], part)
+            part.seek(0)
+            escriptor.afegir(part)
+        progres(min(inici + lot, len(pagines)), len(pagines))
+    escriptor.tancar()
+
+
+def _text_centrat(c, text, x, y, mida):
+    c.setFont('Helvetica', mida)
+    c.drawCentredString(x, y, str(text))
+
+
+def _renderitzar_reportlab(pagines, desti, progres):
+    amplada_pagina, alcada_pagina = A4
+    amplada_cela = (amplada_pagina - 2 * MARGE_LATERAL) / COLUMNES
+
+    c = canvas.Canvas(desti, pagesize=A4, pageCompression=1)
+    c.setTitle("Etiquetas Biblioteca")
+    for num_pagina, pagina in enumerate(pagines, start=1):
+        for num_fila, fila in enumerate(pagina):
+            dalt = alcada_pagina - MARGE_SUPERIOR - num_fila * ALCADA_CELA
+            for num_col, cela in enumerate(fila):
+                if not cela:
+                    continue
+                centre_x = MARGE_LATERAL + (num_col + 0.5) * amplada_cela
+
+                if cela['type'] == 'barcode':
+                    # Centre a dalt, codi de barres al mig i registre a baix
+                    _text_centrat(c, cela['centre_nom'] or '', centre_x, dalt - PADDING - 8, 8)
+                    _text_centrat(c, cela['registre'], centre_x, dalt - ALCADA_CELA + PADDING, 8)
+
+                    alcada_codi = ALCADA_CELA - 2 * PADDING - 22
+                    codi = Code128Vectorial(str(cela['registre']), barWidth=1, barHeight=alcada_codi, quiet=False)
+                    amplada_max = amplada_cela - 2 * PADDING
+                    if codi.width > amplada_max:
+                        codi = Code128Vectorial(str(cela['registre']), barWidth=amplada_max / codi.width,
+                                                barHeight=alcada_codi, quiet=False)
+                    codi.drawOn(c, centre_x - codi.width / 2, dalt - ALCADA_CELA + PADDING + 11)
+
+                elif cela['type'] == 'cdu':
+                    text = f"CDU: {cela['CDU'] or 'No especificat'}"
+                    _text_centrat(c, text, centre_x, dalt - ALCADA_CELA / 2 - 3, 9)
+        c.showPage()
+        progres(num_pagina, len(pagines))
+    c.save()
+
+
+def escriure_pdf(exemplars, desti, renderer='xhtml2pdf', progres=None):
+    """
+    Escriu el PDF d'etiquetes dels exemplars a `desti` (fitxer binari).
+    `progres(pagines_fetes, pagines_totals)` es crida a mesura que avança.
+    """
+    pagines = paginar_celes(celes(exemplars))
+    progres = progres or (lambda fetes, totals: None)
+    if renderer == 'reportlab':
+        _renderitzar_reportlab(pagines, desti, progres)
+    elif renderer == 'xhtml2pdf':
+        _renderitzar_xhtml2pdf(pagines, desti, progres)
+    else:
+        raise ErrorEtiquetes(f"Renderitzador desconegut: {renderer}")
+    return len(pagines)
+
+
+def resposta_pdf(exemplar_ids, renderer='xhtml2pdf', nom='etiquetas.pdf'):
+    """HttpResponse (o FileResponse per als treballs grans) amb el PDF d'etiquetes."""
+    exemplars = carregar_exemplars(exemplar_ids)
+    lot = getattr(settings, 'ETIQUETES_PAGINES_PER_LOT', 10)
+
+    if len(exemplars) * 2 <= lot * CELES_PER_PAGINA:
+        result = BytesIO()
+        escriure_pdf(exemplars, result, renderer)
+        response = HttpResponse(result.getvalue(), content_type='application/pdf')
+        response['Content-Disposition'] = f'attachment; filename="{nom}"'
+        return response
+
+    fitxer = tempfile.TemporaryFile()
+    try:
+        escriure_pdf(exemplars, fitxer, renderer)
+    except Exception:
+        fitxer.close()
+        raise
+    fitxer.seek(0)
+    return FileResponse(fitxer, content_type='application/pdf', as_attachment=True, filename=nom)
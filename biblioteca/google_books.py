@@ -0,0 +1,155 @@
+"""
+Client de Google Books per a l'autocompletat d'autors i editorials.
+
+- Les respostes es desen a ConsultaGoogleBooks, amb clau normalitzada, caducitat
+  (GOOGLE_BOOKS_CACHE_TTL) i expulsió de les menys usades quan se superen
+  GOOGLE_BOOKS_CACHE_MAX entrades.
+- Cada petició té un temps màxim (GOOGLE_BOOKS_TIMEOUT).
+- Després de GOOGLE_BOOKS_ERRORS_MAX errors seguits el circuit s'obre i no es
+  consulta Google Books durant GOOGLE_BOOKS_PAUSA segons.
+- GOOGLE_BOOKS_BACKEND és el camí d'una classe amb `get(url, params, timeout)`
+  que retorna el JSON; GOOGLE_BOOKS_URL permet apuntar a un servidor local.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import ConsultaGoogleBooks
+from .suggeriments import normalitzar
+
+logger = logging.getLogger(__name__)
+
+URL_PER_DEFECTE = "https://www.googleapis.com/books/v1/volumes"
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+class RequestsBackend:
+    def get(self, url, params, timeout):
+        import requests
+        response = requests.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+
+class CircuitBreaker:
+    """
+    Tancat: es fan peticions. Obert: no se'n fa cap fins que passa la pausa.
+    Després de la pausa es deixa passar una petició de prova.
+    """
+
+    def __init__(self, errors_max=None, pausa=None):
+        self.errors_max = errors_max
+        self.pausa = pausa
+        self.errors = 0
+        self.obert_fins = 0
+        self._lock = threading.Lock()
+
+    def _errors_max(self):
+        return self.errors_max if self.errors_max is not None else _config("GOOGLE_BOOKS_ERRORS_MAX", 3)
+
+    def _pausa(self):
+        return self.pausa if self.pausa is not None else _config("GOOGLE_BOOKS_PAUSA", 60)
+
+    def permet(self):
+        with self._lock:
+            if time.monotonic() < self.obert_fins:
+                return False
+            if self.errors >= self._errors_max():
+                # Mig obert: una sola petició de prova fins a la pròxima pausa
+                self.obert_fins = time.monotonic() + self._pausa()
+            return True
+
+    def exit(self):
+        with self._lock:
+            self.errors = 0
+            self.obert_fins = 0
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+            if self.errors >= self._errors_max():
+                self.obert_fins = time.monotonic() + self._pausa()
+
+
+circuit = CircuitBreaker()
+
+
+def _backend():
+    return import_string(_config("GOOGLE_BOOKS_BACKEND", "biblioteca.google_books.RequestsBackend"))()
+
+
+def _llegir_cache(clau):
+    ttl = timedelta(seconds=_config("GOOGLE_BOOKS_CACHE_TTL", 7 * 24 * 3600))
+    ara = timezone.now()
+    consulta = ConsultaGoogleBooks.objects.filter(clau=clau, creat__gte=ara - ttl).first()
+    if consulta is None:
+        return None
+    ConsultaGoogleBooks.objects.filter(pk=consulta.pk).update(darrer_us=ara)
+    return consulta.resultats
+
+
+def _desar_cache(clau, resultats):
+    ara = timezone.now()
+    try:
+        ConsultaGoogleBooks.objects.update_or_create(
+            clau=clau, defaults={"resultats": resultats, "creat": ara, "darrer_us": ara}
+        )
+    except IntegrityError:
+        # Un altre procés l'acaba de desar
+        return
+
+    # Expulsar les entrades menys usades si se supera el màxim
+    maxim = _config("GOOGLE_BOOKS_CACHE_MAX", 5000)
+    sobrants = ConsultaGoogleBooks.objects.order_by("-darrer_us").values_list("pk", flat=True)[maxim:]
+    sobrants = list(sobrants)
+    if sobrants:
+        ConsultaGoogleBooks.objects.filter(pk__in=sobrants).delete()
+
+
+def _consultar(filtre, q, extreure):
+    clau = f"{filtre}:{normalitzar(q)}"[:255]
+    resultats = _llegir_cache(clau)
+    if resultats is not None:
+        return resultats
+
+    if not circuit.permet():
+        return []
+
+    try:
+        data = _backend().get(
+            _config("GOOGLE_BOOKS_URL", URL_PER_DEFECTE),
+            {"q": f"{filtre}:{q}", "maxResults": 10},
+            _config("GOOGLE_BOOKS_TIMEOUT", 2),
+        )
+    except Exception as e:
+        circuit.error()
+        logger.warning("Error al buscar en Google Books: %s", e)
+        return []
+    circuit.exit()
+
+    resultats = []
+    for item in data.get("items", []):
+        for valor in extreure(item.get("volumeInfo", {})):
+            if valor:
+                resultats.append(valor)
+    _desar_cache(clau, resultats)
+    return resultats
+
+
+def autors(q):
+    """Autors dels llibres que Google Books troba per a `q`, en l'ordre de la resposta."""
+    return _consultar("inauthor", q, lambda info: info.get("authors", []))
+
+
+def editorials(q):
+    """Editorials dels llibres que Google Books troba per a `q`, en l'ordre de la resposta."""
+    return _consultar("inpublisher", q, lambda info: [info.get("publisher")])
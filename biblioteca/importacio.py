@@ -0,0 +1,467 @@
+"""
+Importació massiva d'usuaris (views.import_users).
+
+En lloc de consultar i desar fila a fila:
+- els emails, telèfons i noms d'usuari existents que apareixen a les files es
+  carreguen una sola vegada en conjunts;
+- els centres i grups de tot el fitxer es resolen de cop (els que falten es
+  creen amb un sol bulk_create);
+- les contrasenyes temporals es xifren en paral·lel en un grup de processos
+  (IMPORTACIO_PROCESSOS), perquè cada hash PBKDF2 és car, abans d'obrir cap
+  transacció;
+- els usuaris s'insereixen amb bulk_create per lots (IMPORTACIO_LOT) dins
+  d'una transacció.
+
+L'informe d'errors és el mateix que el de la versió fila a fila: un email o
+telèfon només bloqueja les files següents si la seva fila s'ha arribat a crear,
+i si un lot falla a la base de dades (per exemple, un nom d'usuari repetit), les
+seves files es tornen a inserir una a una i cada fila rep l'error que hauria
+rebut.
+
+Per als fitxers molt grans hi ha un mode en segon pla (ImportacioUsuaris): el
+CSV o NDJSON pujat es llegeix fila a fila i es confirma per blocs de
+IMPORTACIO_LOT files. Cada bloc desa, en la mateixa transacció, un punt de
+control amb les files confirmades, de manera que una importació interrompuda
+es reprèn on s'havia quedat. Els errors es van escrivint en un fitxer NDJSON
+al costat del pujat, i la memòria no depèn de la mida del fitxer.
+"""
+import csv
+import json
+import logging
+import os
+import random
+import string
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Centre, Grup, ImportacioUsuaris, Usuari
+
+logger = logging.getLogger(__name__)
+
+# Per sota d'aquest nombre de contrasenyes no surt a compte obrir processos
+MIN_PARALLEL = 32
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+def contrasenya_temporal():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+
+
+def xifrar_contrasenyes(contrasenyes):
+    """Hash de cada contrasenya, en el mateix ordre, repartit entre processos."""
+    processos = _config("IMPORTACIO_PROCESSOS", None) or os.cpu_count() or 1
+    if len(contrasenyes) < MIN_PARALLEL or processos == 1:
+        return [make_password(c) for c in contrasenyes]
+    with ProcessPoolExecutor(max_workers=processos) as pool:
+        mida = max(1, len(contrasenyes) // (processos * 4))
+        return list(pool.map(make_password, contrasenyes, chunksize=mida))
+
+
+def _per_nom(model, noms):
+    """{nom: objecte} amb els existents i els que falten creats d'un sol cop."""
+    if not noms:
+        return {}
+    trobats = {}
+    for obj in model.objects.filter(nom__in=noms).order_by("pk"):
+        trobats.setdefault(obj.nom, obj)
+    falten = [nom for nom in noms if nom not in trobats]
+    if falten:
+        model.objects.bulk_create([model(nom=nom) for nom in falten])
+        # Alguns backends (MySQL) no retornen les claus de bulk_create
+        for obj in model.objects.filter(nom__in=falten).order_by("pk"):
+            trobats.setdefault(obj.nom, obj)
+    return trobats
+
+
+def _error(error_details, index, email, error):
+    error_details.append((index, {"email": email, "error": error}))
+
+
+def _username(user_data):
+    first_initial = user_data["nom"][0].lower() if user_data["nom"] else ""
+    last_name1 = user_data.get("cognom1", "").lower()
+    last_name2 = user_data.get("cognom2", "").lower()
+    return f"{first_initial}{last_name1}{last_name2}".strip()
+
+
+def _existents(camp, valors):
+    """Valors de `camp` que ja té algun usuari, consultant només els de les files."""
+    valors = list({v for v in valors if v is not None})
+    trobats = set()
+    for inici in range(0, len(valors), 500):
+        trobats.update(
+            Usuari.objects.filter(**{f"{camp}__in": valors[inici:inici + 500]}).values_list(camp, flat=True)
+        )
+    return trobats
+
+
+def _usernames_files(data):
+    for user_data in data:
+        try:
+            yield _username(user_data)
+        except Exception:
+            # La fila fallarà més endavant amb el seu propi error
+            continue
+
+
+def _nou_usuari(user_data):
+    # El centre i el grup s'assignen en inserir-lo, quan ja existeixen
+    return Usuari(
+        username=_username(user_data),
+        email=user_data.get("email"),
+        first_name=user_data["nom"],
+        last_name=f"{user_data.get('cognom1', '')} {user_data.get('cognom2', '')}".strip(),
+        telefon=user_data.get("telefon"),
+    )
+
+
+class Preparacio:
+    """
+    El que no necessita cap transacció: emails i telèfons que ja existeixen i,
+    per cada fila, l'usuari construït (o l'excepció en construir-lo) amb la
+    contrasenya temporal ja xifrada.
+    """
+
+    def __init__(self, data):
+        self.emails = _existents("email", (d.get("email") for d in data))
+        self.telefons = _existents("telefon", (d.get("telefon") for d in data))
+        self.usernames = _existents("username", _usernames_files(data))
+        self.usuaris = []
+        for user_data in data:
+            try:
+                self.usuaris.append(_nou_usuari(user_data))
+            except Exception as e:
+                self.usuaris.append(e)
+        # Les files amb un email o telèfon que ja existeix no es crearan
+        candidats = [
+            usuari for usuari, user_data in zip(self.usuaris, data)
+            if isinstance(usuari, Usuari) and not self._existeix(user_data)
+        ]
+        hashes = xifrar_contrasenyes([contrasenya_temporal() for _ in candidats])
+        for usuari, hash_ in zip(candidats, hashes):
+            usuari.password = hash_
+
+    def _existeix(self, user_data):
+        email, telefon = user_data.get("email"), user_data.get("telefon")
+        return (email is not None and email in self.emails) or bool(telefon and telefon in self.telefons)
+
+
+class _Importacio:
+    """
+    Recorre les files en l'ordre del fitxer amb el mateix criteri que la versió
+    fila a fila. Un email o telèfon només queda ocupat quan la seva fila s'ha
+    creat: si una fila en repeteix un d'una fila pendent d'inserir, primer
+    s'insereixen les pendents i després es valida.
+    """
+
+    def __init__(self, preparacio, error_details):
+        self.emails = set(preparacio.emails)
+        self.telefons = set(preparacio.telefons)
+        self.usernames = set(preparacio.usernames)
+        self.error_details = error_details
+        self.centres, self.grups = {}, {}
+        self.noms_centres, self.noms_grups = set(), set()
+        self.pendents = []
+        self.emails_pendents, self.telefons_pendents = set(), set()
+        self.creats = 0
+
+    def fila(self, index, user_data, usuari):
+        email = user_data.get("email")
+        telefon = user_data.get("telefon")
+        if (email is not None and email in self.emails_pendents) or (telefon and telefon in self.telefons_pendents):
+            self.inserir()
+        # Un email nul no coincideix amb cap altre (com el filtre email=None)
+        if email is not None and email in self.emails:
+            _error(self.error_details, index, email, "El email ja existeix")
+            return
+        if telefon and telefon in self.telefons:
+            _error(self.error_details, index, email, "El teléfon ja existeix")
+            return
+        # Com abans, el centre i el grup es creen encara que la fila falli després
+        if user_data.get("centre"):
+            self.noms_centres.add(user_data["centre"])
+        if user_data.get("grup"):
+            self.noms_grups.add(user_data["grup"])
+        if isinstance(usuari, Exception):
+            _error(self.error_details, index, user_data.get("email", "desconocido"), str(usuari))
+            return
+        self.pendents.append((index, usuari, user_data))
+        if email is not None:
+            self.emails_pendents.add(email)
+        if telefon:
+            self.telefons_pendents.add(telefon)
+        if len(self.pendents) >= _config("IMPORTACIO_LOT", 500):
+            self.inserir()
+
+    def inserir(self):
+        """Insereix les files pendents, en ordre."""
+        self.centres.update(_per_nom(Centre, self.noms_centres - self.centres.keys()))
+        self.grups.update(_per_nom(Grup, self.noms_grups - self.grups.keys()))
+        self.noms_centres, self.noms_grups = set(), set()
+
+        # Les files que fallaran (nom d'usuari repetit, email nul) es desen
+        # soles perquè rebin l'error de la base de dades; la resta, per lots
+        lot = []
+        for index, usuari, user_data in self.pendents:
+            usuari.centre = self.centres.get(user_data["centre"]) if user_data.get("centre") else None
+            usuari.grup = self.grups.get(user_data["grup"]) if user_data.get("grup") else None
+            if usuari.username in self.usernames or usuari.email is None:
+                self._inserir_lot(lot)
+                lot = []
+                self._inserir_un_a_un([(index, usuari, user_data)])
+            else:
+                self.usernames.add(usuari.username)
+                lot.append((index, usuari, user_data))
+        self._inserir_lot(lot)
+        self.pendents = []
+        self.emails_pendents, self.telefons_pendents = set(), set()
+
+    def _inserir_lot(self, lot):
+        if not lot:
+            return
+        try:
+            with transaction.atomic():
+                Usuari.objects.bulk_create([usuari for _, usuari, _ in lot])
+        except DatabaseError:
+            self._inserir_un_a_un(lot)
+            return
+        for _, usuari, _ in lot:
+            self._creat(usuari)
+
+    def _inserir_un_a_un(self, files):
+        for index, usuari, user_data in files:
+            try:
+                with transaction.atomic():
+                    usuari.save()
+            except Exception as e:
+                _error(self.error_details, index, user_data.get("email", "desconocido"), str(e))
+            else:
+                self._creat(usuari)
+
+    def _creat(self, usuari):
+        self.creats += 1
+        if usuari.email is not None:
+            self.emails.add(usuari.email)
+        if usuari.telefon:
+            self.telefons.add(usuari.telefon)
+
+
+def importar_usuaris(data, numeros_fila=None, preparacio=None):
+    """
+    Crea els usuaris de `data` (llista de diccionaris del CSV convertit a JSON).
+    Retorna (creats, errors, error_details) amb el mateix format que abans.
+    Si es passa `numeros_fila` (el de cada element), cada error l'inclou.
+    `preparacio` (Preparacio(data)) permet xifrar les contrasenyes abans
+    d'obrir la transacció de qui crida.
+    """
+    if preparacio is None:
+        preparacio = Preparacio(data)
+    error_details = []
+    importacio = _Importacio(preparacio, error_details)
+    with transaction.atomic():
+        for index, (user_data, usuari) in enumerate(zip(data, preparacio.usuaris)):
+            importacio.fila(index, user_data, usuari)
+        importacio.inserir()
+
+    error_details.sort(key=lambda e: e[0])
+    if numeros_fila is not None:
+        for index, detall in error_details:
+            detall["fila"] = numeros_fila[index]
+    error_details = [detall for _, detall in error_details]
+    return importacio.creats, len(error_details), error_details
+
+
+# Importació en segon pla de fitxers grans
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _pool():
+    # Una importació cada vegada: el xifratge ja fa servir tots els processadors
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="importacio")
+        return _executor
+
+
+def _directori():
+    return _config("IMPORTACIO_DIR", os.path.join(settings.BASE_DIR, "cache", "importacions"))
+
+
+def cami_errors(importacio):
+    return f"{importacio.fitxer}.errors.ndjson"
+
+
+def detectar_format(nom):
+    return "ndjson" if os.path.splitext(nom)[1].lower() in (".ndjson", ".jsonl") else "csv"
+
+
+def llegir_files(cami, format):
+    """
+    Genera (número de fila, dades) sense carregar el fitxer sencer. Les files
+    que no es poden interpretar es generen amb una ValueError com a dades.
+    """
+    with open(cami, encoding="utf-8-sig", newline="") as f:
+        if format == "ndjson":
+            for numero, linia in enumerate(f, start=1):
+                if not linia.strip():
+                    continue
+                try:
+                    dades = json.loads(linia)
+                    if not isinstance(dades, dict):
+                        raise ValueError("La fila no és un objecte JSON")
+                except ValueError as e:
+                    dades = ValueError(str(e))
+                yield numero, dades
+            return
+
+        mostra = f.read(4096)
+        f.seek(0)
+        try:
+            dialecte = csv.Sniffer().sniff(mostra, delimiters=",;\t")
+        except csv.Error:
+            dialecte = csv.excel
+        for numero, fila in enumerate(csv.DictReader(f, dialect=dialecte), start=1):
+            # Les columnes buides arriben com a "" igual que des del frontend
+            yield numero, {clau.strip(): (valor or "").strip() for clau, valor in fila.items() if clau}
+
+
+def crear_importacio(fitxer_pujat, format=None):
+    """Desa el fitxer pujat (per trossos) i encua la importació."""
+    os.makedirs(_directori(), exist_ok=True)
+    importacio = ImportacioUsuaris.objects.create(
+        fitxer="", format=format or detectar_format(fitxer_pujat.name)
+    )
+    cami = os.path.join(_directori(), f"usuaris-{importacio.pk}.{importacio.format}")
+    with open(cami, "wb") as desti:
+        for tros in fitxer_pujat.chunks():
+            desti.write(tros)
+    importacio.fitxer = cami
+    importacio.save(update_fields=["fitxer"])
+    transaction.on_commit(lambda: _pool().submit(_executar, importacio.pk))
+    return importacio
+
+
+def processar(importacio, progres=None):
+    """
+    Importa les files pendents des del darrer punt de control. `progres(importacio)`
+    es crida després de confirmar cada bloc.
+    """
+    if importacio.files_totals is None:
+        # Número de l'última fila (a NDJSON compten també les línies buides)
+        importacio.files_totals = max((numero for numero, _ in llegir_files(importacio.fitxer, importacio.format)), default=0)
+        importacio.save(update_fields=["files_totals", "actualitzat"])
+
+    mida_lot = _config("IMPORTACIO_LOT", 500)
+    cami = cami_errors(importacio)
+    with open(cami, "ab"):
+        pass
+    with open(cami, "r+b") as errors:
+        # Descartar els errors escrits per un bloc que no es va arribar a confirmar
+        errors.truncate(importacio.errors_bytes)
+        errors.seek(importacio.errors_bytes)
+
+        lot = []
+        for numero, dades in llegir_files(importacio.fitxer, importacio.format):
+            if numero <= importacio.files_processades:
+                continue
+            lot.append((numero, dades))
+            if len(lot) >= mida_lot:
+                _confirmar_lot(importacio, lot, errors)
+                lot = []
+                if progres:
+                    progres(importacio)
+        if lot:
+            _confirmar_lot(importacio, lot, errors)
+            if progres:
+                progres(importacio)
+
+    importacio.estat = "acabat"
+    importacio.save(update_fields=["estat", "actualitzat"])
+
+
+def _confirmar_lot(importacio, lot, errors):
+    """Importa un bloc i desa el punt de control en la mateixa transacció."""
+    valides = [(numero, dades) for numero, dades in lot if isinstance(dades, dict)]
+    detalls = [
+        {"email": "desconocido", "error": str(dades), "fila": numero}
+        for numero, dades in lot if not isinstance(dades, dict)
+    ]
+    dades_valides = [dades for _, dades in valides]
+    # Les contrasenyes es xifren abans d'obrir la transacció del bloc
+    preparacio = Preparacio(dades_valides)
+    with transaction.atomic():
+        creats, _, detalls_lot = importar_usuaris(
+            dades_valides, numeros_fila=[numero for numero, _ in valides], preparacio=preparacio
+        )
+        detalls = sorted(detalls + detalls_lot, key=lambda d: d["fila"])
+        for detall in detalls:
+            errors.write(json.dumps(detall, ensure_ascii=False).encode("utf-8") + b"\n")
+        errors.flush()
+        os.fsync(errors.fileno())
+
+        ImportacioUsuaris.objects.filter(pk=importacio.pk).update(
+            files_processades=lot[-1][0],
+            errors_bytes=errors.tell(),
+            creats=F("creats") + creats,
+            errors=F("errors") + len(detalls),
+            actualitzat=timezone.now(),
+        )
+    importacio.files_processades = lot[-1][0]
+    importacio.errors_bytes = errors.tell()
+    importacio.creats += creats
+    importacio.errors += len(detalls)
+
+
+def _executar(importacio_id):
+    try:
+        agafada = ImportacioUsuaris.objects.filter(pk=importacio_id, estat="pendent").update(
+            estat="en_curs", actualitzat=timezone.now()
+        )
+        if not agafada:
+            return
+        importacio = ImportacioUsuaris.objects.get(pk=importacio_id)
+        try:
+            processar(importacio)
+        except Exception as e:
+            ImportacioUsuaris.objects.filter(pk=importacio_id).update(
+                estat="error", error=str(e), actualitzat=timezone.now()
+            )
+            raise
+    except Exception:
+        logger.exception("Error a la importació d'usuaris %s", importacio_id)
+    finally:
+        connection.close()
+
+
+def _reprendre():
+    try:
+        limit = timezone.now() - timedelta(seconds=_config("IMPORTACIO_TIMEOUT", 600))
+        ImportacioUsuaris.objects.filter(estat="en_curs", actualitzat__lt=limit).update(
+            estat="pendent", actualitzat=timezone.now()
+        )
+        pendents = list(ImportacioUsuaris.objects.filter(estat="pendent").order_by("pk").values_list("pk", flat=True))
+    except Exception:
+        logger.exception("No s'han pogut recuperar les importacions pendents")
+        return
+    finally:
+        connection.close()
+    for importacio_id in pendents:
+        _pool().submit(_executar, importacio_id)
+
+
+def reprendre_pendents():
+    """Torna a encolar en segon pla les importacions pendents o abandonades."""
+    _pool().submit(_reprendre)
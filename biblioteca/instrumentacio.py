@@ -0,0 +1,209 @@
+"""
+Instrumentació per petició: consultes SQL, temps de base de dades i de Python.
+
+- InstrumentacioMiddleware només s'activa amb INSTRUMENTACIO; si no, Django
+  el treu de la cadena (MiddlewareNotUsed) i no costa res.
+- Cada consulta de la petició es cronometra amb connection.execute_wrapper. La
+  resposta porta una capçalera Server-Timing amb el temps de base de dades i el
+  nombre de consultes, el temps de Python, el total i les consultes més lentes.
+- Les peticions que passen de INSTRUMENTACIO_LLINDAR_MS s'escriuen, amb les
+  seves consultes (sense els paràmetres, que poden portar dades personals), al
+  logger `biblioteca.peticions_lentes`: a settings.LOGGING va a un fitxer
+  rotatiu.
+- Cada procés acumula estadístiques per ruta (peticions, errors, percentils
+  de les darreres INSTRUMENTACIO_MOSTRES peticions, consultes); l'endpoint
+  /api/instrumentacio/rutes les mostra al personal de la biblioteca.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger("biblioteca.peticions_lentes")
+
+SENSE_RUTA = "(sense ruta)"
+MAX_SQL_LOG = 200
+MAX_DESC = 80
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+def activa():
+    return _config("INSTRUMENTACIO", False)
+
+
+def llindar_ms():
+    return _config("INSTRUMENTACIO_LLINDAR_MS", 500)
+
+
+def _percentil(valors, p):
+    if not valors:
+        return 0.0
+    ordenats = sorted(valors)
+    return ordenats[min(len(ordenats) - 1, int(p * len(ordenats)))]
+
+
+class Cronometre:
+    """execute_wrapper que apunta (ms, sql) de cada consulta, en ordre."""
+
+    def __init__(self):
+        self.consultes = []
+
+    def __call__(self, execute, sql, params, many, context):
+        inici = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.consultes.append(((time.perf_counter() - inici) * 1000, sql))
+
+    @property
+    def total_ms(self):
+        return sum(ms for ms, _ in self.consultes)
+
+    def mes_lentes(self, n):
+        return sorted(self.consultes, key=lambda c: c[0], reverse=True)[:n]
+
+
+class EstadistiquesRuta:
+    def __init__(self, mostres):
+        self.peticions = 0
+        self.errors = 0
+        self.lentes = 0
+        self.total_ms = 0.0
+        self.db_ms = 0.0
+        self.consultes = 0
+        self.max_ms = 0.0
+        self.max_consultes = 0
+        self.durades = deque(maxlen=mostres)
+
+    def resum(self):
+        n = self.peticions or 1
+        return {
+            "peticions": self.peticions,
+            "errors": self.errors,
+            "lentes": self.lentes,
+            "p50_ms": round(_percentil(self.durades, 0.50), 2),
+            "p95_ms": round(_percentil(self.durades, 0.95), 2),
+            "max_ms": round(self.max_ms, 2),
+            "mitjana_db_ms": round(self.db_ms / n, 2),
+            "mitjana_python_ms": round((self.total_ms - self.db_ms) / n, 2),
+            "mitjana_consultes": round(self.consultes / n, 2),
+            "max_consultes": self.max_consultes,
+        }
+
+
+class Estadistiques:
+    """Estadístiques acumulades per ruta en aquest procés."""
+
+    def __init__(self, mostres=None):
+        self.mostres = mostres
+        self._lock = threading.Lock()
+        self._rutes = {}
+
+    def _mostres(self):
+        return self.mostres if self.mostres is not None else _config("INSTRUMENTACIO_MOSTRES", 1000)
+
+    def registrar(self, ruta, estat, total_ms, db_ms, consultes, lenta=False):
+        with self._lock:
+            ruta_ = self._rutes.get(ruta)
+            if ruta_ is None:
+                ruta_ = self._rutes[ruta] = EstadistiquesRuta(self._mostres())
+            ruta_.peticions += 1
+            ruta_.errors += estat >= 500
+            ruta_.lentes += lenta
+            ruta_.total_ms += total_ms
+            ruta_.db_ms += db_ms
+            ruta_.consultes += consultes
+            ruta_.max_ms = max(ruta_.max_ms, total_ms)
+            ruta_.max_consultes = max(ruta_.max_consultes, consultes)
+            ruta_.durades.append(total_ms)
+
+    def resum(self):
+        """Una fila per ruta, primer les que han ocupat més temps en total."""
+        with self._lock:
+            files = [(r.total_ms, {"ruta": ruta, **r.resum()}) for ruta, r in self._rutes.items()]
+        return [fila for _, fila in sorted(files, key=lambda f: f[0], reverse=True)]
+
+    def buidar(self):
+        with self._lock:
+            self._rutes.clear()
+
+
+estadistiques = Estadistiques()
+
+
+def ruta(request):
+    """Patró de la URL (sense els ids) amb el mètode, perquè les peticions s'agrupin."""
+    resolver_match = getattr(request, "resolver_match", None)
+    if resolver_match is None:
+        return f"{request.method} {SENSE_RUTA}"
+    return f"{request.method} /{resolver_match.route}"
+
+
+def _desc(text):
+    # Server-Timing: desc és una quoted-string ASCII d'una sola línia
+    text = " ".join(text.replace("\\", "").replace('"', "'").split())
+    text = text.encode("ascii", "replace").decode("ascii")
+    return text if len(text) <= MAX_DESC else text[:MAX_DESC - 3] + "..."
+
+
+def server_timing(cronometre, total_ms, consultes_lentes=3):
+    db_ms = cronometre.total_ms
+    entrades = [
+        f'db;dur={db_ms:.2f};desc="{len(cronometre.consultes)} consultes"',
+        f"python;dur={max(total_ms - db_ms, 0):.2f}",
+        f"total;dur={total_ms:.2f}",
+    ]
+    for i, (ms, sql) in enumerate(cronometre.mes_lentes(consultes_lentes), 1):
+        entrades.append(f'sql{i};dur={ms:.2f};desc="{_desc(sql)}"')
+    return ", ".join(entrades)
+
+
+class InstrumentacioMiddleware:
+    def __init__(self, get_response):
+        if not activa():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        # RotatingFileHandler no crea la carpeta del fitxer
+        for handler in logger.handlers:
+            fitxer = getattr(handler, "baseFilename", None)
+            if fitxer:
+                os.makedirs(os.path.dirname(fitxer), exist_ok=True)
+
+    def __call__(self, request):
+        cronometre = Cronometre()
+        inici = time.perf_counter()
+        with ExitStack() as pila:
+            for connexio in connections.all():
+                pila.enter_context(connexio.execute_wrapper(cronometre))
+            response = self.get_response(request)
+        total_ms = (time.perf_counter() - inici) * 1000
+
+        db_ms = cronometre.total_ms
+        ruta_ = ruta(request)
+        lenta = total_ms >= llindar_ms()
+        estadistiques.registrar(ruta_, response.status_code, total_ms, db_ms, len(cronometre.consultes), lenta)
+        response["Server-Timing"] = server_timing(
+            cronometre, total_ms, _config("INSTRUMENTACIO_CONSULTES_LENTES", 3)
+        )
+        if lenta:
+            logger.warning(json.dumps({
+                "ruta": ruta_,
+                "path": request.path,
+                "estat": response.status_code,
+                "total_ms": round(total_ms, 2),
+                "db_ms": round(db_ms, 2),
+                "python_ms": round(total_ms - db_ms, 2),
+                "consultes": len(cronometre.consultes),
+                "sql": [{"ms": round(ms, 2), "sql": sql} for ms, sql in cronometre.consultes[:MAX_SQL_LOG]],
+            }, ensure_ascii=False))
+        return response
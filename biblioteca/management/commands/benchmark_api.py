@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from biblioteca import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every API endpoint on a seeded test database (queries, p50/p95 latency, '
+            'peak memory) and compare with the committed baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Timed calls per endpoint (default: 20)')
+        parser.add_argument('--only', help='Only endpoints whose "METHOD /path" contains this text')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed latency and memory increase over the baseline (default: 0.5 = 50%%)')
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Write the results to the baseline file instead of failing on regressions')
+
+    def handle(self, *args, **options):
+        resultats = benchmark.executar(
+            repeticions=options['repeat'], filtre=options['only'],
+            sortida=self.stderr.write if options['verbosity'] > 1 else None,
+        )
+        baseline = benchmark.llegir_baseline()
+        files, regressions = benchmark.comparar(resultats, baseline, marge=options['tolerance'])
+        for linia in benchmark.taula(files):
+            self.stdout.write(linia)
+
+        if options['update_baseline']:
+            if options['only']:
+                resultats = {**baseline, **resultats}
+            benchmark.desar_baseline(resultats)
+            self.stdout.write(self.style.SUCCESS(f'Baseline written to {benchmark.BASELINE}'))
+        elif regressions:
+            raise CommandError(f'{len(regressions)} endpoints regressed: {", ".join(regressions)}')
+        else:
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
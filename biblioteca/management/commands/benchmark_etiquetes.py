@@ -0,0 +1,48 @@
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from biblioteca import etiquetes
+from biblioteca.models import Cataleg, Centre, Exemplar
+
+
+class Command(BaseCommand):
+    help = 'Compare the xhtml2pdf and ReportLab label renderers (CPU time and PDF size)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--etiquetes', type=int, nargs='+', default=[68, 680, 6800],
+                            help='Number of labels per run (two labels per exemplar)')
+        parser.add_argument('--renderers', nargs='+', default=list(etiquetes.RENDERITZADORS),
+                            choices=etiquetes.RENDERITZADORS, help='Renderers to compare')
+
+    def _exemplars(self, count):
+        # Objectes en memòria: el benchmark no depèn de les dades de la base de dades
+        centres = [Centre(id=i, nom=nom) for i, nom in enumerate(["IES Esteve Terradas i Illa", "IES Provençana"])]
+        return [
+            Exemplar(
+                id=i,
+                registre=f"EX-2025-{i:06d}",
+                centre=centres[i % len(centres)],
+                cataleg=Cataleg(id=i, titol=f"Títol {i}", CDU=f"{i % 1000:03d}"),
+            )
+            for i in range(1, count + 1)
+        ]
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'labels':>8} {'renderer':>10} {'pages':>6} {'cpu (s)':>9} {'wall (s)':>9} {'size (KB)':>10}")
+        with tempfile.TemporaryDirectory() as cache_dir, override_settings(ETIQUETES_CACHE_DIR=cache_dir):
+            for num_etiquetes in options['etiquetes']:
+                exemplars = self._exemplars(max(1, num_etiquetes // 2))
+                for renderer in options['renderers']:
+                    with tempfile.TemporaryFile() as desti:
+                        cpu = time.process_time()
+                        wall = time.perf_counter()
+                        pagines = etiquetes.escriure_pdf(exemplars, desti, renderer)
+                        cpu = time.process_time() - cpu
+                        wall = time.perf_counter() - wall
+                        mida = desti.tell() / 1024
+                    self.stdout.write(
+                        f"{num_etiquetes:>8} {renderer:>10} {pagines:>6} {cpu:>9.2f} {wall:>9.2f} {mida:>10.1f}"
+                    )
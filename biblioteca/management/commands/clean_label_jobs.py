@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import treballs
+
+
+class Command(BaseCommand):
+    help = 'Delete finished or failed label jobs older than ETIQUETES_TREBALL_CADUCITAT, and their PDFs'
+
+    def handle(self, *args, **options):
+        esborrats = treballs.netejar_caducats()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {esborrats} expired label jobs'))
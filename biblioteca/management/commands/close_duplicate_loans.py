@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import circulacio
+
+
+class Command(BaseCommand):
+    help = 'List exemplars with more than one active loan and optionally close all but the newest one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--close', action='store_true',
+                            help='Close the older loans on the day the newest one started (logged as WARNING)')
+
+    def handle(self, *args, **options):
+        duplicats = circulacio.prestecs_duplicats()
+        if not duplicats:
+            self.stdout.write(self.style.SUCCESS('No exemplar has more than one active loan'))
+            return
+        for exemplar_id, ids in duplicats.items():
+            self.stdout.write(f'Exemplar {exemplar_id}: active loans {", ".join(map(str, ids))} (newest first)')
+        if not options['close']:
+            self.stdout.write(self.style.WARNING(
+                f'{len(duplicats)} exemplars with duplicate active loans (run with --close to close the older ones)'
+            ))
+            return
+        tancats = circulacio.tancar_duplicats(usuari='close_duplicate_loans')
+        self.stdout.write(self.style.SUCCESS(f'Closed {len(tancats)} loans'))
@@ -0,0 +1,61 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from biblioteca import importacio as imp
+from biblioteca.models import ImportacioUsuaris
+
+
+class Command(BaseCommand):
+    help = 'Import users from a CSV or NDJSON file in committed chunks (resumable)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('fitxer', nargs='?', help='CSV or NDJSON file to import')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], help='Defaults to the file extension')
+        parser.add_argument('--resume', type=int, metavar='ID', help='Resume an interrupted import')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            importacio = self._reprendre(options['resume'])
+        elif options['fitxer']:
+            cami = os.path.abspath(options['fitxer'])
+            if not os.path.exists(cami):
+                raise CommandError(f'File not found: {cami}')
+            importacio = ImportacioUsuaris.objects.create(
+                fitxer=cami,
+                format=options['format'] or imp.detectar_format(cami),
+                estat='en_curs',
+            )
+            self.stdout.write(f'Import #{importacio.pk} (resume with --resume {importacio.pk})')
+        else:
+            raise CommandError('Pass a file or --resume ID')
+
+        try:
+            imp.processar(importacio, progres=self._progres)
+        except Exception as e:
+            ImportacioUsuaris.objects.filter(pk=importacio.pk).update(
+                estat='error', error=str(e), actualitzat=timezone.now()
+            )
+            raise
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {importacio.creats} users, {importacio.errors} errors '
+            f'(details in {imp.cami_errors(importacio)})'
+        ))
+
+    def _reprendre(self, importacio_id):
+        actualitzades = ImportacioUsuaris.objects.filter(
+            pk=importacio_id, estat__in=['pendent', 'en_curs', 'error']
+        ).update(estat='en_curs', error=None, actualitzat=timezone.now())
+        if not actualitzades:
+            raise CommandError(f'No import #{importacio_id} to resume')
+        importacio = ImportacioUsuaris.objects.get(pk=importacio_id)
+        self.stdout.write(f'Resuming import #{importacio.pk} after row {importacio.files_processades}')
+        return importacio
+
+    def _progres(self, importacio):
+        self.stdout.write(
+            f'  {importacio.files_processades}/{importacio.files_totals} rows, '
+            f'{importacio.creats} created, {importacio.errors} errors'
+        )
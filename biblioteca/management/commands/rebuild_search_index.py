@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import cerca
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of the catalogue'
+
+    def handle(self, *args, **options):
+        if not cerca.disponible():
+            self.stdout.write(self.style.WARNING(
+                'This database backend has no full-text index; searches use icontains'
+            ))
+            return
+
+        total = cerca.reconstruir_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {total} catalogue items'))
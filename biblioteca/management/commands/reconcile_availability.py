@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from biblioteca import disponibilitat
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-centre availability counters of the catalogue and repair any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Catalogue items checked per transaction (default: 1000)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many counters are wrong')
+
+    def handle(self, *args, **options):
+        reparar = not options['dry_run']
+        incorrectes = disponibilitat.reconciliar(mida_lot=options['batch_size'], reparar=reparar)
+        if not incorrectes:
+            self.stdout.write(self.style.SUCCESS('All availability counters are correct'))
+        elif reparar:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {incorrectes} availability counters'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{incorrectes} availability counters are wrong'))
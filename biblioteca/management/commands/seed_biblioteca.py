@@ -1,555 +1,701 @@
+"""
+Càrrega massiva de dades de prova.
+
+- Les dades es generen per lots de MIDA_LOT elements. Cada lot té el seu propi
+  random.Random i Faker amb una llavor derivada de --seed, de manera que la
+  mateixa llavor dona sempre el mateix conjunt de dades.
+- Els lots es generen en un grup de --workers processos (Faker és el coll
+  d'ampolla). Els resultats es recullen en l'ordre dels lots, i el procés
+  principal els va inserint a mesura que arriben: el resultat és el mateix
+  amb qualsevol nombre de processos.
+- Els ids i els números de registre s'assignen en memòria (el registre es
+  reserva en bloc al comptador), en rangs consecutius i disjunts per a cada
+  lot, i cada lot s'insereix amb bulk_create i es confirma tot seguit.
+- bulk_create no admet l'herència multitaula: es creen les files de Cataleg
+  amb bulk_create (amb el tipus ja fixat) i les de la taula filla (Llibre,
+  CD...) amb un INSERT directe. Préstecs i reserves també s'insereixen així
+  perquè auto_now_add no substitueixi les dates generades.
+- --scale tria la mida del conjunt; qualsevol opció explícita la sobreescriu.
+- Totes les dates es calculen a partir de --data-referencia (per defecte
+  DATA_REFERENCIA si hi ha --seed, i avui si no n'hi ha), no del dia en què
+  s'executa: la mateixa llavor dona les mateixes dades qualsevol dia.
+"""
+import hashlib
+import os
+import random
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+
+from django.contrib.auth.hashers import make_password
 from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
 from django.utils import timezone
-import random
 from faker import Faker
-from datetime import time, timedelta, datetime
 from tqdm import tqdm
+
+from biblioteca import cerca, disponibilitat
 from biblioteca.models import (
-    Pais, Llengua, Categoria, 
-    Llibre, Revista, CD, DVD, BR, Dispositiu, 
-    Exemplar, Centre, Grup, Usuari, Prestec, Reserva
+    Pais, Llengua, Categoria, Cataleg, Imatge,
+    Llibre, Revista, CD, DVD, BR, Dispositiu,
+    Exemplar, Comptador, DisponibilitatExemplars, Centre, Grup, Usuari, Prestec, Reserva
 )
 
+MIDA_LOT = 1000
+# Data de referència per defecte amb --seed
+DATA_REFERENCIA = date(2025, 6, 1)
+AUTORS_PER_LOT = 100
+
+ESCALES = {
+    # ~1.400 elements, ~7.000 exemplars (els valors per defecte de sempre)
+    'small': dict(autors=100, revistes=200, cds=80, dvds=60, brs=40, dispositius=20,
+                  usuaris=300, prestecs=300, reservas=100),
+    # ~14.000 elements, ~70.000 exemplars
+    'medium': dict(autors=1000, revistes=2000, cds=800, dvds=600, brs=400, dispositius=200,
+                   usuaris=3000, prestecs=10000, reservas=3000),
+    # ~140.000 elements, ~700.000 exemplars
+    'large': dict(autors=10000, revistes=20000, cds=8000, dvds=6000, brs=4000, dispositius=2000,
+                  usuaris=30000, prestecs=100000, reservas=30000),
+    # ~420.000 elements, ~2.100.000 exemplars
+    'xl': dict(autors=30000, revistes=60000, cds=24000, dvds=18000, brs=12000, dispositius=6000,
+               usuaris=100000, prestecs=1000000, reservas=300000),
+}
+
+CENTRES = [
+    "IES Esteve Terradas i Illa",
+    "IES Provençana",
+    "IES La Guineueta",
+    "IES Anna Gironella de Mundet",
+    "IES Mare de Déu de la Mercè"
+]
+LLENGUES = ["Català", "Castellà", "Anglès", "Francès", "Alemany"]
+PAISOS = ["Catalunya", "Espanya", "Estats Units", "Regne Unit", "França", "Alemanya", "Itàlia"]
+CATEGORIES = ["Literatura", "Ciència", "Tecnologia", "Història", "Art", "Música", "Cinema", "Informàtica"]
+SUBCATEGORIES = [
+    ("Novel·la", "Literatura"), ("Poesia", "Literatura"), ("Teatre", "Literatura"),
+    ("Física", "Ciència"), ("Química", "Ciència"), ("Biologia", "Ciència"),
+    ("Programació", "Informàtica"), ("Xarxes", "Informàtica"), ("Seguretat", "Informàtica"),
+    ("Rock", "Música"), ("Clàssica", "Música"), ("Jazz", "Música"),
+    ("Drama", "Cinema"), ("Comèdia", "Cinema"), ("Acció", "Cinema"),
+]
+
+MUSIC_STYLES = ["Rock", "Pop", "Jazz", "Clàssica", "Electrònica", "Hip-Hop", "Folk", "Blues", "Metal", "Indie"]
+RECORD_LABELS = ["Sony Music", "Universal Music", "Warner Music", "EMI", "Columbia Records", "Capitol Records",
+                 "Atlantic Records", "Merge Records", "Sub Pop", "Matador Records"]
+PRODUCTION_COMPANIES = ["Universal Pictures", "Warner Bros.", "20th Century Studios", "Paramount Pictures",
+                        "Sony Pictures", "Walt Disney Pictures", "Metro-Goldwyn-Mayer", "DreamWorks",
+                        "Focus Features", "A24"]
+DEVICE_BRANDS = ["Apple", "Samsung", "Sony", "Microsoft", "Lenovo", "Dell", "HP", "ASUS", "Acer", "Xiaomi"]
+DEVICE_TYPES = ["Portàtil", "Tauleta", "Lector de llibres electrònics", "Càmera", "Reproductor MP3",
+                "Auriculars", "Televisor", "Consola", "Ratolí", "Teclat"]
+
+# Camps propis de cada subclasse (a més de cataleg_ptr)
+CAMPS_FILLS = {
+    Llibre: ['ISBN', 'editorial', 'colleccio', 'lloc', 'pais', 'llengua', 'pagines'],
+    Revista: ['ISSN', 'editorial', 'lloc', 'pais', 'llengua', 'numero', 'pagines'],
+    CD: ['discografica', 'estil', 'duracio'],
+    DVD: ['productora', 'duracio'],
+    BR: ['productora', 'duracio'],
+    Dispositiu: ['marca', 'model'],
+}
+MODELS_TIPUS = {model._meta.model_name: model for model in CAMPS_FILLS}
+
+
+def llavor(seed, *claus):
+    """Llavor derivada i estable (no depèn de PYTHONHASHSEED) per a un lot."""
+    text = ":".join(str(c) for c in (seed,) + claus)
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+
+
+class Generador:
+    """random.Random i Faker que es tornen a sembrar a cada lot (un per procés)."""
+
+    def __init__(self):
+        self.fake = Faker('es_ES')
+        self.fake_en = Faker('en_US')  # Para títulos originales en inglés
+
+    def sembrar(self, seed):
+        self.rng = random.Random(seed)
+        self.fake.seed_instance(seed)
+        self.fake_en.seed_instance(seed + 1)
+        return self
+
+
+_generador = None
+
+
+def generador(seed):
+    global _generador
+    if _generador is None:
+        _generador = Generador()
+    return _generador.sembrar(seed)
+
+
+# Generació (sense base de dades, s'executa als processos del grup). Cada
+# element és un dict amb el tipus, els camps de Cataleg i de la subclasse, els
+# ids de les categories i els exemplars.
+
+def _cdu(rng):
+    return f"{rng.randint(0, 9)}{rng.randint(0, 99):02d}"
+
+
+def _data(g, referencia, dies):
+    """Data a l'atzar dels `dies` dies anteriors a la data de referència."""
+    return g.fake.date_between(start_date=referencia - timedelta(days=dies), end_date=referencia)
+
+
+def _exemplars(g, count, ctx):
+    # (any, exclos_prestec, baixa, centre) per a cada exemplar
+    any_actual = ctx['data_referencia'].year
+    return [
+        (g.rng.randint(2000, any_actual), g.rng.random() < 0.2, g.rng.random() < 0.1, g.rng.choice(ctx['centres']))
+        for _ in range(count)
+    ]
+
+
+def _categoria(ctx, nom):
+    return ctx['categories_per_nom'].get(nom)
+
+
+def _subcategories(ctx, pare):
+    return [cat_id for cat_id, nom, nom_pare in ctx['categories'] if nom_pare == pare]
+
+
+def _tags_tematics(g, ctx, pare):
+    principal = _categoria(ctx, pare)
+    if principal is None:
+        return [g.rng.choice(ctx['categories'])[0] for _ in range(g.rng.randint(1, 2))]
+    tags = [principal]
+    subs = _subcategories(ctx, pare)
+    if subs and g.rng.random() > 0.5:
+        tags.append(g.rng.choice(subs))
+    return tags
+
+
+def _llibre(g, ctx, autor):
+    rng, fake, fake_en = g.rng, g.fake, g.fake_en
+    return {
+        'tipus': 'llibre',
+        'cataleg': dict(
+            titol=fake.catch_phrase(),
+            titol_original=fake_en.catch_phrase() if rng.random() > 0.7 else None,
+            autor=autor,
+            CDU=_cdu(rng),
+            signatura=f"L-{rng.randint(100, 999)}",
+            data_edicio=_data(g, ctx['data_referencia'], 70 * 365),
+            resum=fake.paragraph(nb_sentences=5),
+            anotacions=fake.paragraph(nb_sentences=2) if rng.random() > 0.7 else None,
+            mides=f"{rng.randint(15, 30)} x {rng.randint(10, 25)} cm",
+        ),
+        'fill': dict(
+            ISBN=f"978{rng.randint(1000000000, 9999999999)}",
+            editorial=fake.company(),
+            colleccio=fake.word().capitalize() + " " + fake.word() if rng.random() > 0.6 else None,
+            lloc=fake.city(),
+            pais=rng.choice(ctx['paisos']),
+            llengua=rng.choice(ctx['llengues']),
+            pagines=rng.randint(50, 800),
+        ),
+        # 2-3 categories a l'atzar
+        'tags': [rng.choice(ctx['categories'])[0] for _ in range(rng.randint(2, 3))],
+        # Sempre 4-6 exemplars per llibre
+        'exemplars': _exemplars(g, rng.randint(4, 6), ctx),
+    }
+
+
+def _revista(g, ctx, editorials):
+    rng, fake, fake_en = g.rng, g.fake, g.fake_en
+    return {
+        'tipus': 'revista',
+        'cataleg': dict(
+            titol=fake.catch_phrase(),
+            titol_original=fake_en.catch_phrase() if rng.random() > 0.8 else None,
+            autor=fake.name() if rng.random() > 0.1 else None,
+            CDU=_cdu(rng),
+            signatura=f"R-{rng.randint(100, 999)}",
+            data_edicio=_data(g, ctx['data_referencia'], 40 * 365),
+            resum=fake.paragraph(nb_sentences=3),
+            anotacions=fake.paragraph(nb_sentences=1) if rng.random() > 0.8 else None,
+            mides=f"{rng.randint(15, 30)} x {rng.randint(10, 25)} cm",
+        ),
+        'fill': dict(
+            ISSN=f"{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}",
+            editorial=rng.choice(editorials),
+            lloc=fake.city(),
+            pais=rng.choice(ctx['paisos']),
+            llengua=rng.choice(ctx['llengues']),
+            numero=rng.randint(1, 100),
+            pagines=rng.randint(20, 150),
+        ),
+        'tags': [rng.choice(ctx['categories'])[0] for _ in range(rng.randint(2, 3))],
+        'exemplars': _exemplars(g, rng.randint(1, ctx['exemplars']), ctx),
+    }
+
+
+def _cd(g, ctx):
+    rng, fake = g.rng, g.fake
+    # Entre 30 i 75 minuts
+    total_minutes = rng.randint(30, 75)
+    duracio = time(hour=total_minutes // 60, minute=total_minutes % 60, second=rng.randint(0, 59))
+    return {
+        'tipus': 'cd',
+        'cataleg': dict(
+            titol=fake.sentence(nb_words=3)[:-1],  # Album title
+            titol_original=fake.sentence(nb_words=3)[:-1] if rng.random() > 0.8 else None,
+            autor=fake.name() if rng.random() > 0.1 else None,  # Artist name
+            CDU=_cdu(rng),
+            signatura=f"CD-{rng.randint(100, 999)}",
+            data_edicio=_data(g, ctx['data_referencia'], 30 * 365),
+            resum=fake.paragraph(nb_sentences=2) if rng.random() > 0.6 else None,
+            anotacions=fake.paragraph(nb_sentences=1) if rng.random() > 0.8 else None,
+            mides="12 cm" if rng.random() > 0.5 else None,
+        ),
+        'fill': dict(discografica=rng.choice(RECORD_LABELS), estil=rng.choice(MUSIC_STYLES), duracio=duracio),
+        'tags': _tags_tematics(g, ctx, "Música"),
+        'exemplars': _exemplars(g, ctx['exemplars'], ctx),
+    }
+
+
+def _pellicula(g, ctx, tipus, anys):
+    rng, fake = g.rng, g.fake
+    duracio = time(hour=rng.randint(1, 3), minute=rng.randint(0, 59), second=0)
+    return {
+        'tipus': tipus,
+        'cataleg': dict(
+            titol=fake.sentence(nb_words=4)[:-1],  # Movie title
+            titol_original=fake.sentence(nb_words=4)[:-1] if rng.random() > 0.6 else None,
+            autor=fake.name() if rng.random() > 0.1 else None,  # Director
+            CDU=_cdu(rng),
+            signatura=f"{tipus.upper()}-{rng.randint(100, 999)}",
+            data_edicio=_data(g, ctx['data_referencia'], anys * 365),
+            resum=fake.paragraph(nb_sentences=3) if rng.random() > 0.4 else None,
+            anotacions=fake.paragraph(nb_sentences=1) if rng.random() > 0.7 else None,
+            mides="12 cm" if rng.random() > 0.5 else None,
+        ),
+        'fill': dict(productora=rng.choice(PRODUCTION_COMPANIES), duracio=duracio),
+        'tags': _tags_tematics(g, ctx, "Cinema"),
+        'exemplars': _exemplars(g, ctx['exemplars'], ctx),
+    }
+
+
+def _dispositiu(g, ctx):
+    rng, fake = g.rng, g.fake
+    brand = rng.choice(DEVICE_BRANDS)
+    device_type = rng.choice(DEVICE_TYPES)
+    model = f"{brand} {device_type} {rng.choice(['Pro', 'Lite', 'Plus', 'Max', 'Ultra', ''])}"
+
+    tecnologia = _categoria(ctx, "Tecnologia")
+    if tecnologia is not None:
+        tags = [tecnologia]
+        if device_type in ["Portàtil", "Tauleta"] and _categoria(ctx, "Informàtica") is not None:
+            tags.append(_categoria(ctx, "Informàtica"))
+    else:
+        tags = [rng.choice(ctx['categories'])[0] for _ in range(rng.randint(1, 2))]
+
+    return {
+        'tipus': 'dispositiu',
+        'cataleg': dict(
+            titol=f"{brand} {device_type}",
+            titol_original=None,
+            autor=None,
+            CDU=_cdu(rng),
+            signatura=f"D-{rng.randint(100, 999)}",
+            data_edicio=_data(g, ctx['data_referencia'], 10 * 365),
+            resum=fake.paragraph(nb_sentences=2) if rng.random() > 0.5 else None,
+            anotacions=fake.paragraph(nb_sentences=1) if rng.random() > 0.7 else None,
+            mides=f"{rng.randint(10, 40)} x {rng.randint(5, 30)} x {rng.randint(1, 5)} cm" if rng.random() > 0.3 else None,
+        ),
+        'fill': dict(marca=brand, model=model if rng.random() > 0.1 else None),
+        'tags': tags,
+        'exemplars': _exemplars(g, ctx['exemplars'], ctx),
+    }
+
+
+def generar_llibres(seed, lot, autors, ctx):
+    g = generador(llavor(seed, 'llibres', lot))
+    items = []
+    for _ in range(autors):
+        autor = g.fake.name()
+        for _ in range(g.rng.randint(ctx['min_llibres'], ctx['max_llibres'])):
+            items.append(_llibre(g, ctx, autor))
+    return items
+
+
+def generar_items(seed, tipus, lot, quantitat, ctx):
+    if tipus == 'revista':
+        # El mateix grup de 20 editorials per a totes les revistes
+        g = generador(llavor(seed, 'editorials'))
+        editorials = [g.fake.company() for _ in range(20)]
+    g = generador(llavor(seed, tipus, lot))
+    if tipus == 'revista':
+        return [_revista(g, ctx, editorials) for _ in range(quantitat)]
+    if tipus == 'cd':
+        return [_cd(g, ctx) for _ in range(quantitat)]
+    if tipus == 'dvd':
+        return [_pellicula(g, ctx, 'dvd', 25) for _ in range(quantitat)]
+    if tipus == 'br':
+        return [_pellicula(g, ctx, 'br', 15) for _ in range(quantitat)]
+    return [_dispositiu(g, ctx) for _ in range(quantitat)]
+
+
+def generar_usuaris(seed, lot, quantitat, ctx):
+    g = generador(llavor(seed, 'usuaris', lot))
+    rng, fake = g.rng, g.fake
+    files = []
+    for _ in range(quantitat):
+        files.append(dict(
+            first_name=fake.first_name(),
+            last_name=fake.last_name(),
+            email=fake.email(),
+            centre=rng.choice(ctx['centres']) if ctx['centres'] else None,
+            grup=rng.choice(ctx['grups']) if ctx['grups'] else None,
+            telefon=f"6{rng.randint(10000000, 99999999)}",
+        ))
+    return files
+
+
+def generar_prestecs(seed, lot, quantitat, usuaris, disponibles, referencia):
+    # Índexs dins dels usuaris i exemplars disponibles creats
+    g = generador(llavor(seed, 'prestecs', lot))
+    rng, fake = g.rng, g.fake
+    files = []
+    for _ in range(quantitat):
+        start_date = _data(g, referencia, 182)
+        # 70% ja retornats
+        end_date = fake.date_between(start_date=start_date, end_date=referencia) if rng.random() < 0.7 else None
+        files.append((
+            rng.randrange(usuaris), rng.randrange(disponibles), start_date, end_date,
+            fake.text(max_nb_chars=100) if rng.random() > 0.8 else None,
+        ))
+    return files
+
+
+def generar_reserves(seed, lot, quantitat, usuaris, disponibles, referencia):
+    g = generador(llavor(seed, 'reserves', lot))
+    return [
+        (g.rng.randrange(usuaris), g.rng.randrange(disponibles), _data(g, referencia, 30))
+        for _ in range(quantitat)
+    ]
+
+
+def lots(total, mida):
+    """(índex, quantitat) de cada lot."""
+    return [(i, min(mida, total - inici)) for i, inici in enumerate(range(0, total, mida))]
+
+
+def _cridar(tasca):
+    funcio, args = tasca
+    return funcio(*args)
+
+
+def en_ordre(pool, funcio, tasques, finestra):
+    """
+    Resultat de funcio(*args) per a cada tasca, en l'ordre de les tasques.
+    Com a molt hi ha `finestra` lots generats esperant: si la base de dades
+    va més lenta que els processos, no s'acumulen tots a memòria.
+    """
+    if pool is None:
+        for args in tasques:
+            yield funcio(*args)
+        return
+    pendents = deque()
+    for args in tasques:
+        pendents.append(pool.submit(_cridar, (funcio, args)))
+        if len(pendents) >= finestra:
+            yield pendents.popleft().result()
+    while pendents:
+        yield pendents.popleft().result()
+
+
+# Escriptura
+
+def inserir_files(model, camps, files):
+    """INSERT directe, per lots, dels valors de `camps` de cada fila."""
+    if not files:
+        return
+    fields = [model._meta.get_field(camp) for camp in camps]
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join(qn(f.column) for f in fields),
+        ", ".join(["%s"] * len(fields)),
+    )
+    with connection.cursor() as cursor:
+        for inici in range(0, len(files), MIDA_LOT):
+            cursor.executemany(sql, [
+                [f.get_db_prep_save(valor, connection) for f, valor in zip(fields, fila)]
+                for fila in files[inici:inici + MIDA_LOT]
+            ])
+
+
+def seguent_id(model):
+    return (model.objects.aggregate(maxim=Max('id'))['maxim'] or 0) + 1
+
+
 class Command(BaseCommand):
-    help = 'Seed database with sample data for all catalog types'
+    help = 'Seed database with sample data for all catalog types (bulk loader)'
 
     def add_arguments(self, parser):
-        parser.add_argument('--autors', type=int, default=100, help='Number of authors to create')
-        parser.add_argument('--usuaris', type=int, default=300, help='Number of users to create')
+        parser.add_argument('--scale', choices=list(ESCALES), default='small',
+                            help='Dataset size preset (explicit counts below override it)')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for a reproducible dataset')
+        parser.add_argument('--data-referencia', type=date.fromisoformat, default=None,
+                            help='Date (YYYY-MM-DD) all generated dates are relative to '
+                                 f'(default {DATA_REFERENCIA} with --seed, today without)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Processes generating data (1 generates in this process)')
+        parser.add_argument('--autors', type=int, help='Number of authors to create')
+        parser.add_argument('--usuaris', type=int, help='Number of users to create')
         parser.add_argument('--min-llibres', type=int, default=8, help='Minimum books per author')
         parser.add_argument('--max-llibres', type=int, default=12, help='Maximum books per author')
-        parser.add_argument('--revistes', type=int, default=200, help='Number of magazines to create')
-        parser.add_argument('--cds', type=int, default=80, help='Number of CDs to create')
-        parser.add_argument('--dvds', type=int, default=60, help='Number of DVDs to create')
-        parser.add_argument('--brs', type=int, default=40, help='Number of Blu-rays to create')
-        parser.add_argument('--dispositius', type=int, default=20, help='Number of devices to create')
+        parser.add_argument('--revistes', type=int, help='Number of magazines to create')
+        parser.add_argument('--cds', type=int, help='Number of CDs to create')
+        parser.add_argument('--dvds', type=int, help='Number of DVDs to create')
+        parser.add_argument('--brs', type=int, help='Number of Blu-rays to create')
+        parser.add_argument('--dispositius', type=int, help='Number of devices to create')
         parser.add_argument('--exemplars', type=int, default=5, help='Average number of copies per catalog item')
         parser.add_argument('--delete', action='store_true', help='Delete existing data before creating new objects')
-        parser.add_argument('--prestecs', type=int, default=300, help='Number of loans to create')
-        parser.add_argument('--reservas', type=int, default=100, help='Number of reservations to create')
+        parser.add_argument('--prestecs', type=int, help='Number of loans to create')
+        parser.add_argument('--reservas', type=int, help='Number of reservations to create')
 
     def handle(self, *args, **options):
-        fake = Faker(['es_ES'])
-        fake_en = Faker(['en_US']) # Para títulos originales en inglés
-        
+        for nom, valor in ESCALES[options['scale']].items():
+            if options[nom] is None:
+                options[nom] = valor
+        if options['seed'] is not None:
+            seed = options['seed']
+            referencia = options['data_referencia'] or DATA_REFERENCIA
+        else:
+            seed = random.randrange(2 ** 32)
+            referencia = options['data_referencia'] or date.today()
+        self.stdout.write(f"Seed: {seed} (scale {options['scale']}, reference date {referencia})")
+
         # Always delete existing data
         self._delete_existing_data()
-        
-        # Get or create initial data
-        llengues, paisos, categories = self._setup_initial_data(fake)
-        
-        # Create authors first
-        autors = self._create_autors(fake, options['autors'])
-        
-        # Create catalog items by author
-        for autor in autors:
-            num_llibres = random.randint(options['min_llibres'], options['max_llibres'])
-            self._create_llibres_for_autor(fake, fake_en, autor, num_llibres, llengues, paisos, categories, options['exemplars'])
-        
-        # Create other catalog items
-        self._create_revistes(fake, fake_en, options['revistes'], llengues, paisos, categories, options['exemplars'])
-        self._create_cds(fake, options['cds'], categories, options['exemplars'])
-        self._create_dvds(fake, options['dvds'], categories, options['exemplars'])
-        self._create_brs(fake, options['brs'], categories, options['exemplars'])
-        self._create_dispositius(fake, options['dispositius'], categories, options['exemplars'])
-        
-        # Create users
-        self._create_users(fake, options['usuaris'])
-
-        # Create loans and reservations
-        self._create_prestecs(fake, options['prestecs'])
-        self._create_reservas(fake, options['reservas'])
+
+        ctx = self._setup_initial_data()
+        ctx.update(exemplars=options['exemplars'], min_llibres=options['min_llibres'],
+                   max_llibres=options['max_llibres'], data_referencia=referencia)
+        self.seguent_cataleg = seguent_id(Cataleg)
+        self.seguent_exemplar = seguent_id(Exemplar)
+        self.disponibles = array('q')  # Exemplars que es poden prestar
+
+        workers = max(1, options['workers'])
+        self.finestra = workers * 2
+        self.pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            self._create_cataleg(seed, options, ctx)
+            usuaris = self._create_users(seed, options['usuaris'], ctx)
+            self._create_prestecs(seed, options['prestecs'], usuaris, referencia)
+            self._create_reservas(seed, options['reservas'], usuaris, referencia)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+
+        self._reset_sequences()
+        # Els exemplars s'insereixen sense senyals: els comptadors es calculen al final
+        self.stdout.write("Computing availability counters...")
+        disponibilitat.reconciliar()
+        if cerca.disponible():
+            self.stdout.write("Rebuilding search index...")
+            cerca.reconstruir_index()
 
         self.stdout.write(self.style.SUCCESS('Successfully seeded database'))
 
-    def _setup_initial_data(self, fake):
-        # Create specific centres
+    def _setup_initial_data(self):
         if Centre.objects.count() == 0:
-            centres = [
-                "IES Esteve Terradas i Illa",
-                "IES Provençana",
-                "IES La Guineueta",
-                "IES Anna Gironella de Mundet",
-                "IES Mare de Déu de la Mercè"
-            ]
-            for nom in centres:
-                Centre.objects.create(nom=nom)
-        
-        # Create languages if none exist
+            Centre.objects.bulk_create([Centre(nom=nom) for nom in CENTRES])
         if Llengua.objects.count() == 0:
-            llengues = [
-                Llengua.objects.create(nom="Català"),
-                Llengua.objects.create(nom="Castellà"),
-                Llengua.objects.create(nom="Anglès"),
-                Llengua.objects.create(nom="Francès"),
-                Llengua.objects.create(nom="Alemany")
-            ]
-        else:
-            llengues = list(Llengua.objects.all())
-        
-        # Create countries if none exist
+            Llengua.objects.bulk_create([Llengua(nom=nom) for nom in LLENGUES])
         if Pais.objects.count() == 0:
-            paisos = [
-                Pais.objects.create(nom="Catalunya"),
-                Pais.objects.create(nom="Espanya"),
-                Pais.objects.create(nom="Estats Units"),
-                Pais.objects.create(nom="Regne Unit"),
-                Pais.objects.create(nom="França"),
-                Pais.objects.create(nom="Alemanya"),
-                Pais.objects.create(nom="Itàlia")
-            ]
-        else:
-            paisos = list(Pais.objects.all())
-        
-        # Create categories if none exist
+            Pais.objects.bulk_create([Pais(nom=nom) for nom in PAISOS])
         if Categoria.objects.count() == 0:
-            # Main categories
-            literatura = Categoria.objects.create(nom="Literatura")
-            ciencia = Categoria.objects.create(nom="Ciència")
-            tecnologia = Categoria.objects.create(nom="Tecnologia")
-            historia = Categoria.objects.create(nom="Història")
-            art = Categoria.objects.create(nom="Art")
-            musica = Categoria.objects.create(nom="Música")
-            cinema = Categoria.objects.create(nom="Cinema")
-            informatica = Categoria.objects.create(nom="Informàtica")
-            
-            # Subcategories
-            Categoria.objects.create(nom="Novel·la", parent=literatura)
-            Categoria.objects.create(nom="Poesia", parent=literatura)
-            Categoria.objects.create(nom="Teatre", parent=literatura)
-            Categoria.objects.create(nom="Física", parent=ciencia)
-            Categoria.objects.create(nom="Química", parent=ciencia)
-            Categoria.objects.create(nom="Biologia", parent=ciencia)
-            Categoria.objects.create(nom="Programació", parent=informatica)
-            Categoria.objects.create(nom="Xarxes", parent=informatica)
-            Categoria.objects.create(nom="Seguretat", parent=informatica)
-            Categoria.objects.create(nom="Rock", parent=musica)
-            Categoria.objects.create(nom="Clàssica", parent=musica)
-            Categoria.objects.create(nom="Jazz", parent=musica)
-            Categoria.objects.create(nom="Drama", parent=cinema)
-            Categoria.objects.create(nom="Comèdia", parent=cinema)
-            Categoria.objects.create(nom="Acció", parent=cinema)
-        
-        categories = list(Categoria.objects.all())
-        return llengues, paisos, categories
+            for nom in CATEGORIES:
+                Categoria.objects.create(nom=nom)
+            pares = dict(Categoria.objects.values_list('nom', 'id'))
+            Categoria.objects.bulk_create([Categoria(nom=nom, parent_id=pares[pare]) for nom, pare in SUBCATEGORIES])
+
+        # Només ids i noms, ordenats, perquè la generació sigui reproduïble
+        categories = list(Categoria.objects.order_by('id').values_list('id', 'nom', 'parent__nom'))
+        return {
+            'centres': list(Centre.objects.order_by('id').values_list('id', flat=True)),
+            'grups': list(Grup.objects.order_by('id').values_list('id', flat=True)),
+            'llengues': list(Llengua.objects.order_by('id').values_list('id', flat=True)),
+            'paisos': list(Pais.objects.order_by('id').values_list('id', flat=True)),
+            'categories': categories,
+            'categories_per_nom': {nom: cat_id for cat_id, nom, _ in categories},
+        }
+
+    def _generar(self, funcio, tasques):
+        return en_ordre(self.pool, funcio, tasques, self.finestra)
+
+    def _create_cataleg(self, seed, options, ctx):
+        autors = lots(options['autors'], AUTORS_PER_LOT)
+        with tqdm(total=options['autors'], desc="Creating books") as pbar:
+            tasques = [(seed, lot, quantitat, ctx) for lot, quantitat in autors]
+            for (_, quantitat), items in zip(autors, self._generar(generar_llibres, tasques)):
+                self._desar_items(items)
+                pbar.update(quantitat)
+
+        for tipus, opcio, desc in [('revista', 'revistes', "magazines"), ('cd', 'cds', "CDs"),
+                                   ('dvd', 'dvds', "DVDs"), ('br', 'brs', "Blu-rays"),
+                                   ('dispositiu', 'dispositius', "devices")]:
+            with tqdm(total=options[opcio], desc=f"Creating {desc}") as pbar:
+                tasques = [(seed, tipus, lot, quantitat, ctx) for lot, quantitat in lots(options[opcio], MIDA_LOT)]
+                for items in self._generar(generar_items, tasques):
+                    self._desar_items(items)
+                    pbar.update(len(items))
 
     def _delete_existing_data(self):
         """Delete all existing data before seeding"""
         self.stdout.write("Deleting existing data...")
-        # Delete related models first to avoid integrity errors
-        Prestec.objects.all().delete()
-        Reserva.objects.all().delete()
-        Exemplar.objects.all().delete()
-        Dispositiu.objects.all().delete()
-        BR.objects.all().delete()
-        DVD.objects.all().delete()
-        CD.objects.all().delete()
-        Revista.objects.all().delete()
-        Llibre.objects.all().delete()
+        # DELETE directe: amb milions de files el col·lector de Django les
+        # carregaria totes per enviar senyals (l'índex es reconstrueix al final)
+        qn = connection.ops.quote_name
+        subclasses = "SELECT id FROM %s WHERE tipus <> 'indefinit'" % qn(Cataleg._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            Prestec.objects.all().delete()
+            Reserva.objects.all().delete()
+            Imatge.objects.exclude(cataleg__tipus='indefinit').delete()
+            cursor.execute("DELETE FROM %s" % qn(DisponibilitatExemplars._meta.db_table))
+            cursor.execute("DELETE FROM %s" % qn(Exemplar._meta.db_table))
+            cursor.execute("DELETE FROM %s WHERE cataleg_id IN (%s)" % (
+                qn(Cataleg.tags.through._meta.db_table), subclasses))
+            for model in CAMPS_FILLS:
+                cursor.execute("DELETE FROM %s" % qn(model._meta.db_table))
+            cursor.execute("DELETE FROM %s WHERE tipus <> 'indefinit'" % qn(Cataleg._meta.db_table))
+            # Ja no queda cap exemplar: la numeració torna a començar
+            Comptador.objects.filter(nom='registre').update(valor=0)
         # Also delete users except superusers
         Usuari.objects.filter(is_superuser=False).delete()
         self.stdout.write(self.style.SUCCESS("All existing data deleted"))
 
-    def _create_autors(self, fake, count):
-        autors = []
-        for _ in range(count):
-            autor = {
-                'nom': fake.name(),
-                'nacionalitat': fake.country(),
-                'data_naixement': fake.date_of_birth(minimum_age=20, maximum_age=100)
-            }
-            autors.append(autor)
-        return autors
-
-    def _create_llibres_for_autor(self, fake, fake_en, autor, num_llibres, llengues, paisos, categories, exemplars_count):
-        with tqdm(total=num_llibres, desc=f"Creating books for author {autor['nom']}") as pbar:
-            for _ in range(num_llibres):
-                data_edicio = fake.date_between(
-                    start_date='-70y',
-                    end_date='today'
-                )
-                
-                titol = fake.catch_phrase()
-                titol_original = fake_en.catch_phrase() if random.random() > 0.7 else None
-                
-                # Create a book with complete data
-                llibre = Llibre.objects.create(
-                    titol=titol,
-                    titol_original=titol_original,
-                    autor=autor['nom'],
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"L-{random.randint(100, 999)}",
-                    data_edicio=data_edicio,
-                    resum=fake.paragraph(nb_sentences=5),
-                    anotacions=fake.paragraph(nb_sentences=2) if random.random() > 0.7 else None,
-                    mides=f"{random.randint(15, 30)} x {random.randint(10, 25)} cm",
-                    ISBN=f"978{random.randint(1000000000, 9999999999)}",
-                    editorial=fake.company(),
-                    colleccio=fake.word().capitalize() + " " + fake.word() if random.random() > 0.6 else None,
-                    lloc=fake.city(),
-                    pais=random.choice(paisos),
-                    llengua=random.choice(llengues),
-                    pagines=random.randint(50, 800)
-                )
-                
-                # Add random categories (2-3)
-                for _ in range(random.randint(2, 3)):
-                    llibre.tags.add(random.choice(categories))
-                
-                # Ensure 4-6 exemplars per book
-                real_exemplars = random.randint(4, 6)
-                self._create_exemplars(llibre, real_exemplars)
-                pbar.update(1)
-
-    def _create_revistes(self, fake, fake_en, count, llengues, paisos, categories, exemplars_count):
-        with tqdm(total=count, desc="Creating magazines") as pbar:
-            editorials = [fake.company() for _ in range(20)]  # Create a pool of publishers
-            
-            for _ in range(count):
-                data_edicio = fake.date_between(start_date='-40y', end_date='today')
-                editorial = random.choice(editorials)
-                
-                revista = Revista.objects.create(
-                    titol=fake.catch_phrase(),
-                    titol_original=fake_en.catch_phrase() if random.random() > 0.8 else None,
-                    autor=fake.name() if random.random() > 0.1 else None,
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"R-{random.randint(100, 999)}",
-                    data_edicio=data_edicio,
-                    resum=fake.paragraph(nb_sentences=3),
-                    anotacions=fake.paragraph(nb_sentences=1) if random.random() > 0.8 else None,
-                    mides=f"{random.randint(15, 30)} x {random.randint(10, 25)} cm",
-                    ISSN=f"{random.randint(1000, 9999)}-{random.randint(1000, 9999)}",
-                    editorial=editorial,
-                    lloc=fake.city(),
-                    pais=random.choice(paisos),
-                    llengua=random.choice(llengues),
-                    numero=random.randint(1, 100),
-                    pagines=random.randint(20, 150)
-                )
-                
-                # Add categories (2-3)
-                for _ in range(random.randint(2, 3)):
-                    revista.tags.add(random.choice(categories))
-                
-                # Create exemplars
-                self._create_exemplars(revista, random.randint(1, exemplars_count))
-                pbar.update(1)
-
-    def _create_cds(self, fake, count, categories, exemplars_count):
-        with tqdm(total=count, desc="Creating CDs") as pbar:
-            music_styles = ["Rock", "Pop", "Jazz", "Clàssica", "Electrònica", "Hip-Hop", "Folk", "Blues", "Metal", "Indie"]
-            record_labels = ["Sony Music", "Universal Music", "Warner Music", "EMI", "Columbia Records", "Capitol Records", 
-                            "Atlantic Records", "Merge Records", "Sub Pop", "Matador Records"]
-            
-            for _ in range(count):
-                # Create random duration between 30min and 75min - FIXED to handle durations > 60 minutes
-                total_minutes = random.randint(30, 75)
-                hours = total_minutes // 60
-                minutes = total_minutes % 60
-                seconds = random.randint(0, 59)
-                
-                # Now both hours and minutes are in valid ranges
-                duration = time(hour=hours, minute=minutes, second=seconds)
-                
-                # Create a CD
-                cd = CD.objects.create(
-                    titol=fake.sentence(nb_words=3)[:-1],  # Album title
-                    titol_original=fake.sentence(nb_words=3)[:-1] if random.random() > 0.8 else None,
-                    autor=fake.name() if random.random() > 0.1 else None,  # Artist name
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"CD-{random.randint(100, 999)}",
-                    data_edicio=fake.date_between(start_date='-30y', end_date='today'),
-                    resum=fake.paragraph(nb_sentences=2) if random.random() > 0.6 else None,
-                    anotacions=fake.paragraph(nb_sentences=1) if random.random() > 0.8 else None,
-                    mides="12 cm" if random.random() > 0.5 else None,  # Standard CD size
-                    # CD specific fields
-                    discografica=random.choice(record_labels),
-                    estil=random.choice(music_styles),
-                    duracio=duration
-                )
-                
-                # Add random categories (1-2)
-                music_category = next((c for c in categories if c.nom == "Música"), None)
-                if music_category:
-                    cd.tags.add(music_category)
-                    
-                    # Try to add a music subcategory if available
-                    music_subcategories = [c for c in categories if c.parent and c.parent.nom == "Música"]
-                    if music_subcategories and random.random() > 0.5:
-                        cd.tags.add(random.choice(music_subcategories))
-                else:
-                    # Fallback to random categories
-                    for _ in range(random.randint(1, 2)):
-                        cd.tags.add(random.choice(categories))
-                
-                # Create exemplars for the CD
-                self._create_exemplars(cd, exemplars_count)
-                pbar.update(1)
-            
-            self.stdout.write(f"Created {count} CDs")
-
-    def _create_dvds(self, fake, count, categories, exemplars_count):
-        with tqdm(total=count, desc="Creating DVDs") as pbar:
-            production_companies = ["Universal Pictures", "Warner Bros.", "20th Century Studios", "Paramount Pictures", 
-                                "Sony Pictures", "Walt Disney Pictures", "Metro-Goldwyn-Mayer", "DreamWorks", 
-                                "Focus Features", "A24"]
-            
-            for _ in range(count):
-                # Create random duration between 1h and 3h59m
-                hours = random.randint(1, 3)
-                minutes = random.randint(0, 59)
-                seconds = 0
-                
-                duration = time(hour=hours, minute=minutes, second=seconds)
-                
-                # Create a DVD
-                dvd = DVD.objects.create(
-                    titol=fake.sentence(nb_words=4)[:-1],  # Movie title
-                    titol_original=fake.sentence(nb_words=4)[:-1] if random.random() > 0.6 else None,
-                    autor=fake.name() if random.random() > 0.1 else None,  # Director
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"DVD-{random.randint(100, 999)}",
-                    data_edicio=fake.date_between(start_date='-25y', end_date='today'),
-                    resum=fake.paragraph(nb_sentences=3) if random.random() > 0.4 else None,
-                    anotacions=fake.paragraph(nb_sentences=1) if random.random() > 0.7 else None,
-                    mides="12 cm" if random.random() > 0.5 else None,  # Standard DVD size
-                    # DVD specific fields
-                    productora=random.choice(production_companies),
-                    duracio=duration
-                )
-                
-                # Add random categories (1-2)
-                cinema_category = next((c for c in categories if c.nom == "Cinema"), None)
-                if cinema_category:
-                    dvd.tags.add(cinema_category)
-                    
-                    # Try to add a cinema subcategory if available
-                    cinema_subcategories = [c for c in categories if c.parent and c.parent.nom == "Cinema"]
-                    if cinema_subcategories and random.random() > 0.5:
-                        dvd.tags.add(random.choice(cinema_subcategories))
-                else:
-                    # Fallback to random categories
-                    for _ in range(random.randint(1, 2)):
-                        dvd.tags.add(random.choice(categories))
-                
-                # Create exemplars for the DVD
-                self._create_exemplars(dvd, exemplars_count)
-                pbar.update(1)
-            
-            self.stdout.write(f"Created {count} DVDs")
-
-    def _create_brs(self, fake, count, categories, exemplars_count):
-        with tqdm(total=count, desc="Creating Blu-rays") as pbar:
-            production_companies = ["Universal Pictures", "Warner Bros.", "20th Century Studios", "Paramount Pictures", 
-                                "Sony Pictures", "Walt Disney Pictures", "Metro-Goldwyn-Mayer", "DreamWorks", 
-                                "Focus Features", "A24"]
-            
-            for _ in range(count):
-                # Create random duration between 1h30m and 3h30m (typical for Blu-rays)
-                hours = random.randint(1, 3)
-                minutes = random.randint(0, 59)
-                seconds = 0
-                
-                duration = time(hour=hours, minute=minutes, second=seconds)
-                
-                # Create a Blu-ray
-                br = BR.objects.create(
-                    titol=fake.sentence(nb_words=4)[:-1],  # Movie title
-                    titol_original=fake.sentence(nb_words=4)[:-1] if random.random() > 0.6 else None,
-                    autor=fake.name() if random.random() > 0.1 else None,  # Director
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"BR-{random.randint(100, 999)}",
-                    data_edicio=fake.date_between(start_date='-15y', end_date='today'),  # Blu-rays are newer
-                    resum=fake.paragraph(nb_sentences=3) if random.random() > 0.4 else None,
-                    anotacions=fake.paragraph(nb_sentences=1) if random.random() > 0.7 else None,
-                    mides="12 cm" if random.random() > 0.5 else None,  # Standard Blu-ray size
-                    # BR specific fields
-                    productora=random.choice(production_companies),
-                    duracio=duration
-                )
-                
-                # Add random categories (1-2)
-                cinema_category = next((c for c in categories if c.nom == "Cinema"), None)
-                if cinema_category:
-                    br.tags.add(cinema_category)
-                    
-                    # Try to add a cinema subcategory if available
-                    cinema_subcategories = [c for c in categories if c.parent and c.parent.nom == "Cinema"]
-                    if cinema_subcategories and random.random() > 0.5:
-                        br.tags.add(random.choice(cinema_subcategories))
-                else:
-                    # Fallback to random categories
-                    for _ in range(random.randint(1, 2)):
-                        br.tags.add(random.choice(categories))
-                
-                # Create exemplars for the Blu-ray
-                self._create_exemplars(br, exemplars_count)
-                pbar.update(1)
-            
-            self.stdout.write(f"Created {count} Blu-rays")
-
-    def _create_dispositius(self, fake, count, categories, exemplars_count):
-        with tqdm(total=count, desc="Creating devices") as pbar:
-            device_brands = ["Apple", "Samsung", "Sony", "Microsoft", "Lenovo", "Dell", "HP", "ASUS", "Acer", "Xiaomi"]
-            device_types = ["Portàtil", "Tauleta", "Lector de llibres electrònics", "Càmera", "Reproductor MP3", 
-                        "Auriculars", "Televisor", "Consola", "Ratolí", "Teclat"]
-            
-            for i in range(count):
-                brand = random.choice(device_brands)
-                device_type = random.choice(device_types)
-                model = f"{brand} {device_type} {random.choice(['Pro', 'Lite', 'Plus', 'Max', 'Ultra', ''])}"
-                
-                # Create a device
-                dispositiu = Dispositiu.objects.create(
-                    titol=f"{brand} {device_type}",
-                    titol_original=None,  # Devices typically don't have original titles
-                    autor=None,  # Devices don't have authors
-                    CDU=f"{random.randint(0, 9)}{random.randint(0, 99):02d}",
-                    signatura=f"D-{random.randint(100, 999)}",
-                    data_edicio=fake.date_between(start_date='-10y', end_date='today'),  # Modern devices
-                    resum=fake.paragraph(nb_sentences=2) if random.random() > 0.5 else None,
-                    anotacions=fake.paragraph(nb_sentences=1) if random.random() > 0.7 else None,
-                    mides=f"{random.randint(10, 40)} x {random.randint(5, 30)} x {random.randint(1, 5)} cm" if random.random() > 0.3 else None,
-                    # Dispositiu specific fields
-                    marca=brand,
-                    model=model if random.random() > 0.1 else None
+    def _desar_items(self, items):
+        """Desa un lot d'elements del catàleg amb els seus exemplars i categories."""
+        Through = Cataleg.tags.through
+        total_exemplars = sum(len(item['exemplars']) for item in items)
+
+        with transaction.atomic():
+            registre = Exemplar.reservar_registres(total_exemplars) if total_exemplars else 0
+            pares, fills, tags, exemplars = [], {}, [], []
+            for item in items:
+                cataleg_id = self.seguent_cataleg
+                self.seguent_cataleg += 1
+                pares.append(Cataleg(id=cataleg_id, tipus=item['tipus'], **item['cataleg']))
+                model = MODELS_TIPUS[item['tipus']]
+                fills.setdefault(model, []).append(
+                    [cataleg_id] + [item['fill'][camp] for camp in CAMPS_FILLS[model]]
                 )
-                
-                # Add random categories (1-2)
-                tech_category = next((c for c in categories if c.nom == "Tecnologia"), None)
-                if tech_category:
-                    dispositiu.tags.add(tech_category)
-                    
-                    # Try to add an informatics subcategory if available and relevant
-                    if device_type in ["Portàtil", "Tauleta"]:
-                        info_category = next((c for c in categories if c.nom == "Informàtica"), None)
-                        if info_category:
-                            dispositiu.tags.add(info_category)
-                else:
-                    # Fallback to random categories
-                    for _ in range(random.randint(1, 2)):
-                        dispositiu.tags.add(random.choice(categories))
-                
-                # Create exemplars for the device
-                self._create_exemplars(dispositiu, exemplars_count)
-                pbar.update(1)
-            
-            self.stdout.write(f"Created {count} devices")
-
-    def _create_exemplars(self, cataleg_item, count):
-        """Create a specific number of exemplars (copies) for a catalog item"""
-        from django.db.models import Max
-        import re
-
-        # Get all centres or create default if none exist
-        centres = list(Centre.objects.all())
-        if not centres:
-            centres = [Centre.objects.create(nom="IES Esteve Terradas i Illa")]
-
-        # Obtener el último número global ya usado (ignorando el año)
-        exemplars = Exemplar.objects.only('registre')
-        max_num = 0
-        for exemplar in exemplars:
-            match = re.match(r'EX-\d{4}-(\d{6})', exemplar.registre)
-            if match:
-                numero = int(match.group(1))
-                if numero > max_num:
-                    max_num = numero
-
-        for i in range(count):
-            max_num += 1
-            year = random.randint(2000, datetime.now().year)
-            registre = f'EX-{year}-{max_num:06d}'
-
-            exclos_prestec = random.random() < 0.2  # 20% excluded from loans
-            baixa = random.random() < 0.1  # 10% out of circulation
-
-            Exemplar.objects.create(
-                cataleg=cataleg_item,
-                registre=registre,
-                exclos_prestec=exclos_prestec,
-                baixa=baixa,
-                centre=random.choice(centres)
-            )
-
-
-    def _create_users(self, fake, count):
+                # Com tags.add(), una categoria repetida només s'afegeix una vegada
+                for categoria_id in dict.fromkeys(item['tags']):
+                    tags.append(Through(cataleg_id=cataleg_id, categoria_id=categoria_id))
+                for year, exclos_prestec, baixa, centre_id in item['exemplars']:
+                    exemplars.append(Exemplar(
+                        id=self.seguent_exemplar,
+                        cataleg_id=cataleg_id,
+                        registre=Exemplar.format_registre(registre, year),
+                        exclos_prestec=exclos_prestec,
+                        baixa=baixa,
+                        centre_id=centre_id,
+                    ))
+                    if not exclos_prestec and not baixa:
+                        self.disponibles.append(self.seguent_exemplar)
+                    self.seguent_exemplar += 1
+                    registre += 1
+
+            Cataleg.objects.bulk_create(pares, batch_size=MIDA_LOT)
+            for model, files in fills.items():
+                inserir_files(model, ['cataleg_ptr'] + CAMPS_FILLS[model], files)
+            Through.objects.bulk_create(tags, batch_size=MIDA_LOT)
+            Exemplar.objects.bulk_create(exemplars, batch_size=MIDA_LOT)
+
+    def _create_users(self, seed, count, ctx):
+        """Crea els usuaris i retorna la llista dels seus ids."""
+        # Tots amb la mateixa contrasenya: es xifra una sola vegada
+        password = make_password('password123')
+        alta = timezone.make_aware(datetime.combine(ctx['data_referencia'], time.min))
+        primer = seguent_id(Usuari)
+        ids = []
         with tqdm(total=count, desc="Creating users") as pbar:
-            centres = Centre.objects.all()
-            grups = Grup.objects.all()
-            
-            for _ in range(count):
-                first_name = fake.first_name()
-                last_name = fake.last_name()
-                email = fake.email()
-                username = f"{first_name[0].lower()}{last_name.lower()}{random.randint(1,99)}"
-                
-                user = Usuari.objects.create(
-                    username=username,
-                    email=email,
-                    first_name=first_name,
-                    last_name=last_name,
-                    is_active=True,
-                    centre=random.choice(centres) if centres else None,
-                    grup=random.choice(grups) if grups else None,
-                    telefon=f"6{random.randint(10000000, 99999999)}"
-                )
-                user.set_password('password123')  # Set a default password
-                user.save()
-                pbar.update(1)
+            tasques = [(seed, lot, quantitat, ctx) for lot, quantitat in lots(count, MIDA_LOT)]
+            for generats in self._generar(generar_usuaris, tasques):
+                usuaris = []
+                for dades in generats:
+                    usuari_id = primer + len(ids)
+                    ids.append(usuari_id)
+                    usuaris.append(Usuari(
+                        id=usuari_id,
+                        # L'id fa únic el nom d'usuari encara que es repeteixin noms
+                        username=f"{dades['first_name'][0].lower()}{dades['last_name'].lower()}{usuari_id}",
+                        email=dades['email'],
+                        first_name=dades['first_name'],
+                        last_name=dades['last_name'],
+                        is_active=True,
+                        centre_id=dades['centre'],
+                        grup_id=dades['grup'],
+                        telefon=dades['telefon'],
+                        password=password,
+                        date_joined=alta,
+                    ))
+                with transaction.atomic():
+                    Usuari.objects.bulk_create(usuaris, batch_size=MIDA_LOT)
+                pbar.update(len(usuaris))
+        return ids
 
-    def _create_prestecs(self, fake, count):
+    def _create_prestecs(self, seed, count, usuaris, referencia):
         """Create random loans"""
-        self.stdout.write("Creating loans...")
-        users = list(Usuari.objects.all())
-        available_exemplars = list(Exemplar.objects.filter(exclos_prestec=False, baixa=False))
-
-        if not users or not available_exemplars:
+        if not usuaris or not self.disponibles:
             self.stdout.write(self.style.WARNING('No users or available exemplars for loans'))
             return
-
+        primer = seguent_id(Prestec)
         with tqdm(total=count, desc="Creating loans") as pbar:
-            for _ in range(count):
-                user = random.choice(users)
-                exemplar = random.choice(available_exemplars)
-                
-                # Random date in the last 6 months
-                start_date = fake.date_between(start_date='-6m', end_date='today')
-                
-                # 70% chance of being returned
-                if random.random() < 0.7:
-                    end_date = fake.date_between(start_date=start_date, end_date='today')
-                else:
-                    end_date = None
-
-                Prestec.objects.create(
-                    usuari=user,
-                    exemplar=exemplar,
-                    data_prestec=start_date,
-                    data_retorn=end_date,
-                    anotacions=fake.text(max_nb_chars=100) if random.random() > 0.8 else None
-                )
-                pbar.update(1)
+            tasques = [(seed, lot, quantitat, len(usuaris), len(self.disponibles), referencia)
+                       for lot, quantitat in lots(count, MIDA_LOT)]
+            actius = set()
+            for lot, generats in enumerate(self._generar(generar_prestecs, tasques)):
+                # Cada lot té el rang d'ids [primer + lot * MIDA_LOT, ...)
+                files, prestats = [], []
+                for i, (u, e, inici, retorn, anotacions) in enumerate(generats):
+                    exemplar = self.disponibles[e]
+                    if retorn is None:
+                        # Només un préstec actiu per exemplar (prestec_actiu_per_exemplar)
+                        if exemplar in actius:
+                            retorn = inici
+                        else:
+                            actius.add(exemplar)
+                            prestats.append(exemplar)
+                    files.append((primer + lot * MIDA_LOT + i, usuaris[u], exemplar, inici, retorn, anotacions))
+                with transaction.atomic():
+                    inserir_files(Prestec, ['id', 'usuari', 'exemplar', 'data_prestec', 'data_retorn', 'anotacions'], files)
+                    # Com circulacio.prestar: l'exemplar prestat queda exclòs de préstec
+                    # (els comptadors de disponibilitat es calculen al final)
+                    Exemplar.objects.filter(id__in=prestats).update(exclos_prestec=True)
+                pbar.update(len(files))
 
-    def _create_reservas(self, fake, count):
+    def _create_reservas(self, seed, count, usuaris, referencia):
         """Create random reservations"""
-        self.stdout.write("Creating reservations...")
-        users = list(Usuari.objects.all())
-        exemplars = list(Exemplar.objects.filter(exclos_prestec=False, baixa=False))
-
-        if not users or not exemplars:
+        if not usuaris or not self.disponibles:
             self.stdout.write(self.style.WARNING('No users or exemplars for reservations'))
             return
-
+        primer = seguent_id(Reserva)
         with tqdm(total=count, desc="Creating reservations") as pbar:
-            for _ in range(count):
-                user = random.choice(users)
-                exemplar = random.choice(exemplars)
-                
-                Reserva.objects.create(
-                    usuari=user,
-                    exemplar=exemplar,
-                    data=fake.date_between(start_date='-1m', end_date='today')
-                )
-                pbar.update(1)
\ No newline at end of file
+            tasques = [(seed, lot, quantitat, len(usuaris), len(self.disponibles), referencia)
+                       for lot, quantitat in lots(count, MIDA_LOT)]
+            for lot, generats in enumerate(self._generar(generar_reserves, tasques)):
+                files = [
+                    (primer + lot * MIDA_LOT + i, usuaris[u], self.disponibles[e], data)
+                    for i, (u, e, data) in enumerate(generats)
+                ]
+                with transaction.atomic():
+                    inserir_files(Reserva, ['id', 'usuari', 'exemplar', 'data'], files)
+                pbar.update(len(files))
+
+    def _reset_sequences(self):
+        # Els ids s'han fixat a mà: PostgreSQL ha d'avançar les seqüències
+        models = [Cataleg, Cataleg.tags.through, Exemplar, Usuari, Prestec, Reserva]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
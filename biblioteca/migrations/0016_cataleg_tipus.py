@@ -0,0 +1,28 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+def omplir_tipus(apps, schema_editor):
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    for tipus in ('llibre', 'revista', 'cd', 'dvd', 'br', 'dispositiu'):
+        Subclasse = apps.get_model('biblioteca', tipus)
+        Cataleg.objects.filter(
+            id__in=Subclasse.objects.values('cataleg_ptr_id')
+        ).update(tipus=tipus)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0015_alter_exemplar_registre'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cataleg',
+            name='tipus',
+            field=models.CharField(choices=[('indefinit', 'Indefinit'), ('llibre', 'Llibre'), ('revista', 'Revista'), ('cd', 'CD'), ('dvd', 'DVD'), ('br', 'BR'), ('dispositiu', 'Dispositiu')], db_index=True, default='indefinit', editable=False, max_length=20),
+        ),
+        migrations.RunPython(omplir_tipus, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,83 @@
+import unicodedata
+from collections import defaultdict
+
+from django.db import migrations
+
+# Còpia de l'esquema de biblioteca/cerca.py en el moment d'aquesta migració:
+# la migració no ha de canviar si més endavant canvia el mòdul.
+TAULA = "biblioteca_cataleg_fts"
+CAMPS = ("titol", "titol_original", "autor", "resum", "editorial", "isbn", "tags")
+PESOS_BM25 = (10.0, 5.0, 8.0, 1.0, 3.0, 3.0, 2.0)
+PESOS_PG = ("A", "B", "A", "D", "C", "C", "C")
+MIDA_LOT = 500
+
+
+def normalitzar(text):
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def documents(Cataleg, ids):
+    tags = defaultdict(list)
+    for cataleg_id, nom in Cataleg.objects.filter(id__in=ids).values_list("id", "tags__nom"):
+        if nom:
+            tags[cataleg_id].append(nom)
+    files = Cataleg.objects.filter(id__in=ids).values_list(
+        "id", "titol", "titol_original", "autor", "resum", "llibre__editorial", "llibre__ISBN"
+    )
+    return [
+        [fila[0]] + [normalitzar(v) for v in fila[1:]] + [normalitzar(" ".join(tags[fila[0]]))]
+        for fila in files
+    ]
+
+
+def crear_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {TAULA} USING fts5({', '.join(CAMPS)}, "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        )
+        pesos = ", ".join(str(p) for p in PESOS_BM25)
+        schema_editor.execute(f"INSERT INTO {TAULA}({TAULA}, rank) VALUES ('rank', 'bm25({pesos})')")
+        sql = f"INSERT INTO {TAULA}(rowid, {', '.join(CAMPS)}) VALUES (%s, {', '.join(['%s'] * len(CAMPS))})"
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE TABLE {TAULA} ("
+            f"cataleg_id bigint PRIMARY KEY REFERENCES biblioteca_cataleg(id) "
+            f"ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            f"document tsvector NOT NULL)"
+        )
+        schema_editor.execute(f"CREATE INDEX {TAULA}_document ON {TAULA} USING GIN (document)")
+        document = " || ".join(f"setweight(to_tsvector('simple', %s), '{pes}')" for pes in PESOS_PG)
+        sql = f"INSERT INTO {TAULA}(cataleg_id, document) VALUES (%s, {document})"
+    else:
+        return
+
+    Cataleg = apps.get_model('biblioteca', 'Cataleg')
+    darrer = 0
+    while True:
+        ids = list(Cataleg.objects.filter(id__gt=darrer).order_by("id").values_list("id", flat=True)[:MIDA_LOT])
+        if not ids:
+            break
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(sql, documents(Cataleg, ids))
+        darrer = ids[-1]
+
+
+def eliminar_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {TAULA}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0016_cataleg_tipus'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_index, eliminar_index),
+    ]
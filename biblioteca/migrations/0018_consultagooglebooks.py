@@ -0,0 +1,26 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0017_cataleg_fts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsultaGoogleBooks',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clau', models.CharField(max_length=255, unique=True)),
+                ('resultats', models.JSONField(default=list)),
+                ('creat', models.DateTimeField()),
+                ('darrer_us', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Consultes Google Books',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0018_consultagooglebooks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreballEtiquetes',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('clau', models.CharField(db_index=True, max_length=64)),
+                ('exemplar_ids', models.JSONField()),
+                ('renderer', models.CharField(default='xhtml2pdf', max_length=20)),
+                ('estat', models.CharField(choices=[('pendent', 'Pendent'), ('en_curs', 'En curs'), ('acabat', 'Acabat'), ('error', 'Error')], db_index=True, default='pendent', max_length=10)),
+                ('pagines_fetes', models.IntegerField(default=0)),
+                ('pagines_totals', models.IntegerField(default=0)),
+                ('fitxer', models.CharField(blank=True, max_length=255, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('creat', models.DateTimeField(auto_now_add=True)),
+                ('actualitzat', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': "Treballs d'etiquetes",
+            },
+        ),
+    ]
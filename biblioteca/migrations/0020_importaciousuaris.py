@@ -0,0 +1,36 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:37
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0019_treballetiquetes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportacioUsuaris',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('codi', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('fitxer', models.CharField(max_length=255)),
+                ('format', models.CharField(choices=[('csv', 'CSV'), ('ndjson', 'NDJSON')], max_length=10)),
+                ('estat', models.CharField(choices=[('pendent', 'Pendent'), ('en_curs', 'En curs'), ('acabat', 'Acabat'), ('error', 'Error')], db_index=True, default='pendent', max_length=10)),
+                ('files_totals', models.IntegerField(blank=True, null=True)),
+                ('files_processades', models.IntegerField(default=0)),
+                ('errors_bytes', models.BigIntegerField(default=0)),
+                ('creats', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('creat', models.DateTimeField(auto_now_add=True)),
+                ('actualitzat', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': "Importacions d'usuaris",
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:40
+
+import re
+
+from django.db import migrations, models
+
+
+def inicialitzar_registre(apps, schema_editor):
+    Comptador = apps.get_model('biblioteca', 'Comptador')
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    registres = Exemplar.objects.filter(registre__regex=r'^EX-\d{4}-\d{6}$').values_list('registre', flat=True)
+    valor = max((int(re.match(r'EX-\d{4}-(\d{6})', r).group(1)) for r in registres.iterator()), default=0)
+    Comptador.objects.update_or_create(nom='registre', defaults={'valor': valor})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0020_importaciousuaris'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Comptador',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nom', models.CharField(max_length=50, unique=True)),
+                ('valor', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Comptadors',
+            },
+        ),
+        migrations.RunPython(inicialitzar_registre, migrations.RunPython.noop),
+    ]
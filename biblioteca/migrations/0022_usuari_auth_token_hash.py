@@ -0,0 +1,29 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:50
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def xifrar_tokens(apps, schema_editor):
+    # Els tokens ja emesos continuen sent vàlids: es desa el seu hash
+    Usuari = apps.get_model('biblioteca', 'Usuari')
+    for usuari in Usuari.objects.exclude(auth_token__isnull=True).exclude(auth_token='').only('id', 'auth_token'):
+        usuari.auth_token = hashlib.sha256(usuari.auth_token.encode('utf-8')).hexdigest()
+        usuari.save(update_fields=['auth_token'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0021_comptador'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usuari',
+            name='auth_token',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(xifrar_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.18 on 2026-10-18 13:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0022_usuari_auth_token_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenRevocat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(max_length=32, unique=True)),
+                ('caduca', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Tokens revocats',
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Q
+
+
+def calcular_disponibilitat(apps, schema_editor):
+    # Comptadors inicials a partir dels exemplars existents
+    Exemplar = apps.get_model('biblioteca', 'Exemplar')
+    DisponibilitatExemplars = apps.get_model('biblioteca', 'DisponibilitatExemplars')
+    comptes = Exemplar.objects.order_by().values('cataleg_id', 'centre_id').annotate(
+        disponible=Count('id', filter=Q(exclos_prestec=False, baixa=False)),
+        exclos_prestec=Count('id', filter=Q(exclos_prestec=True, baixa=False)),
+        baixa=Count('id', filter=Q(baixa=True)),
+    )
+    DisponibilitatExemplars.objects.bulk_create(
+        (DisponibilitatExemplars(**c) for c in comptes.iterator()), batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0023_tokenrevocat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DisponibilitatExemplars',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('disponible', models.IntegerField(default=0)),
+                ('exclos_prestec', models.IntegerField(default=0)),
+                ('baixa', models.IntegerField(default=0)),
+                ('cataleg', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='disponibilitats', to='biblioteca.cataleg')),
+                ('centre', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='biblioteca.centre')),
+            ],
+            options={
+                'verbose_name_plural': "Disponibilitat d'exemplars",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='disponibilitatexemplars',
+            constraint=models.UniqueConstraint(fields=('cataleg', 'centre'), name='disponibilitat_cataleg_centre'),
+        ),
+        migrations.RunPython(calcular_disponibilitat, migrations.RunPython.noop),
+    ]
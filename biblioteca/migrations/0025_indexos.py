@@ -0,0 +1,64 @@
+# Generated by Django 4.2.18 on 2026-10-18 14:07
+
+from django.db import migrations, models
+
+
+def comprovar_prestecs_duplicats(apps, schema_editor):
+    # La restricció no es pot crear si algun exemplar té més d'un préstec
+    # actiu. La migració no en tanca cap: ho ha de revisar algú
+    Prestec = apps.get_model('biblioteca', 'Prestec')
+    repetits = list(
+        Prestec.objects.filter(data_retorn__isnull=True).values('exemplar_id')
+        .annotate(n=models.Count('id')).filter(n__gt=1)
+        .order_by('exemplar_id').values_list('exemplar_id', flat=True)
+    )
+    if repetits:
+        mostra = ", ".join(str(exemplar_id) for exemplar_id in repetits[:50])
+        raise RuntimeError(
+            f"{len(repetits)} exemplars have more than one active loan (exemplar ids: {mostra}"
+            f"{', ...' if len(repetits) > 50 else ''}). List them with './manage.py close_duplicate_loans', "
+            "return the wrong loans from the admin or close the older ones with "
+            "'./manage.py close_duplicate_loans --close', and run migrate again."
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('biblioteca', '0024_disponibilitatexemplars'),
+    ]
+
+    operations = [
+        # Primer, perquè en bases de dades sense DDL transaccional (MySQL) no
+        # quedin índexs creats a mitges
+        migrations.RunPython(comprovar_prestecs_duplicats, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='usuari',
+            name='telefon',
+            field=models.CharField(blank=True, db_index=True, max_length=9, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='exemplar',
+            index=models.Index(fields=['cataleg', 'centre', 'baixa', 'exclos_prestec'], name='exemplar_disponibilitat'),
+        ),
+        migrations.AddIndex(
+            model_name='exemplar',
+            index=models.Index(fields=['centre', 'registre'], name='exemplar_centre_registre'),
+        ),
+        migrations.AddIndex(
+            model_name='log',
+            index=models.Index(fields=['data_accio', 'tipus'], name='log_data_tipus'),
+        ),
+        migrations.AddIndex(
+            model_name='prestec',
+            index=models.Index(fields=['usuari', 'data_retorn'], name='prestec_usuari_retorn'),
+        ),
+        migrations.AddIndex(
+            model_name='usuari',
+            index=models.Index(fields=['email'], name='usuari_email'),
+        ),
+        migrations.AddConstraint(
+            model_name='prestec',
+            constraint=models.UniqueConstraint(condition=models.Q(('data_retorn__isnull', True)), fields=('exemplar',), name='prestec_actiu_per_exemplar'),
+        ),
+    ]
@@ -1,8 +1,12 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.dispatch import receiver, Signal
 from django.contrib.auth.models import AbstractUser
 from django.utils.timezone import now
 from django.contrib.auth.hashers import make_password
 import re
+import uuid
 
 class Categoria(models.Model):
     class Meta:
@@ -27,6 +31,15 @@ class Llengua(models.Model):
         return self.nom
 
 class Cataleg(models.Model):
+    TIPUS_CATALEG = (
+        ('indefinit', 'Indefinit'),
+        ('llibre', 'Llibre'),
+        ('revista', 'Revista'),
+        ('cd', 'CD'),
+        ('dvd', 'DVD'),
+        ('br', 'BR'),
+        ('dispositiu', 'Dispositiu'),
+    )
     titol = models.CharField(max_length=200)
     titol_original = models.CharField(max_length=200, blank=True, null=True)
     autor = models.CharField(max_length=200, blank=True, null=True)
@@ -37,11 +50,19 @@ class Cataleg(models.Model):
     anotacions = models.TextField(blank=True,null=True)
     mides = models.CharField(max_length=100,null=True,blank=True)
     tags = models.ManyToManyField(Categoria,blank=True)
+    # Subclasse concreta (llibre, revista...), es desa automàticament
+    tipus = models.CharField(max_length=20, choices=TIPUS_CATALEG, default='indefinit', editable=False, db_index=True)
     def exemplars(self):
     	return 0
     def __str__(self):
         return self.titol
 
+    def save(self, *args, **kwargs):
+        # Només les subclasses fixen el tipus; desar el Cataleg pare no l'ha de perdre
+        if type(self) is not Cataleg:
+            self.tipus = self._meta.model_name
+        super().save(*args, **kwargs)
+
 class Llibre(Cataleg):
     ISBN = models.CharField(max_length=13, blank=True, null=True)
     editorial = models.CharField(max_length=100, blank=True, null=True)
@@ -97,14 +118,22 @@ class Grup(models.Model):
         return self.nom
 
 class Usuari(AbstractUser):
-    telefon = models.CharField(max_length=9,blank=True,null=True)
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Importació d'usuaris: emails i telèfons ja existents
+            models.Index(fields=['email'], name='usuari_email'),
+        ]
+    telefon = models.CharField(max_length=9,blank=True,null=True,db_index=True)
     centre = models.ForeignKey(Centre,on_delete=models.SET_NULL,null=True,blank=True)  # Centro puede ser null para usuarios normales
     grup = models.ForeignKey(Grup,on_delete=models.SET_NULL,null=True,blank=True)
     imatge = models.ImageField(upload_to='usuaris/',null=True,blank=True)
-    auth_token = models.CharField(max_length=32,blank=True,null=True)
+    # SHA-256 del token de l'API (biblioteca/tokens.py), mai el token en clar
+    auth_token = models.CharField(max_length=64,blank=True,null=True,db_index=True)
 
     def is_bibliotecari(self):
-        return self.groups.filter(name='Bibliotecaris').exists()
+        from .permisos import instantania
+        perfil = instantania(self)
+        return bool(perfil and perfil.bibliotecari)
 
     def save(self, *args, **kwargs):
         if self.is_staff and not self.centre and not self.pk:  # solo para nuevos usuarios staff
@@ -115,6 +144,91 @@ class Usuari(AbstractUser):
                 raise ValueError("Staff users must have a centre assigned")
         super().save(*args, **kwargs)
 
+class Comptador(models.Model):
+    """
+    Seqüència numèrica compartida (p. ex. els números de registre dels exemplars).
+    Reservar números és un UPDATE atòmic de la fila, de manera que dues
+    insercions concurrents no poden obtenir el mateix número.
+    """
+    class Meta:
+        verbose_name_plural = "Comptadors"
+    nom = models.CharField(max_length=50, unique=True)
+    valor = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.nom}: {self.valor}"
+
+    @classmethod
+    def reservar(cls, nom, quantitat=1, inicial=None):
+        """
+        Reserva `quantitat` números consecutius i retorna el primer. Si el
+        comptador no existeix es crea amb el valor de `inicial()`.
+        """
+        with transaction.atomic():
+            # L'UPDATE bloqueja la fila fins al final de la transacció
+            if not cls.objects.filter(nom=nom).update(valor=F('valor') + quantitat):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(nom=nom, valor=(inicial() if inicial else 0) + quantitat)
+                except IntegrityError:
+                    # Un altre procés l'acaba de crear
+                    cls.objects.filter(nom=nom).update(valor=F('valor') + quantitat)
+            valor = cls.objects.filter(nom=nom).values_list('valor', flat=True).get()
+        return valor - quantitat + 1
+
+    @classmethod
+    def avancar(cls, nom, valor, inicial=None):
+        """Assegura que el comptador no torni a donar cap número <= `valor`."""
+        if cls.objects.filter(nom=nom, valor__lt=valor).update(valor=valor):
+            return
+        if cls.objects.filter(nom=nom).exists():
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(nom=nom, valor=max(valor, inicial() if inicial else 0))
+        except IntegrityError:
+            cls.objects.filter(nom=nom, valor__lt=valor).update(valor=valor)
+
+
+REGISTRE_RE = re.compile(r'^EX-\d{4}-(\d{6})$')
+
+
+def numero_registre(registre):
+    match = REGISTRE_RE.match(registre or '')
+    return int(match.group(1)) if match else None
+
+
+# bulk_create no envia post_save: ExemplarManager.crear_en_bloc envia aquest
+# senyal (sender=Exemplar, cataleg_id, exemplars) en crear exemplars en bloc
+exemplars_creats = Signal()
+
+
+class ExemplarManager(models.Manager):
+
+    def crear_en_bloc(self, cataleg, centre, quantitat, **camps):
+        """
+        Crea `quantitat` exemplars de `cataleg` al `centre` amb números de
+        registre consecutius, en una sola transacció. Retorna els exemplars creats.
+        """
+        # Es reserva abans de la transacció per no bloquejar el comptador
+        # mentre s'insereix; si la inserció falla queda un forat, com en una seqüència
+        primer = Exemplar.reservar_registres(quantitat)
+        year = now().year
+        exemplars = [
+            self.model(cataleg=cataleg, centre=centre, registre=Exemplar.format_registre(primer + i, year), **camps)
+            for i in range(quantitat)
+        ]
+        with transaction.atomic():
+            self.bulk_create(exemplars, batch_size=500)
+            if any(e.pk is None for e in exemplars):
+                # Alguns backends (MySQL) no retornen les claus de bulk_create
+                ids = dict(self.filter(registre__in=[e.registre for e in exemplars]).values_list('registre', 'id'))
+                for exemplar in exemplars:
+                    exemplar.pk = ids[exemplar.registre]
+            exemplars_creats.send(sender=self.model, cataleg_id=cataleg.pk, exemplars=exemplars)
+        return exemplars
+
+
 class Exemplar(models.Model):
     cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE)
     registre = models.CharField(max_length=100, unique=True, editable=False)
@@ -122,36 +236,76 @@ class Exemplar(models.Model):
     baixa = models.BooleanField(default=False)
     centre = models.ForeignKey(Centre, on_delete=models.PROTECT, verbose_name="Centre")
 
+    objects = ExemplarManager()
+
     class Meta:
         verbose_name = "Exemplar"
         verbose_name_plural = "Exemplars"
         ordering = ['registre']
+        indexes = [
+            # Recomptes de disponibilitat per element i centre, sense llegir la taula
+            models.Index(fields=['cataleg', 'centre', 'baixa', 'exclos_prestec'], name='exemplar_disponibilitat'),
+            # Cerca d'exemplars d'un centre, paginada pel registre
+            models.Index(fields=['centre', 'registre'], name='exemplar_centre_registre'),
+        ]
 
     def __str__(self):
         return f"REG:{self.registre} - {self.cataleg.titol}"
 
-    def save(self, *args, **kwargs):
-        if not self.registre:
-            year = now().year
-            max_num = 0
+    @staticmethod
+    def max_numero_registre():
+        """Número més alt dels registres existents (de qualsevol any)."""
+        registres = Exemplar.objects.filter(registre__regex=r'^EX-\d{4}-\d{6}$').values_list('registre', flat=True)
+        return max((numero_registre(r) for r in registres.iterator()), default=0)
 
-            last_exemplar = (
-                Exemplar.objects
-                .filter(registre__regex=r'^EX-\d{4}-\d{6}$')
-                .order_by('-registre')
-                .only('registre')
-                .first()
-            )
+    @staticmethod
+    def reservar_registres(quantitat=1):
+        """Reserva `quantitat` números de registre consecutius i retorna el primer."""
+        return Comptador.reservar('registre', quantitat, inicial=Exemplar.max_numero_registre)
 
-            if last_exemplar:
-                match = re.match(r'EX-\d{4}-(\d{6})', last_exemplar.registre)
-                if match:
-                    max_num = int(match.group(1))
+    @staticmethod
+    def format_registre(numero, year=None):
+        return f'EX-{year or now().year}-{numero:06d}'
 
-            nou_numero = max_num + 1
-            self.registre = f'EX-{year}-{nou_numero:06d}'
+    def save(self, *args, **kwargs):
+        if not self.registre:
+            self.registre = self.format_registre(self.reservar_registres())
+            self._registre_reservat = True
+
+        # En la mateixa transacció que els comptadors de disponibilitat (post_save)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+
+@receiver(post_save, sender=Exemplar)
+def _registre_desat(sender, instance, created, raw=False, **kwargs):
+    # Registres posats a mà o carregats amb loaddata: el comptador no els ha de repetir
+    if not created or getattr(instance, '_registre_reservat', False):
+        return
+    numero = numero_registre(instance.registre)
+    if numero is not None:
+        Comptador.avancar('registre', numero, inicial=Exemplar.max_numero_registre)
+
+
+class DisponibilitatExemplars(models.Model):
+    """
+    Nombre d'exemplars de cada element del catàleg en cada centre, per estat.
+    Es manté en la mateixa transacció que els canvis dels exemplars (vegeu
+    biblioteca/disponibilitat.py) i es repara amb `reconcile_availability`.
+    """
+    class Meta:
+        verbose_name_plural = "Disponibilitat d'exemplars"
+        constraints = [
+            models.UniqueConstraint(fields=['cataleg', 'centre'], name='disponibilitat_cataleg_centre'),
+        ]
+    cataleg = models.ForeignKey(Cataleg, on_delete=models.CASCADE, related_name='disponibilitats')
+    centre = models.ForeignKey(Centre, on_delete=models.CASCADE)
+    disponible = models.IntegerField(default=0)
+    exclos_prestec = models.IntegerField(default=0)
+    baixa = models.IntegerField(default=0)
 
-        super().save(*args, **kwargs)
+    def __str__(self):
+        return f"{self.cataleg_id}@{self.centre_id}: {self.disponible}/{self.exclos_prestec}/{self.baixa}"
 
 
 class Imatge(models.Model):
@@ -168,6 +322,16 @@ class Reserva(models.Model):
 class Prestec(models.Model):
     class Meta:
         verbose_name_plural = "Préstecs"
+        indexes = [
+            # Historial i préstecs actius d'un usuari
+            models.Index(fields=['usuari', 'data_retorn'], name='prestec_usuari_retorn'),
+        ]
+        constraints = [
+            # Un exemplar només pot tenir un préstec actiu; és també l'índex
+            # parcial dels préstecs actius per exemplar (retorns)
+            models.UniqueConstraint(fields=['exemplar'], condition=models.Q(data_retorn__isnull=True),
+                                    name='prestec_actiu_per_exemplar'),
+        ]
     usuari = models.ForeignKey(Usuari, on_delete=models.CASCADE)
     exemplar = models.ForeignKey(Exemplar, on_delete=models.CASCADE)
     data_prestec = models.DateField(auto_now_add=True)
@@ -201,7 +365,92 @@ class Log(models.Model):
     data_accio = models.DateTimeField(auto_now_add=True)
     tipus = models.CharField(max_length=10, choices=TIPO_LOG, default="")
 
+    class Meta:
+        indexes = [
+            # Filtres de l'admin per data i tipus
+            models.Index(fields=['data_accio', 'tipus'], name='log_data_tipus'),
+        ]
+
     def __str__(self):
         return f"{self.accio} - {self.tipus}"
 
 
+class ConsultaGoogleBooks(models.Model):
+    """Resposta cachejada de Google Books per a l'autocompletat d'autors i editorials."""
+    class Meta:
+        verbose_name_plural = "Consultes Google Books"
+    clau = models.CharField(max_length=255, unique=True)
+    resultats = models.JSONField(default=list)
+    creat = models.DateTimeField()
+    darrer_us = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.clau
+
+
+class TreballEtiquetes(models.Model):
+    """Generació en segon pla d'un PDF d'etiquetes (vegeu biblioteca/treballs.py)."""
+    ESTATS = (
+        ('pendent', 'Pendent'),
+        ('en_curs', 'En curs'),
+        ('acabat', 'Acabat'),
+        ('error', 'Error'),
+    )
+    class Meta:
+        verbose_name_plural = "Treballs d'etiquetes"
+    # Hash del renderitzador i la llista d'ids, per reutilitzar resultats
+    clau = models.CharField(max_length=64, db_index=True)
+    exemplar_ids = models.JSONField()
+    renderer = models.CharField(max_length=20, default='xhtml2pdf')
+    estat = models.CharField(max_length=10, choices=ESTATS, default='pendent', db_index=True)
+    pagines_fetes = models.IntegerField(default=0)
+    pagines_totals = models.IntegerField(default=0)
+    # Camí del PDF dins de ETIQUETES_TREBALLS_DIR
+    fitxer = models.CharField(max_length=255, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    creat = models.DateTimeField(auto_now_add=True)
+    actualitzat = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Etiquetes #{self.pk} ({self.estat})"
+
+
+class ImportacioUsuaris(models.Model):
+    """Importació en segon pla d'un CSV o NDJSON d'usuaris (vegeu biblioteca/importacio.py)."""
+    ESTATS = TreballEtiquetes.ESTATS
+    FORMATS = (
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    )
+    class Meta:
+        verbose_name_plural = "Importacions d'usuaris"
+    # Identificador de les URL de la importació: l'id és seqüencial i es podria endevinar
+    codi = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    # Camí del fitxer pujat dins de IMPORTACIO_DIR
+    fitxer = models.CharField(max_length=255)
+    format = models.CharField(max_length=10, choices=FORMATS)
+    estat = models.CharField(max_length=10, choices=ESTATS, default='pendent', db_index=True)
+    files_totals = models.IntegerField(null=True, blank=True)
+    # Punt de control: files ja confirmades i mida confirmada del fitxer d'errors
+    files_processades = models.IntegerField(default=0)
+    errors_bytes = models.BigIntegerField(default=0)
+    creats = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    creat = models.DateTimeField(auto_now_add=True)
+    actualitzat = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Importació #{self.pk} ({self.estat})"
+
+
+class TokenRevocat(models.Model):
+    """Token signat invalidat abans de caducar, p. ex. en tancar la sessió (vegeu biblioteca/tokens.py)."""
+    class Meta:
+        verbose_name_plural = "Tokens revocats"
+    jti = models.CharField(max_length=32, unique=True)
+    # Fins quan cal recordar-lo: després el token ja no és vàlid ni es pot refrescar
+    caduca = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.jti
@@ -0,0 +1,66 @@
+"""
+Paginació per cursor (keyset) per als endpoints de llistat de l'API.
+
+El cursor és opac per al client: codifica l'últim valor de la columna
+d'ordenació de la pàgina anterior, de manera que cada pàgina es resol amb un
+`WHERE camp > valor ORDER BY camp LIMIT n` sobre una columna indexada i el
+cost no creix encara que el client avanci molt.
+"""
+import base64
+import json
+from typing import Generic, List, Optional, TypeVar
+
+from ninja import Schema
+from ninja.errors import HttpError
+
+LIMIT_PER_DEFECTE = 100
+LIMIT_MAXIM = 500
+
+T = TypeVar("T")
+
+
+class Pagina(Schema, Generic[T]):
+    items: List[T]
+    next: Optional[str] = None
+
+
+def codificar_cursor(valor):
+    dades = json.dumps({"v": valor}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(dades).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor):
+    try:
+        dades = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(dades)["v"]
+    except (ValueError, KeyError, TypeError):
+        raise HttpError(400, "Cursor no vàlid")
+
+
+def normalitzar_limit(limit):
+    return min(max(limit or LIMIT_PER_DEFECTE, 1), LIMIT_MAXIM)
+
+
+def paginar(queryset, cursor=None, limit=None, camp="pk"):
+    """
+    Retorna (objectes, next) per a la pàgina que comença després de `cursor`.
+
+    `camp` ha de ser únic i indexat (pk o un camp unique) perquè l'ordre sigui
+    estable entre pàgines.
+    """
+    limit = normalitzar_limit(limit)
+
+    queryset = queryset.order_by(camp)
+    if cursor:
+        queryset = queryset.filter(**{f"{camp}__gt": decodificar_cursor(cursor)})
+
+    # Demanem un element de més per saber si hi ha pàgina següent
+    objectes = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(objectes) > limit:
+        objectes = objectes[:limit]
+        darrer = objectes[-1]
+        valor = darrer.pk if camp == "pk" else getattr(darrer, camp)
+        next_cursor = codificar_cursor(valor)
+
+    return objectes, next_cursor
@@ -0,0 +1,160 @@
+"""
+Instantània dels permisos i el perfil de cada usuari.
+
+- Es calcula una sola vegada per usuari (dades de l'usuari amb el centre i el
+  grup, permisos directes i permisos dels grups, inclòs Bibliotecaris) i es
+  desa a la memòria del procés durant PERMISOS_CACHE_TTL segons.
+- /usuari i les comprovacions de staff de les vistes la fan servir en lloc de
+  carregar les relacions a cada petició.
+- Desar o esborrar un usuari, canviar els seus grups o permisos directes
+  l'invalida. Canviar els permisos d'un grup, o desar un grup, centre o grup
+  d'alumnes les invalida totes. Els altres processos ho veuen en caducar el TTL.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Centre, Grup, Usuari
+
+GRUP_BIBLIOTECARIS = "Bibliotecaris"
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+class Instantania:
+    """Dades d'un usuari que no canvien entre peticions."""
+
+    def __init__(self, usuari, permisos_directes, permisos_grups, grups):
+        self.id = usuari.id
+        self.username = usuari.username
+        self.first_name = usuari.first_name
+        self.last_name = usuari.last_name
+        self.email = usuari.email
+        self.telefon = usuari.telefon
+        self.is_active = usuari.is_active
+        self.is_staff = usuari.is_staff
+        self.is_superuser = usuari.is_superuser
+        self.imatge = usuari.imatge.url if usuari.imatge else None
+        self.centre_id = usuari.centre_id
+        self.centre_nom = usuari.centre.nom if usuari.centre else None
+        self.grup = usuari.grup.nom if usuari.grup else None
+        # [{"id", "name"}] tal com els retorna /usuari
+        self.permisos_directes = permisos_directes
+        # "app_label.codename", com User.get_all_permissions()
+        self.permisos = frozenset(permisos_grups)
+        self.grups = frozenset(grups)
+
+    @property
+    def bibliotecari(self):
+        return GRUP_BIBLIOTECARIS in self.grups
+
+    def te_permis(self, permis):
+        if self.is_active and self.is_superuser:
+            return True
+        return self.is_active and permis in self.permisos
+
+
+def _calcular(usuari_id):
+    usuari = Usuari.objects.select_related("centre", "grup").get(pk=usuari_id)
+    directes = list(
+        Permission.objects.filter(user=usuari)
+        .values_list("id", "name", "content_type__app_label", "codename")
+        .order_by("id")
+    )
+    de_grups = Permission.objects.filter(group__user=usuari).values_list("content_type__app_label", "codename")
+    grups = usuari.groups.values_list("name", flat=True)
+    return Instantania(
+        usuari,
+        [{"id": permis_id, "name": nom} for permis_id, nom, _, _ in directes],
+        [f"{app}.{codi}" for _, _, app, codi in directes] + [f"{app}.{codi}" for app, codi in de_grups],
+        grups,
+    )
+
+
+class CachePermisos:
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._entrades = {}
+        self._generacio = 0
+        self._lock = threading.Lock()
+
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else _config("PERMISOS_CACHE_TTL", 300)
+
+    def obtenir(self, usuari_id):
+        with self._lock:
+            entrada = self._entrades.get(usuari_id)
+            if entrada is not None and time.monotonic() < entrada[1]:
+                return entrada[0]
+            generacio = self._generacio
+        instantania = _calcular(usuari_id)
+        with self._lock:
+            # Si s'ha invalidat mentre es calculava, pot ser antiga: no es desa
+            if generacio == self._generacio:
+                self._entrades[usuari_id] = (instantania, time.monotonic() + self._ttl())
+        return instantania
+
+    def invalidar(self, usuari_id):
+        with self._lock:
+            self._generacio += 1
+            self._entrades.pop(usuari_id, None)
+
+    def buidar(self):
+        with self._lock:
+            self._generacio += 1
+            self._entrades.clear()
+
+
+cache = CachePermisos()
+
+
+def instantania(usuari):
+    """Instantània d'un usuari (o del seu id), o None si ja no existeix."""
+    try:
+        return cache.obtenir(getattr(usuari, "pk", usuari))
+    except Usuari.DoesNotExist:
+        return None
+
+
+@receiver(post_save, sender=Usuari)
+@receiver(post_delete, sender=Usuari)
+def _usuari_canviat(sender, instance, **kwargs):
+    cache.invalidar(instance.pk)
+
+
+@receiver(m2m_changed, sender=Usuari.groups.through)
+@receiver(m2m_changed, sender=Usuari.user_permissions.through)
+def _relacions_usuari_canviades(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        cache.invalidar(instance.pk)
+    elif pk_set:
+        # group.user_set.add(...) o permission.user_set.add(...)
+        for usuari_id in pk_set:
+            cache.invalidar(usuari_id)
+    else:
+        cache.buidar()  # clear() des del grup o permís: no se sap a qui afecta
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def _permisos_grup_canviats(sender, action, **kwargs):
+    if action.startswith("post_"):
+        cache.buidar()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Centre)
+@receiver(post_delete, sender=Centre)
+@receiver(post_save, sender=Grup)
+@receiver(post_delete, sender=Grup)
+def _dades_compartides_canviades(sender, **kwargs):
+    cache.buidar()
@@ -0,0 +1,35 @@
+"""
+Feina en segon pla del procés servidor.
+
+wsgi.py i asgi.py criden en_la_primera_peticio(): la primera petició que rep el
+procés construeix l'índex de suggeriments i torna a encolar els treballs
+d'etiquetes i les importacions pendents o abandonats. Importar l'aplicació
+(ordres de gestió, tests, eines) no engega cap fil ni toca la base de dades.
+"""
+import threading
+
+from django.core.signals import request_started
+
+DISPATCH_UID = "biblioteca.segon_pla.iniciar"
+
+_lock = threading.Lock()
+_iniciat = False
+
+
+def iniciar(**kwargs):
+    """Engega la feina en segon pla una sola vegada per procés."""
+    global _iniciat
+    with _lock:
+        if _iniciat:
+            return
+        _iniciat = True
+    request_started.disconnect(dispatch_uid=DISPATCH_UID)
+
+    from . import importacio, suggeriments, treballs
+    suggeriments.index.precarregar()
+    treballs.reprendre_pendents()
+    importacio.reprendre_pendents()
+
+
+def en_la_primera_peticio():
+    request_started.connect(iniciar, dispatch_uid=DISPATCH_UID)
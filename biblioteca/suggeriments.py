@@ -0,0 +1,284 @@
+"""
+Índex de prefixos en memòria per als suggeriments de cerca mentre s'escriu.
+
+Per a cada element del catàleg es desen els textos de títol, autor i editorial
+normalitzats (sense accents ni signes de puntuació) començant per cada paraula,
+en una llista ordenada. Un prefix es resol amb una cerca binària sobre la
+llista, sense consultar la base de dades.
+
+L'índex es construeix en segon pla amb la primera petició del procés (wsgi/asgi,
+vegeu segon_pla), s'actualitza amb senyals quan es desa o s'esborra un element
+i es reconstrueix cada SUGGERIMENTS_REFRESC segons per recollir canvis fets per
+altres processos.
+Si supera SUGGERIMENTS_MEMORIA_MAXIMA deixa d'estar complet i els endpoints
+tornen a consultar la base de dades; amb 0 l'índex queda desactivat.
+"""
+import bisect
+import logging
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cerca import normalitzar as treure_accents
+from .models import BR, CD, DVD, Cataleg, Dispositiu, Exemplar, Llibre, Revista, exemplars_creats
+
+logger = logging.getLogger(__name__)
+
+CAMPS = ("titol", "autor", "editorial")
+# Paraules inicials des de les quals s'indexa cada text
+MAX_PARAULES = 8
+
+
+def normalitzar(text):
+    text = re.sub(r"[^\w\s]", "", treure_accents(text))
+    return " ".join(text.split())
+
+
+def _claus(text):
+    paraules = normalitzar(text).split()
+    return [" ".join(paraules[i:]) for i in range(min(len(paraules), MAX_PARAULES))]
+
+
+def _mida(clau):
+    # Cadena + tupla (clau, camp, id) + posició a la llista
+    return sys.getsizeof(clau) + 72
+
+
+class IndexSuggeriments:
+
+    def __init__(self, memoria_maxima=None, refresc=None):
+        self.memoria_maxima = memoria_maxima
+        self.refresc = refresc
+        self._lock = threading.RLock()
+        self._construint = False
+        self.preparat = False
+        self.complet = True
+        self.construit = 0
+        self.memoria = 0
+        self.claus = []       # [(clau, camp, cataleg_id)] ordenada
+        self.items = {}       # cataleg_id -> {titol, autor, editorial, tipus}
+        self.exemplars = {}   # cataleg_id -> id del primer exemplar
+
+    def _limit_memoria(self):
+        if self.memoria_maxima is not None:
+            return self.memoria_maxima
+        return getattr(settings, "SUGGERIMENTS_MEMORIA_MAXIMA", 64 * 1024 * 1024)
+
+    def _periode_refresc(self):
+        if self.refresc is not None:
+            return self.refresc
+        return getattr(settings, "SUGGERIMENTS_REFRESC", 300)
+
+    # Construcció
+
+    def construir(self):
+        limit = self._limit_memoria()
+        claus = []
+        items = {}
+        memoria = 0
+        complet = True
+
+        files = Cataleg.objects.values_list("id", "titol", "autor", "tipus", "llibre__editorial")
+        for cataleg_id, titol, autor, tipus, editorial in files.iterator(chunk_size=2000):
+            item = {"titol": titol, "autor": autor, "editorial": editorial, "tipus": tipus}
+            noves = self._claus_item(cataleg_id, item)
+            mida = sum(_mida(c[0]) for c in noves)
+            if memoria + mida > limit:
+                complet = False
+                break
+            items[cataleg_id] = item
+            claus.extend(noves)
+            memoria += mida
+        claus.sort()
+
+        exemplars = dict(
+            Exemplar.objects.values("cataleg_id").annotate(primer=Min("id")).values_list("cataleg_id", "primer")
+        )
+
+        with self._lock:
+            self.claus = claus
+            self.items = items
+            self.exemplars = exemplars
+            self.memoria = memoria
+            self.complet = complet
+            self.preparat = True
+            self.construit = time.monotonic()
+        if not complet:
+            logger.warning("Índex de suggeriments incomplet: s'ha superat el límit de %s bytes", limit)
+
+    def _construir_en_segon_pla(self):
+        try:
+            self.construir()
+        except Exception:
+            logger.exception("No s'ha pogut construir l'índex de suggeriments")
+        finally:
+            self._construint = False
+            connection.close()
+
+    def precarregar(self):
+        """Construeix l'índex en un fil en segon pla si no s'està construint ja."""
+        with self._lock:
+            if self._construint:
+                return
+            self._construint = True
+        threading.Thread(target=self._construir_en_segon_pla, daemon=True).start()
+
+    def disponible(self):
+        if self._limit_memoria() <= 0:
+            return False
+        if not self.preparat:
+            self.precarregar()
+            return False
+        if time.monotonic() - self.construit > self._periode_refresc():
+            self.precarregar()
+        return self.complet
+
+    # Actualitzacions incrementals
+
+    @staticmethod
+    def _claus_item(cataleg_id, item):
+        return [(clau, camp, cataleg_id) for camp in CAMPS for clau in _claus(item[camp])]
+
+    def _treure(self, cataleg_id):
+        item = self.items.pop(cataleg_id, None)
+        if item is None:
+            return
+        for entrada in self._claus_item(cataleg_id, item):
+            i = bisect.bisect_left(self.claus, entrada)
+            if i < len(self.claus) and self.claus[i] == entrada:
+                del self.claus[i]
+                self.memoria -= _mida(entrada[0])
+
+    def actualitzar(self, cataleg_id):
+        fila = Cataleg.objects.filter(id=cataleg_id).values_list("titol", "autor", "tipus", "llibre__editorial").first()
+        with self._lock:
+            if not self.preparat:
+                return
+            self._treure(cataleg_id)
+            if fila is None:
+                return
+            titol, autor, tipus, editorial = fila
+            item = {"titol": titol, "autor": autor, "editorial": editorial, "tipus": tipus}
+            noves = self._claus_item(cataleg_id, item)
+            mida = sum(_mida(c[0]) for c in noves)
+            if self.memoria + mida > self._limit_memoria():
+                self.complet = False
+                return
+            self.items[cataleg_id] = item
+            for entrada in noves:
+                bisect.insort(self.claus, entrada)
+            self.memoria += mida
+
+    def treure(self, cataleg_id):
+        with self._lock:
+            self._treure(cataleg_id)
+            self.exemplars.pop(cataleg_id, None)
+
+    def actualitzar_exemplars(self, cataleg_id):
+        primer = Exemplar.objects.filter(cataleg_id=cataleg_id).aggregate(primer=Min("id"))["primer"]
+        with self._lock:
+            if primer is None:
+                self.exemplars.pop(cataleg_id, None)
+            else:
+                self.exemplars[cataleg_id] = primer
+
+    # Consultes
+
+    def _recorrer(self, prefix):
+        """Entrades (clau, camp, cataleg_id) que comencen pel prefix, en ordre."""
+        i = bisect.bisect_left(self.claus, (prefix,))
+        while i < len(self.claus) and self.claus[i][0].startswith(prefix):
+            yield self.claus[i]
+            i += 1
+
+    def suggeriments_cataleg(self, q, limit=10):
+        prefix = normalitzar(q)
+        if not prefix:
+            return []
+        results = []
+        vistos = set()
+        with self._lock:
+            for _, camp, cataleg_id in self._recorrer(prefix):
+                if camp == "editorial" or cataleg_id in vistos:
+                    continue
+                vistos.add(cataleg_id)
+                item = self.items[cataleg_id]
+                results.append({
+                    "id": cataleg_id,
+                    "titol": item["titol"],
+                    "autor": item["autor"],
+                    "tipus": item["tipus"],
+                })
+                if len(results) >= limit:
+                    break
+        return results
+
+    def suggeriments_exemplars(self, q, limit=50):
+        prefix = normalitzar(q)
+        if not prefix:
+            return []
+        tipus_camp = {"titol": "Título", "autor": "Autor", "editorial": "Editorial"}
+        results = []
+        vistos = set()
+        with self._lock:
+            for _, camp, cataleg_id in self._recorrer(prefix):
+                exemplar_id = self.exemplars.get(cataleg_id)
+                if exemplar_id is None:
+                    continue
+                resultat = self.items[cataleg_id][camp]
+                if resultat in vistos:
+                    continue
+                vistos.add(resultat)
+                results.append({
+                    "id": exemplar_id,
+                    "tipo": tipus_camp[camp],
+                    "resultado": resultat,
+                })
+                if len(results) >= limit:
+                    break
+        return results
+
+
+index = IndexSuggeriments()
+
+
+# Sincronització amb senyals (després del commit, per no indexar canvis desfets)
+@receiver(post_save, sender=Cataleg)
+@receiver(post_save, sender=Llibre)
+@receiver(post_save, sender=Revista)
+@receiver(post_save, sender=CD)
+@receiver(post_save, sender=DVD)
+@receiver(post_save, sender=BR)
+@receiver(post_save, sender=Dispositiu)
+def _cataleg_desat(sender, instance, raw=False, **kwargs):
+    if not raw and index.preparat:
+        cataleg_id = instance.pk
+        transaction.on_commit(lambda: index.actualitzar(cataleg_id))
+
+
+@receiver(post_delete, sender=Cataleg)
+def _cataleg_esborrat(sender, instance, **kwargs):
+    if index.preparat:
+        cataleg_id = instance.pk
+        transaction.on_commit(lambda: index.treure(cataleg_id))
+
+
+@receiver(post_save, sender=Exemplar)
+@receiver(post_delete, sender=Exemplar)
+def _exemplar_canviat(sender, instance, raw=False, **kwargs):
+    if not raw and index.preparat:
+        cataleg_id = instance.cataleg_id
+        transaction.on_commit(lambda: index.actualitzar_exemplars(cataleg_id))
+
+
+@receiver(exemplars_creats, sender=Exemplar)
+def _exemplars_creats(sender, cataleg_id, **kwargs):
+    if index.preparat:
+        transaction.on_commit(lambda: index.actualitzar_exemplars(cataleg_id))
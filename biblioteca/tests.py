@@ -1,3 +1,1361 @@
-from django.test import TestCase
+import base64
+import importlib
+import json
+import os
+import re
+import tempfile
+import threading
+from contextlib import redirect_stderr
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, Permission
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import connection, transaction
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pypdf import PdfReader
+
+from . import (
+    benchmark, cerca, circulacio, disponibilitat, etiquetes, google_books, importacio, instrumentacio, permisos,
+    segon_pla, suggeriments, tokens, treballs,
+)
+from .management.commands import seed_biblioteca
+from .models import (
+    CD, Cataleg, Categoria, Centre, Comptador, ConsultaGoogleBooks, DisponibilitatExemplars, Dispositiu, Exemplar, Grup,
+    ImportacioUsuaris, Llengua, Llibre, Log, Pais, Prestec, Reserva, TokenRevocat, TreballEtiquetes, Usuari,
+)
+from .paginacio import LIMIT_MAXIM, normalitzar_limit
+
+
+class SerialitzadorCercaTests(TestCase):
+
+    def setUp(self):
+        self.centre = Centre.objects.create(nom="Centre")
+        self.tag = Categoria.objects.create(nom="Novel·la")
+
+    def crear(self, n):
+        for i in range(n):
+            llibre = Llibre.objects.create(
+                titol=f"Llibre {i}", autor="Autor", ISBN=f"97800000{i:05d}", editorial="Editorial",
+                pais=Pais.objects.create(nom=f"País {i}"), llengua=Llengua.objects.create(nom=f"Llengua {i}"),
+            )
+            llibre.tags.add(self.tag)
+            for exclos_prestec in (False, False, True):
+                Exemplar.objects.create(cataleg=llibre, centre=self.centre, exclos_prestec=exclos_prestec)
+            CD.objects.create(titol=f"CD {i}", discografica="Discogràfica", estil="Jazz", duracio="01:02:03")
+            Dispositiu.objects.create(titol=f"Dispositiu {i}", marca="Marca", model="Model")
+
+    def cercar(self):
+        resposta = self.client.get("/api/cataleg/search/")
+        self.assertEqual(resposta.status_code, 200)
+        return resposta.json()["items"]
+
+    def test_format_per_tipus(self):
+        self.crear(1)
+        items = {item["tipus"]: item for item in self.cercar()}
+        self.assertEqual(set(items), {"llibre", "cd", "dispositiu"})
+
+        llibre = items["llibre"]
+        self.assertEqual((llibre["editorial"], llibre["ISBN"]), ("Editorial", "9780000000000"))
+        self.assertEqual(llibre["pais"]["nom"], "País 0")
+        self.assertEqual(llibre["llengua"]["nom"], "Llengua 0")
+        self.assertEqual(llibre["tags"], [{"id": self.tag.pk, "nom": "Novel·la"}])
+        self.assertEqual(llibre["exemplar_counts"], {"disponible": 2, "exclos_prestec": 1, "baixa": 0})
+        # Estat del primer exemplar per número de registre
+        self.assertEqual((llibre["exclos_prestec"], llibre["baixa"]), (False, False))
+
+        self.assertEqual((items["cd"]["discografica"], items["cd"]["duracio"]), ("Discogràfica", "01:02:03"))
+        self.assertEqual(items["cd"]["exemplar_counts"], {"disponible": 0, "exclos_prestec": 0, "baixa": 0})
+        self.assertIsNone(items["cd"]["baixa"])
+        self.assertEqual(items["dispositiu"]["marca"], "Marca")
+
+    def test_consultes_constants(self):
+        self.crear(1)
+        with CaptureQueriesContext(connection) as poques:
+            self.assertEqual(len(self.cercar()), 3)
+        self.crear(5)
+        with self.assertNumQueries(len(poques)):
+            self.assertEqual(len(self.cercar()), 18)
+
+
+class PaginacioTests(TestCase):
+
+    def setUp(self):
+        centre = Centre.objects.create(nom="Centre")
+        self.llibres = [Llibre.objects.create(titol=f"Llibre {i}") for i in range(5)]
+        for llibre in self.llibres:
+            Exemplar.objects.create(cataleg=llibre, centre=centre)
+
+    def recorrer(self, ruta, limit):
+        pagines, cursor = [], None
+        while True:
+            parametres = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+            resposta = self.client.get(ruta, parametres)
+            self.assertEqual(resposta.status_code, 200, resposta.content)
+            pagines.append(resposta.json()["items"])
+            cursor = resposta.json()["next"]
+            if cursor is None:
+                return pagines
+
+    def test_recorregut_per_cursor(self):
+        pagines = self.recorrer("/api/llibres/", 2)
+        self.assertEqual([len(p) for p in pagines], [2, 2, 1])
+        self.assertEqual([l["id"] for p in pagines for l in p], [l.pk for l in self.llibres])
+
+        registres = [e["registre"] for p in self.recorrer("/api/exemplars/", 3) for e in p]
+        self.assertEqual(registres, sorted(Exemplar.objects.values_list("registre", flat=True)))
+
+    def test_cursor_estable(self):
+        # Esborrar un element d'una pàgina ja servida no fa saltar ni repetir res
+        resposta = self.client.get("/api/llibres/", {"limit": 2}).json()
+        self.llibres[0].delete()
+        seguent = self.client.get("/api/llibres/", {"limit": 2, "cursor": resposta["next"]}).json()
+        self.assertEqual([l["id"] for l in seguent["items"]], [self.llibres[2].pk, self.llibres[3].pk])
+
+    def test_cursor_no_valid_i_limit(self):
+        self.assertEqual(self.client.get("/api/llibres/", {"cursor": "no-es-un-cursor"}).status_code, 400)
+        self.assertEqual(len(self.client.get("/api/llibres/", {"limit": -3}).json()["items"]), 1)
+        self.assertEqual(normalitzar_limit(10_000), LIMIT_MAXIM)
+
+
+class TipusCatalegTests(TestCase):
+
+    def test_tipus_de_la_subclasse(self):
+        cd = CD.objects.create(titol="CD", discografica="D", estil="Jazz", duracio="00:40:00")
+        llibre = Llibre.objects.create(titol="Llibre")
+        self.assertEqual(Cataleg.objects.get(pk=cd.pk).tipus, "cd")
+        # Desar a través del pare conserva el tipus
+        pare = Cataleg.objects.get(pk=llibre.pk)
+        pare.titol = "Llibre nou"
+        pare.save()
+        self.assertEqual(Cataleg.objects.get(pk=llibre.pk).tipus, "llibre")
+        self.assertEqual(Cataleg.objects.create(titol="Sense tipus").tipus, "indefinit")
+
+    def test_filtre_per_tipus(self):
+        CD.objects.create(titol="Disc", discografica="D", estil="Jazz", duracio="00:40:00")
+        Llibre.objects.create(titol="Llibre")
+        resposta = self.client.get("/api/cataleg/search/", {"tipus": "cd"})
+        self.assertEqual([item["titol"] for item in resposta.json()["items"]], ["Disc"])
+
+
+class CercaTextTests(TestCase):
+
+    def setUp(self):
+        if not cerca.disponible():
+            self.skipTest("Sense índex de text complet en aquesta base de dades")
+        self.titol = Llibre.objects.create(titol="Història de la cançó", autor="Autora")
+        self.resum = Llibre.objects.create(titol="Altres temes", resum="Una història breu de la música")
+        self.tag = Llibre.objects.create(titol="Tercer")
+
+    def ids(self, q, **parametres):
+        resposta = self.client.get("/api/cataleg/search/", {"q": q, **parametres})
+        self.assertEqual(resposta.status_code, 200)
+        return [item["id"] for item in resposta.json()["items"]]
+
+    def test_rellevancia_i_accents(self):
+        # El títol pesa més que el resum
+        self.assertEqual(self.ids("historia"), [self.titol.pk, self.resum.pk])
+        self.assertEqual(self.ids("CANCO"), [self.titol.pk])
+        self.assertEqual(self.ids("hist can"), [self.titol.pk])
+        self.assertEqual(self.ids("inexistent"), [])
+
+    def test_pagines_per_rellevancia(self):
+        primera = self.client.get("/api/cataleg/search/", {"q": "historia", "limit": 1}).json()
+        segona = self.client.get("/api/cataleg/search/", {"q": "historia", "limit": 1, "cursor": primera["next"]}).json()
+        self.assertEqual([i["id"] for i in primera["items"] + segona["items"]], [self.titol.pk, self.resum.pk])
+        self.assertIsNone(segona["next"])
+
+    def test_sincronitzat_amb_senyals(self):
+        categoria = Categoria.objects.create(nom="Poesia")
+        self.tag.tags.add(categoria)
+        self.assertEqual(self.ids("poesia"), [self.tag.pk])
+        categoria.nom = "Teatre"
+        categoria.save()
+        self.assertEqual(self.ids("poesia"), [])
+        self.assertEqual(self.ids("teatre"), [self.tag.pk])
+        self.titol.delete()
+        self.assertEqual(self.ids("historia"), [self.resum.pk])
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {cerca.TAULA}")
+        self.assertEqual(self.ids("teatre"), [])
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(self.ids("teatre"), [self.tag.pk])
+
+    def test_sense_index(self):
+        # Amb una base de dades sense índex (MySQL) es cerca amb icontains
+        with mock.patch.object(cerca, "disponible", return_value=False):
+            self.assertEqual(self.ids("Història"), [self.titol.pk])
+            self.assertEqual(self.ids("Autora"), [self.titol.pk])
+
+
+class SuggerimentsTests(TestCase):
+
+    def setUp(self):
+        centre = Centre.objects.create(nom="Centre")
+        self.llibre = Llibre.objects.create(titol="Història de la cançó", autor="Joan Pérez", editorial="Edicions Sud")
+        self.exemplar = Exemplar.objects.create(cataleg=self.llibre, centre=centre)
+        Exemplar.objects.create(cataleg=self.llibre, centre=centre)
+        self.cd = CD.objects.create(titol="Histories", autor="Banda", discografica="D", estil="Jazz", duracio="00:40:00")
+        self.index = suggeriments.IndexSuggeriments(memoria_maxima=1024 * 1024, refresc=3600)
+        patcher = mock.patch.object(suggeriments, "index", self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def suggeriments(self, q):
+        return self.client.get("/api/cataleg/search/suggestions/", {"q": q}).json()
+
+    def test_prefixos_sense_consultes(self):
+        self.index.construir()
+        self.assertTrue(self.index.complet)
+        with self.assertNumQueries(0):
+            resultats = self.suggeriments("Hist")
+        self.assertEqual({r["id"] for r in resultats}, {self.llibre.pk, self.cd.pk})
+        # Qualsevol paraula del text, sense accents ni puntuació
+        self.assertEqual([r["id"] for r in self.suggeriments("canco")], [self.llibre.pk])
+        self.assertEqual([r["id"] for r in self.suggeriments("perez")], [self.llibre.pk])
+        # L'editorial només surt als suggeriments d'exemplars
+        self.assertEqual(self.suggeriments("sud"), [])
+        resultats = self.client.get("/api/exemplars/search/suggestions/", {"q": "sud"}).json()
+        self.assertEqual(resultats, [{"id": self.exemplar.pk, "tipo": "Editorial", "resultado": "Edicions Sud"}])
+
+    def test_senyals(self):
+        self.index.construir()
+        with self.captureOnCommitCallbacks(execute=True):
+            nou = Llibre.objects.create(titol="Zoologia")
+        self.assertEqual([r["id"] for r in self.suggeriments("zoo")], [nou.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.llibre.titol = "Geografia"
+            self.llibre.save()
+        self.assertEqual([r["id"] for r in self.suggeriments("hist")], [self.cd.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            nou.delete()
+        self.assertEqual(self.suggeriments("zoo"), [])
+
+    def test_limit_de_memoria(self):
+        # Si l'índex no hi cap, els endpoints tornen a consultar la base de dades
+        self.index.memoria_maxima = 200
+        with self.assertLogs("biblioteca.suggeriments", "WARNING"):
+            self.index.construir()
+        self.assertFalse(self.index.complet)
+        self.assertFalse(self.index.disponible())
+        self.assertEqual({r["id"] for r in self.suggeriments("Hist")}, {self.llibre.pk, self.cd.pk})
+
+        self.index.memoria_maxima = 0
+        self.assertFalse(self.index.disponible())
+
+
+class BackendGoogleBooksDeProva:
+    """GOOGLE_BOOKS_BACKEND dels tests: apunta les crides i retorna `resposta` o llança `error`."""
+    crides = []
+    resposta = {"items": []}
+    error = None
+
+    def get(self, url, params, timeout):
+        BackendGoogleBooksDeProva.crides.append((params["q"], timeout))
+        if self.error:
+            raise self.error
+        return self.resposta
+
+
+@override_settings(
+    GOOGLE_BOOKS_BACKEND="biblioteca.tests.BackendGoogleBooksDeProva", GOOGLE_BOOKS_TIMEOUT=1.5,
+    GOOGLE_BOOKS_CACHE_TTL=3600, GOOGLE_BOOKS_CACHE_MAX=100,
+)
+class GoogleBooksTests(TestCase):
+
+    def setUp(self):
+        BackendGoogleBooksDeProva.crides = []
+        BackendGoogleBooksDeProva.error = None
+        BackendGoogleBooksDeProva.resposta = {"items": [
+            {"volumeInfo": {"authors": ["Mercè Rodoreda"], "publisher": "Club Editor"}},
+            {"volumeInfo": {"authors": ["Joan Rodó"], "publisher": "Proa"}},
+        ]}
+        patcher = mock.patch.object(google_books, "circuit", google_books.CircuitBreaker(errors_max=2, pausa=60))
+        self.circuit = patcher.start()
+        self.addCleanup(patcher.stop)
+        Llibre.objects.create(titol="Llibre", autor="Rodolf Llorens")
+
+    def autors(self, q):
+        return self.client.get("/api/autores/search/", {"q": q}).json()["resultados"]
+
+    def test_cache(self):
+        # Primer els de la base de dades, després els de Google Books que comencen pel text
+        self.assertEqual(self.autors("Rodo"), ["Rodolf Llorens", "Mercè Rodoreda", "Joan Rodó"])
+        self.assertEqual(BackendGoogleBooksDeProva.crides, [("inauthor:Rodo", 1.5)])
+        # La clau no distingeix majúscules ni accents
+        self.assertEqual(google_books.autors("RODÓ"), ["Mercè Rodoreda", "Joan Rodó"])
+        self.assertEqual(len(BackendGoogleBooksDeProva.crides), 1)
+        self.assertEqual(google_books.editorials("Rodo"), ["Club Editor", "Proa"])
+        self.assertEqual(len(BackendGoogleBooksDeProva.crides), 2)
+
+    def test_caducitat_i_maxim(self):
+        google_books.autors("Rodo")
+        ConsultaGoogleBooks.objects.update(creat=timezone.now() - timedelta(hours=2))
+        google_books.autors("Rodo")
+        self.assertEqual(len(BackendGoogleBooksDeProva.crides), 2)
+
+        with override_settings(GOOGLE_BOOKS_CACHE_MAX=2):
+            google_books.autors("A")
+            google_books.autors("Rodo")  # Tornar-la a usar la manté a la memòria cau
+            google_books.autors("B")
+        self.assertEqual(
+            set(ConsultaGoogleBooks.objects.values_list("clau", flat=True)), {"inauthor:rodo", "inauthor:b"}
+        )
+
+    def test_circuit_breaker(self):
+        BackendGoogleBooksDeProva.error = TimeoutError("timeout")
+        with self.assertLogs("biblioteca.google_books", "WARNING"):
+            self.assertEqual(google_books.autors("A"), [])
+            self.assertEqual(google_books.autors("B"), [])
+        # Obert: no es consulta Google Books, però la base de dades sí
+        self.assertEqual(self.autors("Rodo"), ["Rodolf Llorens"])
+        self.assertEqual(len(BackendGoogleBooksDeProva.crides), 2)
+
+        # Passada la pausa es deixa passar una petició de prova; si va bé es tanca
+        BackendGoogleBooksDeProva.error = None
+        self.circuit.obert_fins = 0
+        self.assertEqual(google_books.autors("C"), ["Mercè Rodoreda", "Joan Rodó"])
+        self.assertEqual(self.circuit.errors, 0)
+        self.assertEqual(len(BackendGoogleBooksDeProva.crides), 3)
+
+
+def importar_fila_a_fila(data):
+    """La vista import_users d'abans d'importacio.py, de referència."""
+    creats, error_details = 0, []
+    for user_data in data:
+        try:
+            email = user_data.get("email")
+            telefon = user_data.get("telefon")
+            if Usuari.objects.filter(email=email).exists():
+                error_details.append({"email": email, "error": "El email ja existeix"})
+                continue
+            if telefon and Usuari.objects.filter(telefon=telefon).exists():
+                error_details.append({"email": email, "error": "El teléfon ja existeix"})
+                continue
+            centre = Centre.objects.get_or_create(nom=user_data["centre"])[0] if user_data.get("centre") else None
+            grup = Grup.objects.get_or_create(nom=user_data["grup"])[0] if user_data.get("grup") else None
+            nou = Usuari(
+                username=importacio._username(user_data), email=email, first_name=user_data["nom"],
+                last_name=f"{user_data.get('cognom1', '')} {user_data.get('cognom2', '')}".strip(),
+                telefon=telefon, centre=centre, grup=grup,
+            )
+            nou.set_password("x")
+            # Sense ATOMIC_REQUESTS cada save era la seva pròpia transacció
+            with transaction.atomic():
+                nou.save()
+            creats += 1
+        except Exception as e:
+            error_details.append({"email": user_data.get("email", "desconocido"), "error": str(e)})
+    return creats, len(error_details), error_details
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], IMPORTACIO_LOT=2)
+class ImportacioTests(TestCase):
+    FILES = [
+        {"email": "a@x"},  # Sense nom: falla i no ocupa l'email
+        {"nom": "Bob", "cognom1": "Roig", "email": "a@x", "centre": "Centre A"},
+        {"nom": "Bea", "cognom1": "Roig", "email": "b@x", "telefon": "600000001"},  # Mateix usuari que Bob
+        {"nom": "Carla", "cognom1": "Puig", "email": "b@x", "grup": "1r"},
+        {"nom": "Dani", "cognom1": "Vila", "email": "d@x", "telefon": "600000001"},
+        {"nom": "Eva", "cognom1": "Mas", "email": "existent@x"},
+        {"nom": "Ferran", "cognom1": "Pla", "email": None, "centre": "Centre B"},
+        {"nom": "Gina", "cognom1": "Sala", "email": "g@x", "telefon": "600000009"},
+        {"nom": "Gerard", "cognom1": "Sala", "email": "g2@x"},
+        {"nom": "Hug", "cognom1": "Roca", "email": "h@x", "telefon": "600000009", "centre": "Centre A"},
+    ]
+
+    def setUp(self):
+        Usuari.objects.create_user(username="existent", email="existent@x", password="x")
+
+    def estat(self):
+        return sorted(
+            Usuari.objects.values_list("username", "email", "telefon", "centre__nom", "grup__nom")
+        ), sorted(Centre.objects.values_list("nom", flat=True)), sorted(Grup.objects.values_list("nom", flat=True))
+
+    def test_igual_que_fila_a_fila(self):
+        with transaction.atomic():
+            esperat = importar_fila_a_fila(self.FILES), self.estat()
+            transaction.set_rollback(True)
+        resultat = importacio.importar_usuaris(self.FILES), self.estat()
+        self.assertEqual(resultat, esperat)
+        self.assertEqual(resultat[0][:2], (4, 6))
+
+    def test_email_de_fila_fallida_queda_lliure(self):
+        creats, errors, _ = importacio.importar_usuaris([{"email": "a@x"}, {"nom": "Bob", "email": "a@x"}])
+        self.assertEqual((creats, errors), (1, 1))
+
+    @override_settings(IMPORTACIO_LOT=500)
+    def test_vista_amb_consultes_constants(self):
+        def importar(n, inici):
+            files = [
+                {"nom": f"Nom{i}", "cognom1": f"Cognom{i}", "email": f"u{i}@x", "telefon": f"6{i:08d}", "centre": "Centre A"}
+                for i in range(inici, inici + n)
+            ]
+            with CaptureQueriesContext(connection) as consultes:
+                resposta = self.client.post("/import_users/", json.dumps(files), content_type="application/json")
+            self.assertEqual(resposta.json(), {"created": n, "errors": 0})
+            return len(consultes)
+
+        importar(1, 0)  # Crea el centre
+        self.assertEqual(importar(3, 10), importar(30, 100))
+        usuari = Usuari.objects.get(email="u100@x")
+        self.assertEqual((usuari.first_name, usuari.last_name, usuari.centre.nom), ("Nom100", "Cognom100", "Centre A"))
+        self.assertTrue(usuari.has_usable_password())
+
+        resposta = self.client.post("/import_users/", json.dumps([{"nom": "Repetit", "email": "u0@x"}]),
+                                    content_type="application/json")
+        self.assertEqual(resposta.json(), {
+            "created": 0, "errors": 1, "error_details": [{"email": "u0@x", "error": "El email ja existeix"}],
+        })
+
+
+class EtiquetesTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        centre = Centre.objects.create(nom="Centre")
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=centre)
+        lector = Usuari.objects.create_user(username="lector", password="x")
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+        self.capcalera_lector = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(lector)}
+        self.llibre = Llibre.objects.create(titol="Llibre", CDU="821.134")
+        self.exemplars = [Exemplar.objects.create(cataleg=self.llibre, centre=centre) for _ in range(3)]
+        directori = tempfile.TemporaryDirectory()
+        self.addCleanup(directori.cleanup)
+        configuracio = override_settings(
+            ETIQUETES_CACHE_DIR=os.path.join(directori.name, "codis"),
+            ETIQUETES_TREBALLS_DIR=os.path.join(directori.name, "treballs"),
+        )
+        configuracio.enable()
+        self.addCleanup(configuracio.disable)
+
+    def pdf(self, renderer, exemplar_ids):
+        dades = {"exemplar_ids": exemplar_ids, "renderer": renderer}
+        resposta = self.client.post("/api/exemplars/generate-labels", dades, content_type="application/json",
+                                    **self.capcalera)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta["Content-Type"], "application/pdf")
+        contingut = b"".join(resposta.streaming_content) if resposta.streaming else resposta.content
+        return PdfReader(BytesIO(contingut))
+
+    def test_celes_i_pagines(self):
+        primer, _, tercer = (e.pk for e in self.exemplars)
+        with self.assertNumQueries(1):
+            exemplars = etiquetes.carregar_exemplars([tercer, 0, primer, tercer])
+        self.assertEqual([e.pk for e in exemplars], [tercer, primer, tercer])
+
+        celes = etiquetes.celes(exemplars)
+        self.assertEqual([c["type"] for c in celes[:2]], ["barcode", "cdu"])
+        self.assertEqual((celes[0]["registre"], celes[1]["CDU"]), (self.exemplars[2].registre, "821.134"))
+        # 36 exemplars = 72 cel·les: dues pàgines de FILES x COLUMNES, l'última completada amb None
+        pagines = etiquetes.paginar_celes(celes * 12)
+        self.assertEqual(len(pagines), 2)
+        for pagina in pagines:
+            self.assertEqual([len(fila) for fila in pagina], [etiquetes.COLUMNES] * etiquetes.FILES)
+        self.assertEqual(sum(c is None for f in pagines[1] for c in f), 2 * etiquetes.CELES_PER_PAGINA - 72)
+        self.assertEqual(len(etiquetes.paginar_celes([])), 1)
+
+    def test_codis_de_barres_al_disc(self):
+        png = etiquetes.codi_barres_png("EX-2025-000001")
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        with mock.patch.object(etiquetes, "Code128") as code128:
+            self.assertEqual(etiquetes.codi_barres_png("EX-2025-000001"), png)
+        code128.assert_not_called()
+
+    @override_settings(ETIQUETES_PAGINES_PER_LOT=1)
+    def test_pdf_per_lots(self):
+        ids = [e.pk for e in self.exemplars]
+        self.assertEqual(len(self.pdf("xhtml2pdf", ids).pages), 1)
+        # Més d'un lot: s'uneixen les parts i es retorna en streaming
+        self.assertEqual(len(self.pdf("xhtml2pdf", ids * 12).pages), 2)
+
+    @override_settings(ETIQUETES_PAGINES_PER_LOT=1)
+    def test_lots_escrits_a_mesura(self):
+        # Cada lot s'escriu al destí abans de renderitzar el següent: no s'acumulen les pàgines en memòria
+        ids = [e.pk for e in self.exemplars] * 34
+        renderitzar_html = etiquetes._renderitzar_html
+        mides = []
+        with BytesIO() as desti:
+            def renderitzar(pagines, part):
+                mides.append(desti.tell())
+                renderitzar_html(pagines, part)
+
+            with mock.patch.object(etiquetes, "_renderitzar_html", renderitzar):
+                pagines = etiquetes.escriure_pdf(etiquetes.carregar_exemplars(ids), desti)
+            pdf = PdfReader(BytesIO(desti.getvalue()), strict=True)
+        self.assertEqual((pagines, len(pdf.pages)), (3, 3))
+        self.assertTrue(0 < mides[0] < mides[1] < mides[2], mides)
+        self.assertIn(self.exemplars[0].registre, pdf.pages[2].extract_text())
+
+    def test_renderitzador_reportlab(self):
+        ids = [e.pk for e in self.exemplars]
+        pdf = self.pdf("reportlab", ids * 12)
+        self.assertEqual(len(pdf.pages), 2)
+        text = pdf.pages[0].extract_text()
+        self.assertIn(self.exemplars[0].registre, text)
+        self.assertIn("CDU: 821.134", text)
+        self.assertIn("Centre", text)
+
+        progres = []
+        with BytesIO() as desti:
+            pagines = etiquetes.escriure_pdf(etiquetes.carregar_exemplars(ids), desti, "reportlab",
+                                             lambda fetes, totals: progres.append((fetes, totals)))
+        self.assertEqual((pagines, progres), (1, [(1, 1)]))
+        with self.assertRaises(etiquetes.ErrorEtiquetes):
+            etiquetes.escriure_pdf([], BytesIO(), "desconegut")
+
+    def test_treball_en_segon_pla(self):
+        ruta = "/api/exemplars/generate-labels/jobs"
+        dades = {"exemplar_ids": [e.pk for e in self.exemplars], "renderer": "reportlab"}
+        with self.captureOnCommitCallbacks() as encuats:
+            resposta = self.client.post(ruta, dades, content_type="application/json", **self.capcalera)
+        self.assertEqual(resposta.status_code, 202)
+        treball = resposta.json()
+        self.assertEqual((treball["estat"], treball["descarrega"]), ("pendent", None))
+        self.assertEqual(len(encuats), 1)
+        self.assertEqual(self.client.get(f"{ruta}/{treball['id']}/pdf", **self.capcalera).status_code, 409)
+
+        # El treballador tanca la seva connexió en acabar; aquí és la del test
+        with mock.patch.object(treballs, "connection"):
+            treballs._executar(treball["id"])
+            treballs._executar(treball["id"])  # Un treball ja agafat no es torna a renderitzar
+        estat = self.client.get(f"{ruta}/{treball['id']}", **self.capcalera).json()
+        self.assertEqual((estat["estat"], estat["pagines_fetes"], estat["pagines_totals"]), ("acabat", 1, 1))
+        resposta = self.client.get(estat["descarrega"], **self.capcalera)
+        self.assertEqual(resposta["Content-Type"], "application/pdf")
+        self.assertEqual(len(PdfReader(BytesIO(b"".join(resposta.streaming_content))).pages), 1)
+
+        # Els mateixos exemplars reutilitzen el treball; si el PDF s'ha esborrat se'n fa un de nou
+        resposta = self.client.post(ruta, dades, content_type="application/json", **self.capcalera)
+        self.assertEqual(resposta.json()["id"], treball["id"])
+        os.remove(TreballEtiquetes.objects.get(pk=treball["id"]).fitxer)
+        self.assertEqual(self.client.get(estat["descarrega"], **self.capcalera).status_code, 410)
+        resposta = self.client.post(ruta, dades, content_type="application/json", **self.capcalera)
+        self.assertNotEqual(resposta.json()["id"], treball["id"])
+
+    @override_settings(ETIQUETES_TREBALL_TIMEOUT=60)
+    def test_reprendre_pendents(self):
+        ids = [self.exemplars[0].pk]
+        pendent = TreballEtiquetes.objects.create(exemplar_ids=ids, renderer="reportlab")
+        abandonat = TreballEtiquetes.objects.create(exemplar_ids=ids, renderer="reportlab", estat="en_curs")
+        en_curs = TreballEtiquetes.objects.create(exemplar_ids=ids, renderer="reportlab", estat="en_curs")
+        TreballEtiquetes.objects.filter(pk=abandonat.pk).update(actualitzat=timezone.now() - timedelta(minutes=5))
+
+        pool = mock.Mock()
+        with mock.patch.object(treballs, "_pool", return_value=pool), mock.patch.object(treballs, "connection"):
+            treballs._reprendre()
+        self.assertEqual(sorted(c.args[1] for c in pool.submit.call_args_list), [pendent.pk, abandonat.pk])
+        self.assertEqual(TreballEtiquetes.objects.get(pk=en_curs.pk).estat, "en_curs")
+
+    def test_netejar_caducats(self):
+        directori = treballs._directori()
+        os.makedirs(directori)
+        creats = {}
+        for nom, estat in (("vell", "acabat"), ("fallit", "error"), ("recent", "acabat"), ("pendent", "pendent")):
+            cami = os.path.join(directori, f"{nom}.pdf")
+            with open(cami, "wb") as f:
+                f.write(b"%PDF")
+            creats[nom] = TreballEtiquetes.objects.create(exemplar_ids=[], estat=estat, fitxer=cami)
+        fa_temps = timezone.now() - timedelta(days=8)
+        TreballEtiquetes.objects.exclude(pk=creats["recent"].pk).update(actualitzat=fa_temps)
+
+        sortida = StringIO()
+        call_command("clean_label_jobs", stdout=sortida)
+        self.assertIn("Deleted 2 expired label jobs", sortida.getvalue())
+        self.assertEqual(set(TreballEtiquetes.objects.values_list("pk", flat=True)),
+                         {creats["recent"].pk, creats["pendent"].pk})
+        self.assertEqual(sorted(os.listdir(directori)), ["pendent.pdf", "recent.pdf"])
+
+        with override_settings(ETIQUETES_TREBALL_CADUCITAT=0):
+            self.assertEqual(treballs.netejar_caducats(), 1)
+        self.assertFalse(os.path.exists(creats["recent"].fitxer))
+
+    def test_nomes_bibliotecaris(self):
+        treball = TreballEtiquetes.objects.create(exemplar_ids=[e.pk for e in self.exemplars], renderer="reportlab")
+        peticions = [
+            ("post", "/api/exemplars/generate-labels"),
+            ("post", "/api/exemplars/generate-labels/jobs"),
+            ("get", f"/api/exemplars/generate-labels/jobs/{treball.pk}"),
+            ("get", f"/api/exemplars/generate-labels/jobs/{treball.pk}/pdf"),
+        ]
+        for metode, ruta in peticions:
+            with self.subTest(ruta=ruta):
+                dades = {"exemplar_ids": [self.exemplars[0].pk]} if metode == "post" else None
+                for capcalera in ({}, self.capcalera_lector):
+                    resposta = getattr(self.client, metode)(ruta, dades, content_type="application/json", **capcalera)
+                    self.assertEqual(resposta.status_code, 401)
+        self.assertEqual(TreballEtiquetes.objects.count(), 1)
+
+
+class ImportacioFitxerVistesTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        directori = tempfile.TemporaryDirectory()
+        self.addCleanup(directori.cleanup)
+        configuracio = override_settings(IMPORTACIO_DIR=directori.name, IMPORTACIO_MIDA_MAXIMA=1024)
+        configuracio.enable()
+        self.addCleanup(configuracio.disable)
+        centre = Centre.objects.create(nom="Centre")
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=centre)
+        lector = Usuari.objects.create_user(username="lector", password="x")
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+        self.capcalera_lector = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(lector)}
+
+    def pujar(self, contingut, **capcalera):
+        fitxer = SimpleUploadedFile("usuaris.csv", contingut, content_type="text/csv")
+        return self.client.post("/import_users/stream/", {"fitxer": fitxer}, **capcalera)
+
+    def test_nomes_bibliotecaris(self):
+        csv = b"nom,cognom1,email\nAna,Puig,ana@x\n"
+        self.assertEqual(self.pujar(csv).status_code, 401)
+        self.assertEqual(self.pujar(csv, **self.capcalera_lector).status_code, 401)
+        resposta = self.pujar(csv, **self.capcalera)
+        self.assertEqual(resposta.status_code, 202)
+
+        codi = resposta.json()["id"]
+        self.assertEqual(str(ImportacioUsuaris.objects.get().codi), codi)
+        for ruta in (f"/import_users/stream/{codi}/", f"/import_users/stream/{codi}/errors/"):
+            self.assertEqual(self.client.get(ruta).status_code, 401)
+        self.assertEqual(self.client.get(f"/import_users/stream/{codi}/", **self.capcalera).json()["estat"], "pendent")
+        # Els ids seqüencials ja no serveixen
+        pk = ImportacioUsuaris.objects.get().pk
+        self.assertEqual(self.client.get(f"/import_users/stream/{pk}/", **self.capcalera).status_code, 404)
+
+    def test_fitxer_massa_gran(self):
+        resposta = self.pujar(b"nom,email\n" + b"Ana,ana@x\n" * 200, **self.capcalera)
+        self.assertEqual(resposta.status_code, 413)
+        self.assertFalse(ImportacioUsuaris.objects.exists())
+
+    def errors(self, codi):
+        resposta = self.client.get(f"/import_users/stream/{codi}/errors/", **self.capcalera)
+        return [json.loads(linia) for linia in b"".join(resposta.streaming_content).splitlines()]
+
+    @override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+    def test_importacio_completa(self):
+        csv = "nom;cognom1;email;centre\nAna;Puig;ana@x;Centre\nAnna;Pons;ana@x;\nBiel;Roca;biel@x;Nou\n"
+        with self.captureOnCommitCallbacks() as encuats:
+            codi = self.pujar(csv.encode("utf-8"), **self.capcalera).json()["id"]
+        self.assertEqual(len(encuats), 1)
+        # El fil d'importació tanca la seva connexió en acabar; aquí és la del test
+        with mock.patch.object(importacio, "connection"):
+            importacio._executar(ImportacioUsuaris.objects.get().pk)
+
+        estat = self.client.get(f"/import_users/stream/{codi}/", **self.capcalera).json()
+        self.assertEqual(
+            (estat["estat"], estat["files_totals"], estat["files_processades"], estat["created"], estat["errors"]),
+            ("acabat", 3, 3, 2, 1),
+        )
+        self.assertEqual(self.errors(codi), [{"email": "ana@x", "error": "El email ja existeix", "fila": 2}])
+        self.assertEqual(Usuari.objects.get(email="biel@x").centre.nom, "Nou")
+
+    @override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"], IMPORTACIO_LOT=2)
+    def test_repren_des_del_punt_de_control(self):
+        files = [json.dumps({"nom": f"Nom{i}", "cognom1": f"Cognom{i}", "email": f"u{i}@x"}) for i in range(5)]
+        files[3] = "{no és JSON"
+        fitxer = SimpleUploadedFile("usuaris.ndjson", "\n".join(files).encode("utf-8"))
+        with self.captureOnCommitCallbacks():
+            registre = importacio.crear_importacio(fitxer)
+
+        # El procés mor al segon bloc, amb l'error de la fila 4 ja escrit però sense confirmar
+        confirmar = importacio._confirmar_lot
+
+        def morir_al_segon_bloc(importacio_, lot, errors):
+            if lot[0][0] > 2:
+                errors.write(b'{"a mitges"')
+                raise SystemExit
+            confirmar(importacio_, lot, errors)
+
+        with mock.patch.object(importacio, "_confirmar_lot", morir_al_segon_bloc), self.assertRaises(SystemExit):
+            importacio.processar(registre)
+        registre = ImportacioUsuaris.objects.get()
+        self.assertEqual((registre.files_processades, registre.creats, registre.errors), (2, 2, 0))
+
+        importacio.processar(registre)
+        registre = ImportacioUsuaris.objects.get()
+        self.assertEqual(
+            (registre.estat, registre.files_processades, registre.creats, registre.errors), ("acabat", 5, 4, 1)
+        )
+        self.assertEqual(Usuari.objects.filter(email__endswith="@x").count(), 4)
+        self.assertEqual([e["fila"] for e in self.errors(registre.codi)], [4])
+
+
+class SegonPlaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.addCleanup(request_started.disconnect, dispatch_uid=segon_pla.DISPATCH_UID)
+        self.addCleanup(setattr, segon_pla, "_iniciat", False)
+        self.crides = []
+        for modul, funcio in ((suggeriments.index, "precarregar"), (treballs, "reprendre_pendents"),
+                              (importacio, "reprendre_pendents")):
+            patcher = mock.patch.object(modul, funcio, side_effect=lambda f=funcio: self.crides.append(f))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_nomes_amb_la_primera_peticio(self):
+        for modul in ("biblioteca-maricarmen.wsgi", "biblioteca-maricarmen.asgi"):
+            importlib.import_module(modul)
+        self.assertEqual(self.crides, [])
+
+        request_started.send(sender=self.__class__)
+        request_started.send(sender=self.__class__)
+        self.assertEqual(self.crides, ["precarregar", "reprendre_pendents", "reprendre_pendents"])
+
+
+class ComptadorRegistreTests(TestCase):
+
+    def setUp(self):
+        self.centre = Centre.objects.create(nom="Centre")
+        self.llibre = Llibre.objects.create(titol="Llibre")
+
+    def test_registres_consecutius(self):
+        primer = Exemplar.objects.create(cataleg=self.llibre, centre=self.centre)
+        segon = Exemplar.objects.create(cataleg=self.llibre, centre=self.centre)
+        self.assertRegex(primer.registre, r'^EX-\d{4}-\d{6}$')
+        self.assertEqual(int(segon.registre[-6:]), int(primer.registre[-6:]) + 1)
+
+    def test_reservar_bloc(self):
+        primer = Exemplar.reservar_registres(10)
+        seguent = Exemplar.reservar_registres()
+        self.assertEqual(seguent, primer + 10)
+
+    def test_registre_manual_avanca_comptador(self):
+        Exemplar.objects.create(cataleg=self.llibre, centre=self.centre, registre='EX-2001-000500')
+        exemplar = Exemplar.objects.create(cataleg=self.llibre, centre=self.centre)
+        self.assertEqual(exemplar.registre[-6:], '000501')
+
+    def test_comptador_inexistent_continua_pels_registres(self):
+        Exemplar.objects.create(cataleg=self.llibre, centre=self.centre, registre='EX-2010-000042')
+        Comptador.objects.all().delete()
+        self.assertEqual(Exemplar.reservar_registres(), 43)
+
+    def test_crear_en_bloc(self):
+        exemplars = Exemplar.objects.crear_en_bloc(self.llibre, self.centre, 5, exclos_prestec=True)
+        numeros = [int(e.registre[-6:]) for e in exemplars]
+        self.assertEqual(numeros, list(range(numeros[0], numeros[0] + 5)))
+        self.assertTrue(all(e.pk for e in exemplars))
+        self.assertEqual(Exemplar.objects.filter(cataleg=self.llibre, exclos_prestec=True).count(), 5)
+        seguent = Exemplar.objects.create(cataleg=self.llibre, centre=self.centre)
+        self.assertEqual(int(seguent.registre[-6:]), numeros[-1] + 1)
+
+
+class ComptadorConcurrenciaTests(TransactionTestCase):
+    FILS = 8
+    PER_FIL = 25
+
+    def setUp(self):
+        # La BD SQLite en memòria dels tests no espera els bloquejos entre connexions
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("Cal una base de dades real (MySQL, PostgreSQL o SQLite en fitxer)")
+
+    def test_insercions_concurrents_sense_duplicats(self):
+        centre = Centre.objects.create(nom="Centre")
+        llibre = Llibre.objects.create(titol="Llibre")
+        errors = []
+        inici = threading.Barrier(self.FILS)
+
+        def inserir():
+            try:
+                inici.wait()
+                for _ in range(self.PER_FIL):
+                    Exemplar.objects.create(cataleg_id=llibre.pk, centre_id=centre.pk)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        fils = [threading.Thread(target=inserir) for _ in range(self.FILS)]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+
+        self.assertEqual(errors, [])
+        registres = list(Exemplar.objects.values_list('registre', flat=True))
+        self.assertEqual(len(registres), self.FILS * self.PER_FIL)
+        numeros = sorted(int(r[-6:]) for r in registres)
+        self.assertEqual(numeros, list(range(numeros[0], numeros[0] + self.FILS * self.PER_FIL)))
+
+
+class SeedTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        with redirect_stderr(StringIO()):
+            call_command("seed_biblioteca", scale="small", seed=1, workers=1, stdout=StringIO())
+
+    def test_dates_del_seed(self):
+        # Amb --seed, les dates surten de DATA_REFERENCIA i no del dia en què s'executa
+        referencia = seed_biblioteca.DATA_REFERENCIA
+        self.assertFalse(Cataleg.objects.filter(data_edicio__gt=referencia).exists())
+        anys = {int(registre.split("-")[1]) for registre in Exemplar.objects.values_list("registre", flat=True)}
+        self.assertLessEqual(max(anys), referencia.year)
+        self.assertFalse(Prestec.objects.filter(data_prestec__gt=referencia).exists())
+        self.assertFalse(Reserva.objects.filter(data__gt=referencia).exists())
+
+        prestecs = seed_biblioteca.generar_prestecs(1, 0, 50, 10, 10, date(2000, 1, 1))
+        self.assertEqual(prestecs, seed_biblioteca.generar_prestecs(1, 0, 50, 10, 10, date(2000, 1, 1)))
+        self.assertTrue(all(date(1999, 7, 1) <= inici <= date(2000, 1, 1) for _, _, inici, _, _ in prestecs))
+
+    def test_mateixes_dades_amb_diversos_processos(self):
+        # Els lots es reparteixen entre processos però es desen en ordre: les dades no depenen de --workers
+        def files(model, excloure=()):
+            camps = [camp.attname for camp in model._meta.concrete_fields if camp.attname not in excloure]
+            return list(model.objects.order_by("pk").values_list(*camps))
+
+        def dades():
+            return {
+                "cataleg": files(Cataleg),
+                "exemplars": files(Exemplar),
+                # La contrasenya es xifra amb una sal aleatòria a cada execució
+                "usuaris": files(Usuari, excloure=("password",)),
+                "prestecs": files(Prestec),
+                "reserves": files(Reserva),
+            }
+
+        amb_un = dades()
+        self.assertTrue(all(amb_un.values()))
+        with redirect_stderr(StringIO()):
+            call_command("seed_biblioteca", scale="small", seed=1, workers=3, stdout=StringIO())
+        self.assertEqual(dades(), amb_un)
+
+
+@override_settings(TOKENS_SIGNATS=False)
+class TokensOpacsTests(TestCase):
+
+    def setUp(self):
+        tokens.cache.buidar()
+        self.usuari = Usuari.objects.create_user(username="lector", password="x")
+
+    def test_desa_nomes_el_hash(self):
+        token = tokens.emetre(self.usuari)
+        self.usuari.refresh_from_db()
+        self.assertEqual(self.usuari.auth_token, tokens.hash_token(token))
+        self.assertEqual(tokens.usuari_per_token(token).pk, self.usuari.pk)
+        self.assertIsNone(tokens.usuari_per_token(self.usuari.auth_token))
+
+    def test_segona_consulta_sense_queries(self):
+        token = tokens.emetre(self.usuari)
+        tokens.usuari_per_token(token)
+        with self.assertNumQueries(0):
+            self.assertEqual(tokens.usuari_per_token(token).pk, self.usuari.pk)
+
+    def test_token_nou_invalida_l_anterior(self):
+        antic = tokens.emetre(self.usuari)
+        tokens.usuari_per_token(antic)
+        tokens.emetre(self.usuari)
+        self.assertIsNone(tokens.usuari_per_token(antic))
+
+    def test_usuari_desactivat(self):
+        token = tokens.emetre(self.usuari)
+        tokens.usuari_per_token(token)
+        self.usuari.is_active = False
+        self.usuari.save()
+        self.assertIsNone(tokens.usuari_per_token(token))
+
+
+class TokensSignatsTests(TestCase):
+
+    def setUp(self):
+        tokens.revocats.buidar()
+        tokens.logins.buidar()
+        self.centre = Centre.objects.create(nom="Centre")
+        self.usuari = Usuari.objects.create_user(username="bibliotecari", password="x",
+                                                 is_staff=True, centre=self.centre)
+
+    def test_verificacio_sense_queries(self):
+        token = tokens.emetre(self.usuari)
+        tokens.revocats.conte(None)  # primera lectura dels revocats
+        with self.assertNumQueries(0):
+            usuari = tokens.usuari_per_token(token)
+            self.assertEqual((usuari.pk, usuari.username, usuari.centre_id), (self.usuari.pk, "bibliotecari", self.centre.pk))
+            self.assertTrue(usuari.is_staff)
+        self.assertEqual(usuari.email, self.usuari.email)
+
+    def test_token_caducat_o_manipulat(self):
+        with override_settings(TOKENS_DURADA=-1):
+            caducat = tokens.emetre(self.usuari)
+        self.assertIsNone(tokens.usuari_per_token(caducat))
+        self.assertIsNone(tokens.usuari_per_token(tokens.emetre(self.usuari) + "x"))
+        # Encara es pot refrescar
+        self.assertIsNotNone(tokens.usuari_per_token(tokens.refrescar(caducat)))
+
+    def test_refrescar_revoca_l_anterior(self):
+        token = tokens.emetre(self.usuari)
+        nou = tokens.refrescar(token)
+        self.assertIsNotNone(tokens.usuari_per_token(nou))
+        self.assertIsNone(tokens.usuari_per_token(token))
+        self.assertIsNone(tokens.refrescar(token))
+
+    def test_logout(self):
+        token = tokens.emetre(self.usuari)
+        tokens.revocar(token)
+        self.assertIsNone(tokens.usuari_per_token(token))
+        # Els altres processos ho llegeixen de la base de dades
+        tokens.revocats.buidar()
+        self.assertIsNone(tokens.usuari_per_token(token))
+
+    def test_usuari_desactivat_no_refresca(self):
+        token = tokens.emetre(self.usuari)
+        self.usuari.is_active = False
+        self.usuari.save()
+        self.assertIsNone(tokens.refrescar(token))
+
+    @override_settings(TOKENS_SIGNATS=False)
+    def test_token_opac_durant_la_migracio(self):
+        opac = tokens.emetre(self.usuari)
+        self.assertEqual(tokens.usuari_per_token(opac).pk, self.usuari.pk)
+        self.assertIsNotNone(tokens.usuari_per_token(tokens.refrescar(opac)))
+        with override_settings(TOKENS_OPACS=False):
+            self.assertIsNone(tokens.usuari_per_token(opac))
+
+    def test_login_reutilitza_el_token(self):
+        token = tokens.iniciar_sessio("bibliotecari", "x")
+        with mock.patch("biblioteca.tokens.authenticate") as authenticate:
+            self.assertEqual(tokens.iniciar_sessio("bibliotecari", "x"), token)
+            authenticate.assert_not_called()
+        self.assertIsNone(tokens.iniciar_sessio("bibliotecari", "y"))
+
+    def test_login_despres_de_logout_o_canvi_de_contrasenya(self):
+        token = tokens.iniciar_sessio("bibliotecari", "x")
+        tokens.revocar(token)
+        nou = tokens.iniciar_sessio("bibliotecari", "x")
+        self.assertNotEqual(nou, token)
+        self.usuari.set_password("y")
+        self.usuari.save()
+        self.assertIsNone(tokens.iniciar_sessio("bibliotecari", "x"))
+
+
+class PermisosTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        self.centre = Centre.objects.create(nom="Centre")
+        self.usuari = Usuari.objects.create_user(username="bibliotecari", password="x",
+                                                 is_staff=True, centre=self.centre)
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(self.usuari)}
+
+    def test_usuari_sense_consultes(self):
+        self.client.get("/api/usuari", **self.capcalera)
+        with self.assertNumQueries(0):
+            resposta = self.client.get("/api/usuari", **self.capcalera)
+        self.assertEqual(resposta.json()["centre"], {"id": self.centre.pk, "nom": "Centre"})
+
+    def test_grups_i_permisos_invaliden(self):
+        self.assertFalse(self.usuari.is_bibliotecari())
+        self.usuari.groups.add(Group.objects.get_or_create(name=permisos.GRUP_BIBLIOTECARIS)[0])
+        self.assertTrue(self.usuari.is_bibliotecari())
+
+        grup = Group.objects.create(name="Altres")
+        self.usuari.groups.add(grup)
+        self.assertFalse(permisos.instantania(self.usuari).te_permis("auth.view_group"))
+        grup.permissions.add(Permission.objects.get(codename="view_group"))
+        self.assertTrue(permisos.instantania(self.usuari).te_permis("auth.view_group"))
+
+        self.usuari.user_permissions.add(Permission.objects.get(codename="add_prestec"))
+        resposta = self.client.get("/api/usuari", **self.capcalera)
+        self.assertEqual([p["name"] for p in resposta.json()["user_permissions"]], ["Can add prestec"])
+
+    def test_centre_desat_invalida(self):
+        permisos.instantania(self.usuari)
+        self.centre.nom = "Nou nom"
+        self.centre.save()
+        self.assertEqual(permisos.instantania(self.usuari).centre_nom, "Nou nom")
+
+    def test_exemplars_en_bloc_amb_dades_actuals(self):
+        # El token signat porta is_staff i el centre del moment en què es va emetre
+        llibre = Llibre.objects.create(titol="Llibre")
+        altre = Centre.objects.create(nom="Altre")
+        self.usuari.centre = altre
+        self.usuari.save()
+        resposta = self.client.post("/api/exemplars/bulk", {"cataleg_id": llibre.pk, "quantitat": 2},
+                                    content_type="application/json", **self.capcalera)
+        self.assertEqual(resposta.status_code, 201, resposta.content)
+        self.assertEqual(set(Exemplar.objects.values_list("centre", flat=True)), {altre.pk})
+
+        self.usuari.is_staff = False
+        self.usuari.save()
+        resposta = self.client.post("/api/exemplars/bulk", {"cataleg_id": llibre.pk, "quantitat": 2},
+                                    content_type="application/json", **self.capcalera)
+        self.assertEqual(resposta.status_code, 401)
+
+
+class PrestecTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        self.centre = Centre.objects.create(nom="Centre")
+        self.bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x",
+                                                       is_staff=True, centre=self.centre)
+        self.lector = Usuari.objects.create_user(username="lector", password="x")
+        self.exemplar = Exemplar.objects.create(cataleg=Llibre.objects.create(titol="Llibre"), centre=self.centre)
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(self.bibliotecari)}
+
+    def prestar(self):
+        return self.client.post("/api/prestecs/crear/", {"usuari_id": self.lector.pk, "exemplar_id": self.exemplar.pk},
+                                content_type="application/json", **self.capcalera)
+
+    def test_prestec(self):
+        resposta = self.prestar()
+        self.assertEqual(resposta.status_code, 200)
+        self.assertTrue(resposta.json()["exemplar"]["exclos_prestec"])
+        self.exemplar.refresh_from_db()
+        self.assertTrue(self.exemplar.exclos_prestec)
+        self.assertEqual(Log.objects.filter(tipus="INFO").count(), 1)
+
+    def test_exemplar_ja_prestat(self):
+        self.prestar()
+        resposta = self.prestar()
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(Prestec.objects.count(), 1)
+
+    def test_exemplar_amb_prestec_obert(self):
+        Prestec.objects.create(usuari=self.lector, exemplar=self.exemplar)
+        self.assertEqual(self.prestar().status_code, 409)
+        self.assertEqual(Prestec.objects.count(), 1)
+
+    def test_baixa_entre_la_lectura_i_el_prestec(self):
+        # Simula un canvi d'un altre bibliotecari després de llegir l'exemplar
+        original = Exemplar.objects.select_related
+
+        def llegir_i_donar_de_baixa(*args):
+            llegit = original(*args).get(pk=self.exemplar.pk)
+            Exemplar.objects.filter(pk=self.exemplar.pk).update(baixa=True)
+            return mock.Mock(get=lambda **kwargs: llegit)
+
+        with mock.patch.object(Exemplar.objects, "select_related", llegir_i_donar_de_baixa):
+            resposta = self.prestar()
+        self.assertEqual(resposta.status_code, 409)
+        self.assertEqual(Prestec.objects.count(), 0)
+
+
+class PrestecsLotTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        self.centre = Centre.objects.create(nom="Centre")
+        altre = Centre.objects.create(nom="Altre")
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=self.centre)
+        self.lector = Usuari.objects.create_user(username="lector", password="x")
+        llibre = Llibre.objects.create(titol="Llibre")
+        self.exemplars = Exemplar.objects.crear_en_bloc(llibre, self.centre, 4)
+        self.exemplars[2].baixa = True
+        self.exemplars[2].save()
+        self.extern = Exemplar.objects.create(cataleg=llibre, centre=altre)
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+
+    def post(self, ruta, dades):
+        return self.client.post(ruta, dades, content_type="application/json", **self.capcalera)
+
+    def test_prestar_i_retornar_en_lot(self):
+        registres = [e.registre for e in self.exemplars] + [self.extern.registre, "NO-EXISTEIX", self.exemplars[0].registre]
+        resposta = self.post("/api/prestecs/lot", {"usuari_id": self.lector.pk, "registres": registres})
+        self.assertEqual(resposta.status_code, 200)
+        resultats = resposta.json()["resultats"]
+        self.assertEqual([r["registre"] for r in resultats], registres)
+        self.assertEqual([r["ok"] for r in resultats], [True, True, False, True, False, False, False])
+        self.assertEqual(resposta.json()["correctes"], 3)
+        self.assertEqual(Prestec.objects.filter(usuari=self.lector, data_retorn__isnull=True).count(), 3)
+        self.assertEqual(Log.objects.filter(accio__startswith="Préstamo creado").count(), 3)
+
+        with self.assertNumQueries(10):
+            resposta = self.post("/api/prestecs/retorn", {"registres": registres[:4]})
+        self.assertEqual([r["ok"] for r in resposta.json()["resultats"]], [True, True, False, True])
+        self.assertFalse(Prestec.objects.filter(data_retorn__isnull=True).exists())
+        self.assertFalse(Exemplar.objects.filter(pk__in=[e.pk for e in self.exemplars], exclos_prestec=True).exists())
+        resposta = self.post("/api/prestecs/retorn", {"registres": registres[:1]})
+        self.assertEqual(resposta.json()["resultats"][0]["error"], "El ejemplar no tiene ningún préstamo activo")
+
+    def test_exemplar_amb_prestec_obert(self):
+        # Préstec creat des de l'admin: l'exemplar no s'ha marcat com a exclòs
+        Prestec.objects.create(usuari=self.lector, exemplar=self.exemplars[0])
+        registres = [self.exemplars[0].registre, self.exemplars[1].registre]
+        resposta = self.post("/api/prestecs/lot", {"usuari_id": self.lector.pk, "registres": registres})
+        self.assertEqual(resposta.status_code, 200)
+        resultats = resposta.json()["resultats"]
+        self.assertEqual([r["ok"] for r in resultats], [False, True])
+        self.assertEqual(resultats[0]["error"], "El ejemplar ya tiene un préstamo activo")
+
+    def test_lot_buit_o_massa_gran(self):
+        self.assertEqual(self.post("/api/prestecs/retorn", {"registres": []}).status_code, 422)
+        massa = ["X"] * (circulacio.MAX_PER_LOT + 1)
+        self.assertEqual(self.post("/api/prestecs/lot", {"usuari_id": self.lector.pk, "registres": massa}).status_code, 422)
+
+
+class DisponibilitatTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        self.centre = Centre.objects.create(nom="Centre")
+        self.altre = Centre.objects.create(nom="Altre")
+        self.llibre = Llibre.objects.create(titol="Llibre")
+        self.exemplars = Exemplar.objects.crear_en_bloc(self.llibre, self.centre, 3)
+        Exemplar.objects.create(cataleg=self.llibre, centre=self.altre, exclos_prestec=True)
+
+    def comptadors(self):
+        return {
+            d.centre_id: (d.disponible, d.exclos_prestec, d.baixa)
+            for d in DisponibilitatExemplars.objects.filter(cataleg=self.llibre)
+        }
+
+    def test_canvis_dels_exemplars(self):
+        self.assertEqual(self.comptadors(), {self.centre.pk: (3, 0, 0), self.altre.pk: (0, 1, 0)})
+        exemplar = self.exemplars[0]
+        exemplar.baixa = True
+        exemplar.save()
+        exemplar.centre = self.altre
+        exemplar.save()
+        self.exemplars[1].delete()
+        self.assertEqual(self.comptadors(), {self.centre.pk: (1, 0, 0), self.altre.pk: (0, 1, 1)})
+        self.assertEqual(disponibilitat.per_cataleg([self.llibre.pk]),
+                         {self.llibre.pk: {"disponible": 1, "exclos_prestec": 1, "baixa": 1}})
+
+    def test_prestec_i_retorn(self):
+        bibliotecari = permisos.instantania(
+            Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=self.centre)
+        )
+        lector = Usuari.objects.create_user(username="lector", password="x")
+        registres = [e.registre for e in self.exemplars[:2]]
+        circulacio.prestar(bibliotecari, lector, registres)
+        self.assertEqual(self.comptadors()[self.centre.pk], (1, 2, 0))
+        circulacio.retornar(bibliotecari, registres)
+        self.assertEqual(self.comptadors()[self.centre.pk], (3, 0, 0))
+
+    def test_reconciliar(self):
+        # Canvis que no passen pels senyals
+        Exemplar.objects.filter(pk=self.exemplars[0].pk).update(baixa=True)
+        DisponibilitatExemplars.objects.filter(centre=self.altre).delete()
+        self.assertEqual(disponibilitat.reconciliar(reparar=False), 2)
+        call_command("reconcile_availability", stdout=StringIO())
+        self.assertEqual(self.comptadors(), {self.centre.pk: (2, 0, 1), self.altre.pk: (0, 1, 0)})
+        self.assertEqual(disponibilitat.reconciliar(), 0)
+
+
+class PrestecConcurrenciaTests(TransactionTestCase):
+    PETICIONS = 8
+
+    def setUp(self):
+        # La BD SQLite en memòria dels tests no espera els bloquejos entre connexions
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("Cal una base de dades real (MySQL, PostgreSQL o SQLite en fitxer)")
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+
+    def test_un_sol_prestec_per_exemplar(self):
+        centre = Centre.objects.create(nom="Centre")
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=centre)
+        lectors = [Usuari.objects.create_user(username=f"lector{i}", password="x") for i in range(self.PETICIONS)]
+        exemplar = Exemplar.objects.create(cataleg=Llibre.objects.create(titol="Llibre"), centre=centre)
+        capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+        codis = []
+        inici = threading.Barrier(self.PETICIONS)
+
+        def prestar(lector):
+            try:
+                client = Client()
+                inici.wait()
+                resposta = client.post("/api/prestecs/crear/", {"usuari_id": lector.pk, "exemplar_id": exemplar.pk},
+                                       content_type="application/json", **capcalera)
+                codis.append(resposta.status_code)
+            finally:
+                connection.close()
+
+        fils = [threading.Thread(target=prestar, args=(lector,)) for lector in lectors]
+        for fil in fils:
+            fil.start()
+        for fil in fils:
+            fil.join()
+
+        self.assertEqual(codis.count(200), 1)
+        self.assertTrue(all(codi in (400, 409) for codi in codis if codi != 200), codis)
+        self.assertEqual(Prestec.objects.filter(exemplar=exemplar).count(), 1)
+        self.assertEqual(disponibilitat.per_cataleg([exemplar.cataleg_id])[exemplar.cataleg_id]["exclos_prestec"], 1)
+
+
+class IndexosTests(TestCase):
+    """
+    Les consultes dels endpoints més usats no han de recórrer cap taula gran
+    sencera: es comprova el pla (EXPLAIN) de cadascuna sobre dades de
+    seed_biblioteca. Amb més dades: ESCALA = 'large'.
+    """
+    ESCALA = 'small'
+    TAULES = {model._meta.db_table for model in (
+        Cataleg, DisponibilitatExemplars, Exemplar, Llibre, Log, Prestec, Reserva, TokenRevocat, Usuari,
+    )}
+
+    @classmethod
+    def setUpTestData(cls):
+        with redirect_stderr(StringIO()):
+            call_command("seed_biblioteca", scale=cls.ESCALA, seed=1, workers=1, stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        tokens.logins.buidar()
+
+    def escanejos_complets(self, sql, params):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                passos = [fila[3] for fila in cursor.fetchall()]
+                if re.search(r"\bLIMIT\b", sql) and not any("TEMP B-TREE FOR ORDER BY" in pas for pas in passos):
+                    return []  # Recorre la taula en l'ordre demanat i s'atura al LIMIT
+                return [pas.split()[1] for pas in passos if re.fullmatch(r"SCAN \S+", pas)]
+            if connection.vendor == 'postgresql':
+                # Sense seqüencials si hi ha cap índex que serveixi, sigui quina sigui la mida de les taules
+                cursor.execute("SET LOCAL enable_seqscan = off")
+                cursor.execute("EXPLAIN " + sql, params)
+                return re.findall(r'Seq Scan on "?(\w+)', "\n".join(fila[0] for fila in cursor.fetchall()))
+            cursor.execute("EXPLAIN " + sql, params)
+            columnes = [c[0] for c in cursor.description]
+            return [
+                fila[columnes.index("table")] for fila in cursor.fetchall()
+                if fila[columnes.index("type")] == "ALL"
+            ]
+
+    def assertSenseEscanejos(self, nom, funcio):
+        consultes = []
+
+        def capturar(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith("SELECT"):
+                consultes.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(capturar):
+            funcio()
+        self.assertTrue(consultes, nom)
+        for sql, params in consultes:
+            taules = set(self.escanejos_complets(sql, params)) & self.TAULES
+            self.assertFalse(taules, f"{nom}: escaneig complet de {sorted(taules)}\n{sql}")
+
+    def test_endpoints_amb_index(self):
+        centre = Centre.objects.first()
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari_explain", password="x", is_staff=True, centre=centre)
+        lector = Prestec.objects.filter(data_retorn__isnull=True).first().usuari
+        exemplar = Exemplar.objects.filter(centre=centre, exclos_prestec=False, baixa=False).first()
+        prestat = Prestec.objects.filter(data_retorn__isnull=True, exemplar__centre=centre).first().exemplar
+        capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+        paraula = Cataleg.objects.exclude(tipus="indefinit").first().titol.split()[0]
+
+        peticions = [
+            ("get", "/api/exemplars/", None),
+            ("get", f"/api/exemplars/search/?centre_id={centre.pk}", None),
+            ("get", f"/api/exemplars/search/?code={exemplar.registre}", None),
+            ("get", f"/api/exemplars/by-item/{exemplar.cataleg_id}", None),
+            ("get", f"/api/exemplars/{exemplar.pk}/", None),
+            ("get", "/api/llibres/", None),
+            ("get", "/api/usuari/", None),
+            ("get", "/api/usuarios-disponibles/", None),
+            ("get", f"/api/usuari/historial_prestecs?usuari_id={bibliotecari.pk}", None),
+            ("post", "/api/prestecs/lot", {"usuari_id": lector.pk, "registres": [exemplar.registre]}),
+            ("post", "/api/prestecs/retorn", {"registres": [prestat.registre]}),
+        ]
+        if cerca.disponible():
+            peticions.append(("get", f"/api/cataleg/search/?q={paraula}", None))
+        for metode, ruta, dades in peticions:
+            with self.subTest(ruta=ruta):
+                def peticio():
+                    if metode == "get":
+                        resposta = self.client.get(ruta, **capcalera)
+                    else:
+                        resposta = self.client.post(ruta, dades, content_type="application/json", **capcalera)
+                    self.assertEqual(resposta.status_code, 200, resposta.content)
+                self.assertSenseEscanejos(ruta, peticio)
+
+        self.assertSenseEscanejos("/api/token", lambda: self.client.get(
+            "/api/token", HTTP_AUTHORIZATION="Basic " + base64.b64encode(b"bibliotecari_explain:x").decode()
+        ))
+        usuaris = list(Usuari.objects.exclude(email="").values_list("email", "telefon")[:20])
+        self.assertSenseEscanejos("importació", lambda: (
+            importacio._existents("email", [e for e, _ in usuaris]),
+            importacio._existents("telefon", [t for _, t in usuaris]),
+        ))
+        self.assertSenseEscanejos("log", lambda: list(
+            Log.objects.filter(data_accio__gte=timezone.now() - timedelta(days=1), tipus="ERROR")
+        ))
+
+    def test_prestecs_actius_del_seed(self):
+        # Com els de l'API: l'exemplar amb un préstec actiu no està disponible
+        actius = Prestec.objects.filter(data_retorn__isnull=True)
+        self.assertTrue(actius.exists())
+        self.assertFalse(actius.filter(exemplar__exclos_prestec=False).exists())
+        self.assertEqual(disponibilitat.reconciliar(reparar=False), 0)
+
+
+class BenchmarkTests(TestCase):
+
+    def test_cada_endpoint_te_cas_i_referencia(self):
+        operacions = set(benchmark.operacions())
+        self.assertEqual(operacions, set(benchmark.CASOS))
+        self.assertEqual({f"{metode} {ruta}" for metode, ruta in operacions}, set(benchmark.llegir_baseline()))
+
+    def test_comparar(self):
+        abans = {"GET /x": {"consultes": 3, "p50_ms": 10.0, "p95_ms": 12.0, "memoria_kb": 100.0}}
+        ara = {"GET /x": {"estat": 200, "esperat": 200, "consultes": 4, "p50_ms": 11.0, "p95_ms": 30.0, "memoria_kb": 100.0}}
+        files, regressions = benchmark.comparar(ara, abans)
+        self.assertEqual(regressions, ["GET /x"])
+        self.assertEqual(files[0][3], ["queries", "p95"])
+        self.assertIn("3→4 (+1)", benchmark.taula(files)[1])
+
+
+@override_settings(INSTRUMENTACIO=True, INSTRUMENTACIO_LLINDAR_MS=60_000)
+class InstrumentacioTests(TestCase):
+
+    def setUp(self):
+        permisos.cache.buidar()
+        tokens.revocats.buidar()
+        instrumentacio.estadistiques.buidar()
+        centre = Centre.objects.create(nom="Centre")
+        bibliotecari = Usuari.objects.create_user(username="bibliotecari", password="x", is_staff=True, centre=centre)
+        self.lector = Usuari.objects.create_user(username="lector", password="x")
+        self.llibre = Llibre.objects.create(titol="Llibre")
+        Exemplar.objects.crear_en_bloc(self.llibre, centre, 2)
+        self.capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(bibliotecari)}
+
+    def test_server_timing_i_estadistiques(self):
+        for _ in range(2):
+            resposta = self.client.get(f"/api/exemplars/by-item/{self.llibre.pk}")
+        entrades = resposta["Server-Timing"].split(", ")
+        self.assertRegex(entrades[0], r'^db;dur=[\d.]+;desc="[1-9]\d* consultes"$')
+        self.assertTrue(entrades[1].startswith("python;dur="))
+        self.assertTrue(any(e.startswith("sql1;dur=") and "SELECT" in e for e in entrades))
+
+        resposta = self.client.get("/api/instrumentacio/rutes", **self.capcalera)
+        self.assertTrue(resposta.json()["activa"])
+        rutes = {r["ruta"]: r for r in resposta.json()["rutes"]}
+        fila = rutes["GET /api/exemplars/by-item/<item_id>"]
+        self.assertEqual(fila["peticions"], 2)
+        self.assertEqual(fila["lentes"], 0)
+        self.assertGreater(fila["mitjana_consultes"], 0)
+
+        capcalera = {"HTTP_AUTHORIZATION": "Bearer " + tokens.emetre(self.lector)}
+        self.assertEqual(self.client.get("/api/instrumentacio/rutes", **capcalera).status_code, 401)
+
+    @override_settings(INSTRUMENTACIO_LLINDAR_MS=0)
+    def test_peticio_lenta_al_log(self):
+        with self.assertLogs("biblioteca.peticions_lentes", "WARNING") as logs:
+            self.client.get(f"/api/exemplars/by-item/{self.llibre.pk}")
+        registre = json.loads(logs.records[0].getMessage())
+        self.assertEqual(registre["ruta"], "GET /api/exemplars/by-item/<item_id>")
+        self.assertEqual(len(registre["sql"]), registre["consultes"])
+        self.assertTrue(all("SELECT" in c["sql"] or "INSERT" in c["sql"] for c in registre["sql"]))
+
+    @override_settings(INSTRUMENTACIO=False)
+    def test_desactivada(self):
+        resposta = self.client.get(f"/api/exemplars/by-item/{self.llibre.pk}")
+        self.assertNotIn("Server-Timing", resposta)
+        self.assertEqual(instrumentacio.estadistiques.resum(), [])
@@ -0,0 +1,312 @@
+"""
+Tokens d'accés de l'API (AuthBearer).
+
+Tokens signats (TOKENS_SIGNATS, per defecte):
+- /token retorna un token signat amb django.core.signing que porta l'id, el
+  nom d'usuari, el centre, els indicadors de staff i superusuari i la
+  caducitat (TOKENS_DURADA segons). Es verifica sense cap consulta i l'usuari
+  de la petició es construeix amb aquestes dades; els altres camps es carreguen
+  de la base de dades només si una vista els fa servir.
+- En tancar la sessió el token es revoca (TokenRevocat). Cada procés té una
+  còpia dels revocats que actualitza com a molt cada TOKENS_REVOCATS_INTERVAL
+  segons.
+- /token/refresh canvia un token vàlid, o caducat fa menys de TOKENS_REFRESC
+  segons, per un de nou i revoca l'anterior. Les dades del token (centre,
+  staff) i que l'usuari sigui actiu es tornen a comprovar en aquest moment.
+
+Inici de sessió (/token):
+- La contrasenya es comprova una sola vegada (PBKDF2). Durant TOKENS_LOGIN_TTL
+  segons, les mateixes credencials tornen el mateix token sense tornar-la a
+  xifrar, sempre que el token encara sigui vàlid i li quedin com a mínim
+  TOKENS_REUS_MINIM segons. La clau de la memòria cau és un HMAC de l'usuari i
+  la contrasenya, mai la contrasenya.
+
+Tokens opacs (els d'abans, acceptats mentre TOKENS_OPACS sigui cert):
+- A la base de dades només es desa el SHA-256 del token (Usuari.auth_token,
+  indexat): una fuita de la taula no dona tokens vàlids i la cerca no recorre
+  tots els usuaris.
+- Cada procés té una memòria cau LRU token→usuari de TOKENS_CACHE_MAX entrades
+  que caduquen als TOKENS_CACHE_TTL segons.
+- Desar un usuari (token nou, desactivació...) o esborrar-lo buida les seves
+  entrades d'aquest procés; els altres processos ho veuen en caducar el TTL.
+"""
+import copy
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.core import signing
+from django.db import IntegrityError, router
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from .models import TokenRevocat, Usuari
+
+SALT = "biblioteca.tokens"
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def es_signat(token):
+    # Els opacs són hexadecimals; els signats porten les signatures separades per ':'
+    return ":" in token
+
+
+class CacheTokens:
+    """LRU amb caducitat: clau → (id de l'usuari, valor)."""
+
+    def __init__(self, maxim=None, ttl=None):
+        self.maxim = maxim
+        self.ttl = ttl
+        self._entrades = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _maxim(self):
+        return self.maxim if self.maxim is not None else _config("TOKENS_CACHE_MAX", 1024)
+
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else _config("TOKENS_CACHE_TTL", 60)
+
+    def obtenir(self, clau):
+        with self._lock:
+            entrada = self._entrades.get(clau)
+            if entrada is None:
+                return None
+            _, valor, caduca = entrada
+            if time.monotonic() >= caduca:
+                del self._entrades[clau]
+                return None
+            self._entrades.move_to_end(clau)
+            return valor
+
+    def desar(self, clau, usuari_id, valor):
+        with self._lock:
+            self._entrades[clau] = (usuari_id, valor, time.monotonic() + self._ttl())
+            self._entrades.move_to_end(clau)
+            while len(self._entrades) > self._maxim():
+                self._entrades.popitem(last=False)
+
+    def eliminar(self, clau):
+        with self._lock:
+            self._entrades.pop(clau, None)
+
+    def invalidar_usuari(self, usuari_id):
+        with self._lock:
+            for clau in [c for c, (u, _, _) in self._entrades.items() if u == usuari_id]:
+                del self._entrades[clau]
+
+    def buidar(self):
+        with self._lock:
+            self._entrades.clear()
+
+
+class Revocats:
+    """Còpia en memòria dels jti revocats, actualitzada per increments."""
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.buidar()
+
+    def _interval(self):
+        return self.interval if self.interval is not None else _config("TOKENS_REVOCATS_INTERVAL", 5)
+
+    def buidar(self):
+        with self._lock:
+            self._jtis = {}
+            self._darrer_id = 0
+            self._propera = 0
+
+    def _actualitzar(self):
+        ara = timezone.now()
+        nous = TokenRevocat.objects.filter(id__gt=self._darrer_id, caduca__gt=ara).order_by("id")
+        for revocat_id, jti, caduca in nous.values_list("id", "jti", "caduca"):
+            self._jtis[jti] = caduca
+            self._darrer_id = revocat_id
+        self._jtis = {jti: caduca for jti, caduca in self._jtis.items() if caduca > ara}
+
+    def conte(self, jti):
+        with self._lock:
+            if time.monotonic() >= self._propera:
+                self._actualitzar()
+                self._propera = time.monotonic() + self._interval()
+            return jti in self._jtis
+
+    def afegir(self, jti, caduca):
+        TokenRevocat.objects.filter(caduca__lte=timezone.now()).delete()
+        try:
+            TokenRevocat.objects.create(jti=jti, caduca=caduca)
+        except IntegrityError:
+            pass  # Ja estava revocat
+        with self._lock:
+            self._jtis[jti] = caduca
+
+
+class CacheLogins(CacheTokens):
+    """HMAC de les credencials → darrer token emès."""
+
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else _config("TOKENS_LOGIN_TTL", 300)
+
+
+cache = CacheTokens()
+logins = CacheLogins()
+revocats = Revocats()
+
+
+# Tokens signats
+
+def emetre_signat(usuari):
+    dades = {
+        "u": usuari.pk,
+        "n": usuari.username,
+        "c": usuari.centre_id,
+        "s": usuari.is_staff,
+        "a": usuari.is_superuser,
+        "e": int(time.time()) + _config("TOKENS_DURADA", 3600),
+        "j": secrets.token_hex(8),
+    }
+    return signing.dumps(dades, salt=SALT)
+
+
+def verificar_signat(token, marge=0):
+    """Dades d'un token signat vàlid (caducat fa menys de `marge` segons) i no revocat, o None."""
+    try:
+        dades = signing.loads(token, salt=SALT)
+    except signing.BadSignature:
+        return None
+    if not isinstance(dades, dict) or dades.get("e", 0) + marge <= time.time():
+        return None
+    if revocats.conte(dades.get("j")):
+        return None
+    return dades
+
+
+def _usuari_de(dades):
+    # Els camps que no porta el token queden diferits: es carreguen si es fan servir
+    valors = {
+        "id": dades["u"], "username": dades["n"], "centre_id": dades["c"],
+        "is_staff": dades["s"], "is_superuser": dades["a"], "is_active": True,
+    }
+    # from_db espera els valors en l'ordre dels camps del model
+    camps = [f.attname for f in Usuari._meta.concrete_fields if f.attname in valors]
+    return Usuari.from_db(router.db_for_read(Usuari), camps, [valors[c] for c in camps])
+
+
+def _revocar(dades):
+    caduca = dades["e"] + _config("TOKENS_REFRESC", 7 * 24 * 3600)
+    revocats.afegir(dades["j"], datetime.fromtimestamp(caduca, tz=dt_timezone.utc))
+
+
+# Tokens opacs
+
+def _emetre_opac(usuari):
+    token = secrets.token_hex(16)
+    usuari.auth_token = hash_token(token)
+    usuari.save(update_fields=["auth_token"])
+    return token
+
+
+def _usuari_opac(token):
+    clau = hash_token(token)
+    usuari = cache.obtenir(clau)
+    if usuari is None:
+        try:
+            usuari = Usuari.objects.select_related("centre", "grup").get(auth_token=clau, is_active=True)
+        except Usuari.DoesNotExist:
+            return None
+        cache.desar(clau, usuari.pk, usuari)
+    # Cada petició rep la seva còpia: les vistes poden modificar-la
+    return copy.copy(usuari)
+
+
+def emetre(usuari):
+    """Genera un token nou per a l'usuari i el retorna."""
+    if _config("TOKENS_SIGNATS", True):
+        return emetre_signat(usuari)
+    return _emetre_opac(usuari)
+
+
+def _clau_login(username, password):
+    return salted_hmac("biblioteca.tokens.login", f"{username}\0{password}", algorithm="sha256").hexdigest()
+
+
+def _reutilitzable(token):
+    if es_signat(token):
+        dades = verificar_signat(token)
+        return dades is not None and dades["e"] - time.time() >= _config("TOKENS_REUS_MINIM", 300)
+    return _config("TOKENS_OPACS", True) and _usuari_opac(token) is not None
+
+
+def iniciar_sessio(username, password):
+    """Token per a aquestes credencials, o None si no són vàlides."""
+    clau = _clau_login(username, password)
+    token = logins.obtenir(clau)
+    if token and _reutilitzable(token):
+        return token
+    usuari = authenticate(username=username, password=password)
+    if usuari is None:
+        return None
+    token = emetre(usuari)
+    logins.desar(clau, usuari.pk, token)
+    return token
+
+
+def usuari_per_token(token):
+    """Usuari actiu amb aquest token, o None."""
+    if es_signat(token):
+        dades = verificar_signat(token)
+        return _usuari_de(dades) if dades else None
+    if not _config("TOKENS_OPACS", True):
+        return None
+    return _usuari_opac(token)
+
+
+def refrescar(token):
+    """Token nou a canvi d'un de vàlid o caducat recentment, o None."""
+    if es_signat(token):
+        dades = verificar_signat(token, marge=_config("TOKENS_REFRESC", 7 * 24 * 3600))
+        if not dades:
+            return None
+        usuari = Usuari.objects.filter(pk=dades["u"], is_active=True).first()
+        if usuari is None:
+            return None
+        _revocar(dades)
+        return emetre_signat(usuari)
+    # Un token opac encara vàlid es pot canviar per un de signat
+    usuari = _usuari_opac(token) if _config("TOKENS_OPACS", True) else None
+    return emetre(usuari) if usuari else None
+
+
+def revocar(token):
+    """Tanca la sessió d'aquest token."""
+    if es_signat(token):
+        dades = verificar_signat(token)
+        if dades:
+            _revocar(dades)
+        return
+    clau = hash_token(token)
+    Usuari.objects.filter(auth_token=clau).update(auth_token=None)
+    cache.eliminar(clau)
+
+
+@receiver(post_save, sender=Usuari)
+@receiver(post_delete, sender=Usuari)
+def _usuari_canviat(sender, instance, update_fields=None, **kwargs):
+    cache.invalidar_usuari(instance.pk)
+    # Emetre un token opac només canvia auth_token: no cal oblidar la contrasenya
+    if update_fields is None or set(update_fields) != {"auth_token"}:
+        logins.invalidar_usuari(instance.pk)
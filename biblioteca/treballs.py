@@ -0,0 +1,173 @@
+"""
+Treballs d'etiquetes en segon pla.
+
+Demanar un PDF gran bloquejava un worker de l'Apache fins que s'acabava de
+renderitzar. Ara la petició només crea un TreballEtiquetes i retorna el seu id;
+un grup de fils del mateix procés (ETIQUETES_TREBALLADORS) el renderitza a
+ETIQUETES_TREBALLS_DIR i va desant el progrés, que el client consulta fins que
+el pot descarregar.
+
+- Els treballs són a la base de dades: amb la primera petició del procés
+  (wsgi/asgi, vegeu segon_pla) es tornen a encolar els pendents i els que
+  porten ETIQUETES_TREBALL_TIMEOUT segons en curs sense avançar (el procés que
+  els feia ha mort).
+- Un treball s'agafa amb un UPDATE condicional, de manera que si diversos
+  processos l'encuen només un el renderitza.
+- La mateixa llista d'ids amb el mateix renderitzador reutilitza el treball
+  existent (acabat o encara en curs) en lloc de tornar-lo a renderitzar.
+- Els treballs acabats o fallits fa més de ETIQUETES_TREBALL_CADUCITAT segons
+  s'esborren, amb el seu PDF, quan es reprenen els pendents i amb l'ordre
+  clean_label_jobs (per als servidors que no es reinicien).
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import etiquetes
+from .models import TreballEtiquetes
+
+logger = logging.getLogger(__name__)
+
+# Segons mínims entre dues escriptures del progrés a la base de dades
+INTERVAL_PROGRES = 1.0
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _config(nom, defecte):
+    return getattr(settings, nom, defecte)
+
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_config("ETIQUETES_TREBALLADORS", 2),
+                thread_name_prefix="etiquetes",
+            )
+        return _executor
+
+
+def _directori():
+    return _config("ETIQUETES_TREBALLS_DIR", os.path.join(settings.BASE_DIR, "cache", "etiquetes"))
+
+
+def clau(exemplar_ids, renderer):
+    text = f"{renderer}:" + ",".join(str(i) for i in exemplar_ids)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _encuar(treball_id):
+    transaction.on_commit(lambda: _pool().submit(_executar, treball_id))
+
+
+def crear(exemplar_ids, renderer="xhtml2pdf"):
+    """Retorna el treball per a aquesta llista d'ids, creant-lo i encuant-lo si cal."""
+    if renderer not in etiquetes.RENDERITZADORS:
+        raise etiquetes.ErrorEtiquetes(f"Renderitzador desconegut: {renderer}")
+
+    c = clau(exemplar_ids, renderer)
+    existents = TreballEtiquetes.objects.filter(clau=c, estat__in=["pendent", "en_curs", "acabat"]).order_by("-creat")
+    for treball in existents:
+        if treball.estat != "acabat" or (treball.fitxer and os.path.exists(treball.fitxer)):
+            return treball
+
+    treball = TreballEtiquetes.objects.create(clau=c, exemplar_ids=list(exemplar_ids), renderer=renderer)
+    _encuar(treball.pk)
+    return treball
+
+
+def _executar(treball_id):
+    try:
+        # Només un treballador (d'aquest o d'un altre procés) agafa el treball
+        agafat = TreballEtiquetes.objects.filter(pk=treball_id, estat="pendent").update(
+            estat="en_curs", pagines_fetes=0, actualitzat=timezone.now()
+        )
+        if not agafat:
+            return
+        treball = TreballEtiquetes.objects.get(pk=treball_id)
+        _renderitzar(treball)
+    except Exception:
+        logger.exception("Error al generar el treball d'etiquetes %s", treball_id)
+    finally:
+        connection.close()
+
+
+def _renderitzar(treball):
+    darrer = [0.0]
+
+    def progres(fetes, totals):
+        ara = time.monotonic()
+        if fetes < totals and ara - darrer[0] < INTERVAL_PROGRES:
+            return
+        darrer[0] = ara
+        TreballEtiquetes.objects.filter(pk=treball.pk).update(
+            pagines_fetes=fetes, pagines_totals=totals, actualitzat=timezone.now()
+        )
+
+    os.makedirs(_directori(), exist_ok=True)
+    cami = os.path.join(_directori(), f"etiquetes-{treball.pk}.pdf")
+    temporal = f"{cami}.tmp"
+    try:
+        exemplars = etiquetes.carregar_exemplars(treball.exemplar_ids)
+        with open(temporal, "wb") as desti:
+            pagines = etiquetes.escriure_pdf(exemplars, desti, treball.renderer, progres)
+        os.replace(temporal, cami)
+    except Exception as e:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        TreballEtiquetes.objects.filter(pk=treball.pk).update(
+            estat="error", error=str(e), actualitzat=timezone.now()
+        )
+        raise
+
+    TreballEtiquetes.objects.filter(pk=treball.pk).update(
+        estat="acabat", fitxer=cami, pagines_fetes=pagines, pagines_totals=pagines, actualitzat=timezone.now()
+    )
+
+
+def netejar_caducats():
+    """Esborra els treballs acabats o fallits caducats i els seus PDF. Retorna quants n'ha esborrat."""
+    limit = timezone.now() - timedelta(seconds=_config("ETIQUETES_TREBALL_CADUCITAT", 7 * 24 * 3600))
+    caducats = TreballEtiquetes.objects.filter(estat__in=["acabat", "error"], actualitzat__lt=limit)
+    caducats = dict(caducats.values_list("pk", "fitxer"))
+    # Primer el fitxer: si la fila quedés, la descàrrega respondria 410
+    for fitxer in caducats.values():
+        if fitxer:
+            try:
+                os.remove(fitxer)
+            except FileNotFoundError:
+                pass
+    TreballEtiquetes.objects.filter(pk__in=caducats).delete()
+    return len(caducats)
+
+
+def _reprendre():
+    try:
+        netejar_caducats()
+        limit = timezone.now() - timedelta(seconds=_config("ETIQUETES_TREBALL_TIMEOUT", 600))
+        abandonats = TreballEtiquetes.objects.filter(estat="en_curs", actualitzat__lt=limit)
+        abandonats.update(estat="pendent", actualitzat=timezone.now())
+        pendents = list(TreballEtiquetes.objects.filter(estat="pendent").order_by("pk").values_list("pk", flat=True))
+    except Exception:
+        logger.exception("No s'han pogut recuperar els treballs d'etiquetes pendents")
+        return
+    finally:
+        connection.close()
+    for treball_id in pendents:
+        _pool().submit(_executar, treball_id)
+
+
+def reprendre_pendents():
+    """Torna a encolar en segon pla els treballs pendents o abandonats."""
+    _pool().submit(_reprendre)
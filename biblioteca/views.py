@@ -8,9 +8,12 @@ from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Q
 import json
-from .models import Usuari, Centre, Grup
-import random
-import string
+from functools import wraps
+from django.conf import settings
+from django.http import FileResponse
+from . import permisos, tokens
+from .importacio import importar_usuaris, crear_importacio, cami_errors
+from .models import ImportacioUsuaris
 
 
 # Index View
@@ -30,76 +33,8 @@ def import_users(request):
 
     try:
         data = json.loads(request.body)
-        created_count = 0
-        errors_count = 0
-        error_details = []
-
-        for user_data in data:
-            try:
-                email = user_data.get("email")
-                telefon = user_data.get("telefon")
-
-                # Validar que el email no está en uso
-                if Usuari.objects.filter(email=email).exists():
-                    error_details.append({
-                        "email": email,
-                        "error": "El email ja existeix"
-                    })
-                    errors_count += 1
-                    continue
-                
-                # Validar que el teléfono no está en uso
-                if telefon and Usuari.objects.filter(telefon=telefon).exists():
-                    error_details.append({
-                        "email": email,
-                        "error": "El teléfon ja existeix"
-                    })
-                    errors_count += 1
-                    continue
-
-                # Búsqueda o creación de Centro
-                centre = None
-                if "centre" in user_data and user_data["centre"]:
-                    centre, _ = Centre.objects.get_or_create(
-                        nom=user_data["centre"]
-                    )
-                
-                # Búsqueda o creación de Ciclo
-                grup = None
-                if "grup" in user_data and user_data["grup"]:
-                    grup, _ = Grup.objects.get_or_create(
-                        nom=user_data["grup"]
-                    )
-                
-                # Crear nuevo usuario con contraseña aleatoria temporal
-                first_initial = user_data["nom"][0].lower() if user_data["nom"] else ""
-                last_name1 = user_data.get("cognom1", "").lower()
-                last_name2 = user_data.get("cognom2", "").lower()
-                username = f"{first_initial}{last_name1}{last_name2}".strip()
-
-                temp_password = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-                
-                new_user = Usuari(
-                    username=username,
-                    email=email,
-                    first_name=user_data["nom"],
-                    last_name=f"{user_data.get('cognom1', '')} {user_data.get('cognom2', '')}".strip(),
-                    telefon=telefon,
-                    centre=centre,
-                    grup=grup
-                )
-                new_user.set_password(temp_password)
-                new_user.save()
-                created_count += 1
-                    
-            except Exception as e:
-                errors_count += 1
-                error_details.append({
-                    "email": user_data.get("email", "desconocido"),
-                    "error": str(e)
-                })
-                print(f"Error al procesar usuario {user_data.get('email', 'desconocido')}: {str(e)}")
-        
+        created_count, errors_count, error_details = importar_usuaris(data)
+
         response_data = {
             "created": created_count,
             "errors": errors_count
@@ -114,6 +49,103 @@ def import_users(request):
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=400)
 
+# Importación en segundo plano de CSV/NDJSON grandes: solo bibliotecarios, con
+# el mismo token Bearer que la API. Como no se aceptan cookies de sesión, el
+# csrf_exempt no abre la puerta a peticiones de otras webs
+def _bibliotecari(request):
+    tipus, _, token = request.headers.get("Authorization", "").partition(" ")
+    if tipus.lower() != "bearer" or not token.strip():
+        return None
+    usuari = tokens.usuari_per_token(token.strip())
+    bibliotecari = permisos.instantania(usuari) if usuari else None
+    return bibliotecari if bibliotecari and bibliotecari.is_staff else None
+
+
+def nomes_bibliotecaris(vista):
+    @wraps(vista)
+    def comprovar(request, *args, **kwargs):
+        if _bibliotecari(request) is None:
+            return JsonResponse({"error": "No autorizado"}, status=401)
+        return vista(request, *args, **kwargs)
+    return comprovar
+
+
+def _mida_maxima():
+    return getattr(settings, "IMPORTACIO_MIDA_MAXIMA", 50 * 1024 * 1024)
+
+
+@csrf_exempt
+@nomes_bibliotecaris
+def import_users_stream(request):
+    if request.method != "POST":
+        return JsonResponse({"error": "Método no permitido"}, status=405)
+
+    # Antes de leer el cuerpo, si el cliente ya indica que es demasiado grande
+    try:
+        mida = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        mida = 0
+    if mida > _mida_maxima():
+        return JsonResponse({"error": "El fitxer és massa gran"}, status=413)
+
+    fitxer = request.FILES.get("fitxer")
+    if fitxer is None:
+        return JsonResponse({"error": "Falta el fitxer"}, status=400)
+    if fitxer.size > _mida_maxima():
+        return JsonResponse({"error": "El fitxer és massa gran"}, status=413)
+    format = request.POST.get("format")
+    if format not in (None, "csv", "ndjson"):
+        return JsonResponse({"error": "Format no vàlid"}, status=400)
+
+    importacio = crear_importacio(fitxer, format)
+    return JsonResponse(estat_importacio(importacio), status=202)
+
+
+def estat_importacio(importacio):
+    return {
+        "id": str(importacio.codi),
+        "estat": importacio.estat,
+        "files_totals": importacio.files_totals,
+        "files_processades": importacio.files_processades,
+        "created": importacio.creats,
+        "errors": importacio.errors,
+        "error": importacio.error,
+    }
+
+
+@nomes_bibliotecaris
+def import_users_stream_status(request, codi):
+    try:
+        importacio = ImportacioUsuaris.objects.get(codi=codi)
+    except ImportacioUsuaris.DoesNotExist:
+        return JsonResponse({"error": "Importació no trobada"}, status=404)
+    return JsonResponse(estat_importacio(importacio))
+
+
+@nomes_bibliotecaris
+def import_users_stream_errors(request, codi):
+    # Detalles de los errores, una línea JSON por fila con error
+    try:
+        importacio = ImportacioUsuaris.objects.get(codi=codi)
+    except ImportacioUsuaris.DoesNotExist:
+        return JsonResponse({"error": "Importació no trobada"}, status=404)
+    try:
+        errors = open(cami_errors(importacio), "rb")
+    except OSError:
+        return JsonResponse({"error": "Encara no hi ha errors"}, status=404)
+    # Solo la parte confirmada del fichero
+    return FileResponse(_llegir_fins(errors, importacio.errors_bytes), content_type="application/x-ndjson")
+
+
+def _llegir_fins(fitxer, limit, mida=64 * 1024):
+    with fitxer:
+        while limit > 0:
+            tros = fitxer.read(min(mida, limit))
+            if not tros:
+                break
+            limit -= len(tros)
+            yield tros
+
 # Errores
 def error_404(request, exception):
     return render(request, 'errors/404.html', status=404)